@@ -0,0 +1,79 @@
+# Write generated files only when their content changes
+#
+# VS Code's devcontainer tooling compares the devcontainer.json, Dockerfile
+# and settings.json files with the ones used to create the running container
+# and rebuilds it when they differ, so rewriting identical content is not
+# free.
+
+import hashlib
+import json
+import os
+
+from typing import Any
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def file_hash(path: str) -> str:
+    """sha256 of the file at path, or "" if it doesn't exist"""
+    try:
+        with open(path, "rb") as f:
+            return content_hash(f.read())
+    except FileNotFoundError:
+        return ""
+
+def write_if_changed(path: str, text: str) -> bool:
+    """Write text to path unless the file already has that content
+
+    Returns:
+        bool: True if the file was written
+    """
+    data = text.encode("utf-8")
+    if file_hash(path) == content_hash(data):
+        return False
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return True
+
+def to_json(obj: Any) -> str:
+    """Serialize obj the same way every time, so that equal objects produce
+    identical files"""
+    return json.dumps(obj, indent=4) + "\n"
+
+def write_json_if_changed(path: str, obj: Any) -> bool:
+    """Write obj as JSON to path unless the file already has that content
+
+    Returns:
+        bool: True if the file was written
+    """
+    return write_if_changed(path, to_json(obj))
+
+def copy_if_changed(src: str, dest_dir: str) -> bool:
+    """Copy the file src into dest_dir unless the copy is identical
+
+    Returns:
+        bool: True if the file was copied
+    """
+    with open(src, "rb") as f:
+        data = f.read()
+    dest = os.path.join(dest_dir, os.path.basename(src))
+    if file_hash(dest) == content_hash(data):
+        return False
+    with open(dest, "wb") as f:
+        f.write(data)
+    os.chmod(dest, os.stat(src).st_mode & 0o777)
+    return True
+
+def remove_if_exists(path: str) -> bool:
+    """Remove path if it exists
+
+    Returns:
+        bool: True if the file was removed
+    """
+    if not os.path.exists(path):
+        return False
+    os.remove(path)
+    return True
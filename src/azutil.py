@@ -8,13 +8,17 @@ import re
 import shlex
 import urllib.parse
 
-from exec import (exec_cmd_return_dataframe, exec_cmd, exit_on_error)
+from credentials import (STORAGE_KEY_TTL_SECONDS, get_secret, 
+    storage_key_name)
+from exec import (ExecResult, exec_cmd_return_dataframe, exec_cmd, 
+    exit_on_error)
 from ez_state import EzRuntime
 from formatting import printf, printf_err
+from mount_profiles import DEFAULT_PROFILE, automount_script, mount_command
 from os import path, system, path, system
 from rich import print
 from rich.prompt import IntPrompt
-from time import sleep
+from time import sleep, time
 
 # Execute commands, either locally or remotely
 
@@ -143,6 +147,25 @@ def is_vm_running(runtime: EzRuntime, vm_name) -> bool:
     result = exec_cmd(is_running)
     return True if result.exit_code == 0 else False
 
+def wait_for_compute(runtime: EzRuntime, vm_name: str, 
+    timeout: int=600) -> bool:
+    """Wait until vm_name accepts SSH connections and its Docker daemon is
+    ready to launch containers. Returns False on timeout."""
+    ez = runtime.current()
+    uri = get_compute_uri(runtime, vm_name)
+    deadline = time() + timeout
+    while time() < deadline:
+        try:
+            result = exec_cmd("docker info --format '{{.ServerVersion}}'",
+                uri=uri, private_key_path=ez.private_key_path)
+            if result.exit_code == 0:
+                return True
+        except Exception as e:
+            # Connection refused or timed out while the VM is booting
+            runtime.debug_print(f"WAITING for {vm_name}: {e}")
+        sleep(2)
+    return False
+
 def jit_activate_vm(runtime: EzRuntime, vm_name) -> None:
     """JIT activate vm_name for 3 hours"""
     # TODO: this is broken right now, they changed the resource ID
@@ -397,29 +420,104 @@ def pick_vm(resource_group, show_gpu_only=False):
     return df.iloc[choice]["Name"]
 
 def get_storage_account_key(storage_account_name: str, 
-    resource_group: str) -> str:
-    """Retrieve storage account key for current account"""
-    cmd = (f"az storage account keys list --resource-group "
-        f"{resource_group} --account-name {storage_account_name} "
-        f"--query \"[0].value\" --output json")
-    
-    result = exec_cmd(cmd, description="Retrieving storage account key")
-    if result.exit_code == 0:
-        return result.stdout.strip().strip('"')
-    else:
-        printf_err(result.stderr)
+    resource_group: str, refresh: bool=False) -> str:
+    """Retrieve storage account key for current account. The key is kept in
+    the local credential store, and refresh looks it up again, e.g., after
+    an authorization failure because the key was rotated."""
+    def fetch() -> str:
+        cmd = (f"az storage account keys list --resource-group "
+            f"{resource_group} --account-name {storage_account_name} "
+            f"--query \"[0].value\" --output json")
+        result = exec_cmd(cmd, description="Retrieving storage account key")
+        if result.exit_code == 0:
+            return result.stdout.strip().strip('"')
+        else:
+            printf_err(result.stderr)
+            exit(1)
+
+    return get_secret(storage_key_name(storage_account_name), fetch, 
+        STORAGE_KEY_TTL_SECONDS, refresh)
+
+def get_share_key(runtime: EzRuntime, refresh: bool=False) -> str:
+    """Storage account key used to mount the workspace file share, or "" for
+    NFS shares, which don't use it"""
+    ez = runtime.current()
+    if get_share_protocol(runtime) != "SMB":
+        return ""
+    return get_storage_account_key(ez.storage_account_name, 
+        ez.resource_group, refresh)
+
+def get_share_protocol(runtime: EzRuntime) -> str:
+    """Return the protocol (SMB or NFS) of the workspace file share. NFS 4.1
+    shares can only be created on premium (FileStorage) storage accounts."""
+    ez = runtime.current()
+    if ez.file_share_protocol == "":
+        cmd = (f"az storage share-rm show --resource-group "
+            f"{ez.resource_group} --storage-account "
+            f"{ez.storage_account_name} --name {ez.file_share_name} "
+            f"--query enabledProtocols --output tsv")
+        result = exec_cmd(cmd, 
+            description="Querying protocol of the Azure File Share")
+        if result.exit_code != 0:
+            return "SMB"
+        ez.file_share_protocol = result.stdout.strip() or "SMB"
+    return ez.file_share_protocol
+
+def deallocate_vm(runtime: EzRuntime, compute_name: str, 
+    hibernate: bool=False) -> None:
+    """Deallocate, or hibernate, compute_name and record how it was stopped
+    so that ez compute start can report the resume time. Exits if the
+    compute can't be stopped that way."""
+    ez = runtime.current()
+    compute = ez.computes.setdefault(compute_name, {})
+    if compute.get("ephemeral_os_disk", False):
+        printf_err(f"{compute_name} has an ephemeral OS disk and cannot be "
+            "deallocated. Use ez compute delete to remove it.")
+        exit(1)
+    if hibernate and not compute.get("hibernation", True):
+        printf_err(f"{compute_name} was not created with hibernation "
+            "enabled. Stop without --hibernate.")
         exit(1)
 
+    cmd = (f"az vm deallocate --name {compute_name} "
+        f"--resource-group {ez.resource_group}")
+    if hibernate:
+        cmd += " --hibernate true"
+    mode = "hibernating" if hibernate else "stopping"
+    result = exec_cmd(cmd, description=f"{mode} compute node {compute_name}")
+    exit_on_error(result)
+    compute["stopped_with"] = "hibernate" if hibernate else "deallocate"
+
+def has_automount(runtime: EzRuntime, compute_name: str, 
+    mount_path: str) -> bool:
+    """True if compute_name mounts the file share at mount_path on demand
+    (see ez compute mount --persistent)"""
+    ez = runtime.current()
+    return ez.computes.get(compute_name, {}).get("automount") == mount_path
+
+def has_data_cache(runtime: EzRuntime, compute_name: str) -> bool:
+    """True if compute_name has a local disk cache for the file share"""
+    ez = runtime.current()
+    return ez.computes.get(compute_name, {}).get("data_cache_gb", 0) > 0
+
 def mount_storage_account(runtime: EzRuntime, 
     compute_name: str, 
     mount_path: str, 
-    persistent_mount: bool=False) -> int:
-    """Generate SMB path name for Azure File Share"""
+    persistent_mount: bool=False,
+    profile: str=DEFAULT_PROFILE,
+    cache: bool=False) -> int:
+    """Mount the workspace Azure File Share at mount_path on compute_name
+    using the options of the mount profile. If cache is set, reads are
+    cached on the compute's local disk (see ez compute mount --cache-gb).
+
+    With persistent_mount, systemd on the compute mounts the share on first
+    access to mount_path, including after the compute restarts."""
 
-    # Retrieve the storage account key and urlencode it
     ez = runtime.current()
-    key = get_storage_account_key(ez.storage_account_name, ez.resource_group)
-    quoted_key = urllib.parse.quote_plus(key)
+    protocol = get_share_protocol(runtime)
+    if persistent_mount and compute_name == ".":
+        printf_err("Persistent mounts are only supported on remote computes")
+        return 1
 
     # Ensure that the mount directory is created on the server
     cmd = f"mkdir -p {mount_path}"
@@ -433,40 +531,54 @@ def mount_storage_account(runtime: EzRuntime,
     exit_on_error(result)
 
     # Mount the Azure File Share onto the VM 
-    # TODO: Add a flag that indicates whether we want to mount temporarily 
-    # for the session or permanently via editing fstab
-    # //servername/sharename  /media/windowsshare  cifs  guest,uid=1000,iocharset=utf8  0  0
-    if persistent_mount:
-        raise ValueError("persistent_mount True is not supported yet")
-
-    if compute_name == ".":
-        client_os = platform.system()
-        if client_os == "Darwin":
-            cmd = (f"mount_smbfs -d 0777 -f 0777 //{ez.storage_account_name}:"
-                f"{quoted_key}@{ez.storage_account_name}."
-                f"file.core.windows.net/{ez.file_share_name} {mount_path}")
-        elif client_os == "Linux":
-            cmd = (f"sudo mount -t cifs //{ez.storage_account_name}."
-                f"file.core.windows.net/{ez.file_share_name} {mount_path} "
-                f"-o username={ez.storage_account_name},password={key},"
-                f"serverino,uid={getpass.getuser()},file_mode=0777,"
-                f"dir_mode=0777")
+    def mount(key: str) -> ExecResult:
+        if compute_name == ".":
+            client_os = platform.system()
+            if client_os == "Darwin":
+                quoted_key = urllib.parse.quote_plus(key)
+                cmd = (f"mount_smbfs -d 0777 -f 0777 "
+                    f"//{ez.storage_account_name}:{quoted_key}@"
+                    f"{ez.storage_account_name}.file.core.windows.net/"
+                    f"{ez.file_share_name} {mount_path}")
+            elif client_os == "Linux":
+                cmd = mount_command(ez.storage_account_name, 
+                    ez.file_share_name, mount_path, profile, protocol, key, 
+                    getpass.getuser())
+            else:
+                printf_err(f"Trying to mount on unsupported system "
+                    f"{client_os}")
+                exit(1)
+            return exec_cmd(cmd,
+                description=f"Mounting local Azure File Share ({profile})")
+        elif persistent_mount:
+            script = automount_script(ez.storage_account_name, 
+                ez.file_share_name, mount_path, profile, protocol, key, 
+                ez.user_name, cache)
+            return exec_cmd(f"sudo bash -c {shlex.quote(script)}", 
+                get_compute_uri(runtime, compute_name), ez.private_key_path,
+                description=f"Configuring automount of Azure File Share "
+                    f"({profile})")
         else:
-            printf_err(f"Trying to mount on unsupported system {client_os}")
-            exit(1)
-        result = exec_cmd(cmd,
-            description="Mounting local Azure File Share")
-    else:
-        cmd = (f"sudo mount -t cifs //{ez.storage_account_name}."
-            f"file.core.windows.net/{ez.file_share_name} {mount_path} "
-            f"-o username={ez.storage_account_name},password={key},serverino,"
-            f"uid={ez.user_name},file_mode=0777,dir_mode=0777")
-        result = exec_cmd(cmd, get_compute_uri(runtime, compute_name), 
-            ez.private_key_path,
-            description="Mounting remote Azure File Share")
+            cmd = mount_command(ez.storage_account_name, ez.file_share_name,
+                mount_path, profile, protocol, key, ez.user_name, cache)
+            return exec_cmd(cmd, get_compute_uri(runtime, compute_name), 
+                ez.private_key_path,
+                description=f"Mounting remote Azure File Share ({profile})")
+
+    # The key comes from the local credential store. If the share rejects
+    # it, the key was probably rotated: look it up again and retry.
+    result = mount(get_share_key(runtime))
+    if protocol == "SMB" and is_auth_failure(result):
+        result = mount(get_share_key(runtime, refresh=True))
     # exit_on_error(result)
     return result.exit_code
 
+def is_auth_failure(result: ExecResult) -> bool:
+    """True if a mount failed because the credentials were rejected"""
+    output = f"{result.stdout}\n{result.stderr}".lower()
+    return result.exit_code != 0 and ("error(13)" in output or
+        "permission denied" in output or "authentication error" in output)
+
 def get_compute_uri(runtime: EzRuntime, compute_name: str) -> str:
     ez = runtime.current()
     return f"{ez.user_name}@{compute_name}.{ez.region}.cloudapp.azure.com"
@@ -7,15 +7,25 @@ import os
 import pandas as pd
 import shlex
 
-from azutil import (copy_to_clipboard, enable_jit_access_on_vm, is_gpu, 
+from azutil import (copy_to_clipboard, deallocate_vm, 
+    enable_jit_access_on_vm, is_gpu, 
     jit_activate_vm, get_vm_size, get_active_compute_name, 
-    mount_storage_account, get_compute_uri, get_host_ecdsa_key)
+    has_automount, has_data_cache, mount_storage_account, get_compute_uri, 
+    get_host_ecdsa_key, wait_for_compute)
 from exec import ExecResult, exec_cmd, exec_file, exit_on_error
 from ez_state import EzRuntime
 from fabric import Connection
-from formatting import printf, printf_err
+from formatting import format_output_string, printf, printf_err
+from mount_profiles import (DEFAULT_PROFILE, PROFILES, bench_command, 
+    parse_bench, remove_automount_script)
 from os import path, system
 from rich import print
+from rich.progress import (Progress, SpinnerColumn, TextColumn, 
+    TimeElapsedColumn)
+from size_catalog import (CreateOptions, get_vm_size_info, 
+    validate_create_options)
+from sync import format_bytes
+from time import time
 from typing import Optional
 
 @click.command()
@@ -34,9 +44,25 @@ from typing import Optional
     "DNS caching issues for recycled names)"))
 @click.option("--no-install", "-q", is_flag=True, default=False,
     help=("Do not install system software"))
+@click.option("--os-disk-size", type=int, default=None,
+    help="Size of the OS disk in GB (default from workspace)")
+@click.option("--ephemeral-os-disk/--no-ephemeral-os-disk", default=None,
+    help=("Put the OS disk on the local disk of the VM. Faster, but the VM "
+    "cannot be deallocated (default from workspace)"))
+@click.option("--accelerated-networking/--no-accelerated-networking", 
+    default=None, help="Enable accelerated networking (default from "
+    "workspace)")
+@click.option("--ppg", default=None,
+    help=("Proximity placement group to create the VM in; created if it "
+    "doesn't exist (default from workspace)"))
+@click.option("--hibernation/--no-hibernation", default=None,
+    help=("Enable hibernation so that the VM can be stopped with "
+    "ez compute stop --hibernate (default from workspace)"))
 @click.pass_obj
 def create(runtime: EzRuntime, name: str, compute_size: str, 
-    compute_type: str, image: str, force:bool, no_install: bool):
+    compute_type: str, image: str, force:bool, no_install: bool,
+    os_disk_size: int, ephemeral_os_disk: bool, 
+    accelerated_networking: bool, ppg: str, hibernation: bool):
     """Create a compute node"""
 
     ez = runtime.current()
@@ -67,8 +93,26 @@ def create(runtime: EzRuntime, name: str, compute_size: str,
     # a GPU
     if compute_type == "vm":
 
-        # TODO: parameterize this in .ez.conf
-        os_disk_size = 256
+        # Command line options override the workspace defaults
+        options = CreateOptions(
+            os_disk_size_gb=(ez.os_disk_size_gb if os_disk_size is None 
+                else os_disk_size),
+            ephemeral_os_disk=(ez.ephemeral_os_disk 
+                if ephemeral_os_disk is None else ephemeral_os_disk),
+            accelerated_networking=(ez.accelerated_networking
+                if accelerated_networking is None 
+                else accelerated_networking),
+            proximity_placement_group=(ez.proximity_placement_group
+                if ppg is None else ppg),
+            hibernation=(ez.enable_hibernation if hibernation is None
+                else hibernation))
+
+        size_info = get_vm_size_info(runtime, compute_size)
+        errors = validate_create_options(size_info, options)
+        if len(errors) > 0:
+            for error in errors:
+                printf_err(error)
+            exit(1)
 
         description = (
             f"creating virtual machine {name} size "
@@ -83,13 +127,38 @@ def create(runtime: EzRuntime, name: str, compute_size: str,
             f"--admin-username {ez.user_name} "
             f"--public-ip-address-dns-name {name} "
             f"--public-ip-sku Standard "
-            f"--os-disk-size-gb {os_disk_size} "
+            f"--os-disk-size-gb {options.os_disk_size_gb} "
             f"-o json"
         )   
+        if options.ephemeral_os_disk:
+            printf("ephemeral OS disk: the VM cannot be deallocated, "
+                "use ez compute delete when you are done with it", indent=2)
+            cmd += (" --ephemeral-os-disk true --os-disk-caching ReadOnly "
+                "--ephemeral-os-disk-placement "
+                f"{options.ephemeral_os_disk_placement}")
+        if options.accelerated_networking:
+            cmd += " --accelerated-networking true"
+        if options.hibernation:
+            cmd += " --enable-hibernation true"
+        if options.proximity_placement_group != "":
+            __ensure_proximity_placement_group(runtime, 
+                options.proximity_placement_group)
+            cmd += f" --ppg {options.proximity_placement_group}"
+
         result = exec_cmd(cmd, description=description)
         exit_on_error(result)
+
+        ez.computes[name] = {
+            "size": compute_size,
+            "os_disk_size_gb": options.os_disk_size_gb,
+            "ephemeral_os_disk": options.ephemeral_os_disk,
+            "accelerated_networking": options.accelerated_networking,
+            "proximity_placement_group": options.proximity_placement_group,
+            "hibernation": options.hibernation,
+        }
         
         if no_install:
+            runtime.save()
             exit(0)
 
         # Once the VM is created, we need to trust the created VM. This
@@ -132,6 +201,23 @@ def create(runtime: EzRuntime, name: str, compute_size: str,
         print(f"Unknown --compute-type: {compute_type}")
         exit(1)
 
+def __ensure_proximity_placement_group(runtime: EzRuntime, 
+    ppg_name: str) -> None:
+    """Create the proximity placement group ppg_name if it doesn't exist"""
+    ez = runtime.current()
+    cmd = (f"az ppg show --name {ppg_name} "
+        f"--resource-group {ez.resource_group} -o none")
+    result = exec_cmd(cmd)
+    if result.exit_code == 0:
+        return
+
+    cmd = (f"az ppg create --name {ppg_name} "
+        f"--resource-group {ez.resource_group} --location {ez.region} "
+        f"--type Standard -o none")
+    result = exec_cmd(cmd, 
+        description=f"creating proximity placement group {ppg_name}")
+    exit_on_error(result)
+
 @click.option("--name", "-n", required=True, default="",
     help="Name of compute to update")
 @click.option("--compute-size", "-s", required=True, 
@@ -162,10 +248,16 @@ def __update_system(runtime: EzRuntime, compute_name: str,
         provision_vm_script = "provision-gpu"
 
     description = "Installing system software on compute"
-    provision_vm_script_path = (
-        f"{path.dirname(path.realpath(__file__))}/scripts/"
-        f"{provision_vm_script}"
-    )
+    scripts_dir = f"{path.dirname(path.realpath(__file__))}/scripts"
+    provision_vm_script_path = f"{scripts_dir}/{provision_vm_script}"
+
+    # The provisioning scripts install ez-local-disk, which moves the Docker
+    # data-root and scratch space onto the local temp or NVMe disk
+    hostname = f"{compute_name}.{ez.region}.cloudapp.azure.com"
+    with Connection(hostname, user=ez.user_name,
+        connect_kwargs={ "key_filename": [ez.private_key_path] }) as c:
+        c.put(f"{scripts_dir}/ez-local-disk",
+            f"/home/{ez.user_name}/ez-local-disk")
 
     uri = get_compute_uri(runtime, compute_name)
     result = exec_file(provision_vm_script_path, uri=uri, 
@@ -458,8 +550,10 @@ def ls(runtime: EzRuntime, all: bool):
 @click.command()
 @click.option("--name", "-n", prompt="Name of compute to start",
     help="Name of compute to start")
+@click.option("--no-wait", is_flag=True, default=False,
+    help="Don't wait for the compute to be ready to run containers")
 @click.pass_obj
-def start(runtime: EzRuntime, name: str):
+def start(runtime: EzRuntime, name: str, no_wait: bool):
     """Start a virtual machine"""
 
     ez = runtime.current()
@@ -469,26 +563,73 @@ def start(runtime: EzRuntime, name: str):
 
     name = get_active_compute_name(runtime, name)
     jit_activate_vm(runtime, name)
+    compute = ez.computes.setdefault(name, {})
+    stopped_with = compute.pop("stopped_with", None)
+
+    # Resume time is measured until Docker on the compute is ready to launch
+    # containers so that hibernate and deallocate can be compared. It isn't
+    # recorded when ez didn't stop the compute, which may have been stopped
+    # some other way or may still be running.
+    started = time()
     result = exec_cmd(f"az vm start --name {name} "
         f"--resource-group {ez.resource_group}",
         description=f"starting compute node {name}")
     exit_on_error(result)
+
+    if not no_wait:
+        description = f"waiting for {name} to be ready"
+        with Progress(
+            SpinnerColumn(),
+            TextColumn("[progress.description]{task.description}"),
+            TimeElapsedColumn(),
+        ) as progress:
+            task = progress.add_task(format_output_string(description))
+            ready = wait_for_compute(runtime, name)
+            progress.update(task, completed=100, description=
+                format_output_string(f"Completed: {description}"))
+        if ready and stopped_with is not None:
+            __record_resume_time(runtime, name, stopped_with, 
+                time() - started)
+        elif not ready:
+            printf_err(f"Timed out waiting for {name} to be ready")
+
     ez.active_remote_compute = name
     runtime.save()
     exit(0)
 
+def __record_resume_time(runtime: EzRuntime, compute_name: str, 
+    stopped_with: str, seconds: float):
+    """Record and report how long compute_name took to resume after it was
+    stopped using stopped_with (hibernate or deallocate)"""
+    ez = runtime.current()
+    compute = ez.computes.setdefault(compute_name, {})
+    resume_seconds = compute.setdefault("resume_seconds", {})
+    history = resume_seconds.setdefault(stopped_with, [])
+    history.append(round(seconds, 1))
+    del history[:-10]
+
+    mode = "hibernation" if stopped_with == "hibernate" else "cold start"
+    printf(f"resumed {compute_name} from {mode} in {seconds:.1f}s", indent=2)
+    for other, other_history in resume_seconds.items():
+        if other != stopped_with and len(other_history) > 0:
+            other_mode = ("hibernation" if other == "hibernate" 
+                else "cold start")
+            average = sum(other_history) / len(other_history)
+            printf(f"compare: {other_mode} averages {average:.1f}s over "
+                f"{len(other_history)} starts", indent=2)
+
 @click.command()
 @click.option("--name", "-n", default="", help="Name of compute to stop")
+@click.option("--hibernate", is_flag=True, default=False,
+    help=("Hibernate instead of deallocating so that start restores memory "
+    "state. Compute must be created with --hibernation"))
 @click.pass_obj
-def stop(runtime: EzRuntime, name: str):
+def stop(runtime: EzRuntime, name: str, hibernate: bool):
     """Stop a virtual machine"""
     ez = runtime.current()
     name = get_active_compute_name(runtime, name)
     # TODO: get compute_type too and fail for now on this
-    result = exec_cmd(f"az vm deallocate --name {name} "
-        f"--resource-group {ez.resource_group}",
-        description=f"stopping compute node {name}")
-    exit_on_error(result)
+    deallocate_vm(runtime, name, hibernate)
     ez.active_remote_compute = name
     runtime.save()
     exit(0)
@@ -574,19 +715,114 @@ def info(runtime: EzRuntime, name: str):
 @click.option("--name", "-n", 
     prompt="Name of compute to mount Azure File share on",
     help="Name of compute to mount Azure File share on")
+@click.option("--profile", type=click.Choice(list(PROFILES.keys())),
+    default=DEFAULT_PROFILE, 
+    help=f"Mount options to use (default {DEFAULT_PROFILE})")
+@click.option("--bench", is_flag=True, default=False,
+    help="Measure read throughput and metadata ops/s of each profile")
+@click.option("--cache-gb", type=click.IntRange(min=0), default=None,
+    help=("Cache reads from the share in up to this many GB of the "
+    "compute's local disk, 0 to disable the cache"))
+@click.option("--persistent/--no-persistent", default=None,
+    help=("Mount the share on first access, including after the compute "
+    "restarts, using a systemd automount"))
 @click.pass_obj
-def mount(runtime: EzRuntime, name: str):
-    """Mount the workspace file share onto the compute and storage"""
+def mount(runtime: EzRuntime, name: str, profile: str, bench: bool,
+    cache_gb: Optional[int], persistent: Optional[bool]):
+    """Mount the workspace file share onto the compute and storage
+
+\b
+Profiles:
+  throughput         Large sequential reads and writes
+  metadata-heavy     Many small files
+  read-only-dataset  Read-only mount that caches aggressively
+
+With --cache-gb, repeated reads of the same files (e.g., every epoch over
+a dataset) are served from the local disk after the first read. The least
+recently used files are evicted once the cache is full. The setting is
+remembered and used when env go mounts the share.
+
+With --persistent, the storage account key is kept in a credentials file
+that only root can read on the compute, and env go no longer needs to
+mount the share. --no-persistent removes the automount.
+    """
     ez = runtime.current()
     name = get_active_compute_name(runtime, name)
 
+    if bench:
+        __bench_mount_profiles(runtime, name)
+        runtime.save()
+        exit(0)
+
     # TODO: figure out whether to mount onto VM or onto each env
     # TODO: figure out where to mount - for now let's call it data
     # mount_path = f"/home/{ez.user_name}/src/{env_name}/data"
     mount_path = f"/home/{ez.user_name}/data"
 
+    compute = ez.computes.setdefault(name, {})
+    if persistent is None:
+        persistent = has_automount(runtime, name, mount_path)
+    elif not persistent and "automount" in compute:
+        exec_cmd(f"sudo bash -c "
+            f"{shlex.quote(remove_automount_script(compute['automount']))}",
+            get_compute_uri(runtime, name), ez.private_key_path,
+            description="Removing automount of Azure File Share")
+        del compute["automount"]
+
+    if cache_gb is not None:
+        __configure_data_cache(runtime, name, cache_gb)
+        # Remount so that the fsc option is added or removed
+        exec_cmd(f"sudo umount {mount_path}", 
+            get_compute_uri(runtime, name), ez.private_key_path)
+
+    exit_code = mount_storage_account(runtime, name, mount_path, 
+        persistent_mount=persistent, profile=profile, 
+        cache=has_data_cache(runtime, name))
+    if persistent and exit_code == 0:
+        compute["automount"] = mount_path
     runtime.save()
-    exit(mount_storage_account(runtime, name, mount_path))
+    exit(exit_code)
+
+def __configure_data_cache(runtime: EzRuntime, compute_name: str, 
+    cache_gb: int):
+    """Create (or remove if cache_gb is 0) the FS-Cache store for the file
+    share on the local disk of compute_name"""
+    ez = runtime.current()
+    if compute_name == ".":
+        printf_err("The data cache is only supported on remote computes")
+        exit(1)
+    result = exec_cmd(f"sudo /usr/local/bin/ez-local-disk cache "
+        f"{ez.user_name} {cache_gb}", get_compute_uri(runtime, compute_name),
+        ez.private_key_path, 
+        description=f"Configuring {cache_gb}GB data cache on {compute_name}")
+    exit_on_error(result)
+    compute = ez.computes.setdefault(compute_name, {})
+    compute["data_cache_gb"] = cache_gb
+
+def __bench_mount_profiles(runtime: EzRuntime, compute_name: str):
+    """Mount the file share with each profile on compute_name and measure
+    the read throughput of a 256MB file and the stat + read rate of 1000
+    4KB files. The test files are kept in ez-bench on the share."""
+    ez = runtime.current()
+    uri = get_compute_uri(runtime, compute_name)
+    bench_path = f"/home/{ez.user_name}/.ez/bench-mount"
+    for profile in PROFILES.keys():
+        exec_cmd(f"sudo umount {bench_path}", uri, ez.private_key_path)
+        exit_code = mount_storage_account(runtime, compute_name, bench_path,
+            profile=profile)
+        if exit_code != 0:
+            printf_err(f"{profile}: mount failed", indent=2)
+            continue
+        result = exec_cmd(bench_command(f"{bench_path}/ez-bench"), uri,
+            ez.private_key_path,
+            description=f"Benchmarking {profile} profile")
+        exec_cmd(f"sudo umount {bench_path}", uri, ez.private_key_path)
+        if result.exit_code != 0:
+            printf_err(f"{profile}: {result.stderr}", indent=2)
+            continue
+        throughput, ops = parse_bench(result.stdout)
+        printf(f"{profile}: read {format_bytes(throughput)}/s, "
+            f"{ops:.0f} metadata ops/s", indent=2)
 
 @click.command()
 @click.option("--name", "-n", 
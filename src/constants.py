@@ -3,4 +3,30 @@ SSH_DIR = "~/.ssh"
 
 # GitHub public key SHA256 hash to detect MITM attacks
 GITHUB_PUBLIC_KEY_SHA256 = "nThbg6kXUpJWGl7E1IGOCspRomTxdCARLviKw6E5SY8"
-MINICONDA_INSTALLER = "https://repo.anaconda.com/miniconda/Miniconda3-latest-Linux-x86_64.sh"
\ No newline at end of file
+
+# Image that generated Dockerfiles copy conda from
+CONDA_IMAGE = "condaforge/miniforge3:latest"
+
+# Local ez state that isn't part of the workspace configuration
+SIZE_CATALOG_CACHE = "~/.ez/size_catalog.json"
+IMAGE_DIGEST_CACHE = "~/.ez/image_digests.json"
+TRANSFER_JOURNAL_DIR = "~/.ez/transfers"
+CREDENTIALS_FILE = "~/.ez/credentials.json"
+
+# Where provisioning puts the Docker data-root and scratch space when the VM
+# has a local temp or NVMe disk
+LOCAL_DISK_ROOT = "/mnt/ez"
+SCRATCH_DIR = f"{LOCAL_DISK_ROOT}/scratch"
+
+# Where ez data prefetch copies files from the workspace file share. It is
+# /scratch/data in environments.
+PREFETCH_DIR = f"{SCRATCH_DIR}/data"
+
+# Bare git object caches on each compute, relative to the user's home
+GIT_CACHE_DIR = ".ez/git-cache"
+
+# Spool of headless jobs on each compute, relative to the user's home
+JOBS_DIR = ".ez/jobs"
+
+# Control sockets of multiplexed SSH connections to computes
+SSH_CONTROL_DIR = "~/.ez/ssh"
@@ -0,0 +1,65 @@
+# Local store of secrets that are expensive to look up, e.g., storage
+# account keys, which take an az call of a few seconds to retrieve
+#
+# The store is a JSON file that only the user can read. Entries expire after
+# a TTL so that rotated keys are picked up eventually; callers that get an
+# authorization failure with a cached secret look it up again right away
+# with refresh.
+
+import constants as C
+import json
+import os
+import threading
+
+from time import time
+from typing import Callable
+
+# Storage account keys are rarely rotated, and a rotation is detected by
+# the authorization failure that it causes
+STORAGE_KEY_TTL_SECONDS = 24 * 60 * 60
+
+__lock = threading.Lock()
+
+def __path() -> str:
+    return os.path.expanduser(C.CREDENTIALS_FILE)
+
+def load_credentials() -> dict:
+    path = __path()
+    try:
+        if os.stat(path).st_mode & 0o077:
+            os.chmod(path, 0o600)
+        with open(path, "rt") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return {}
+
+def save_credentials(credentials: dict) -> None:
+    """Write credentials to the store, which is created readable and
+    writable by the user only"""
+    path = __path()
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wt") as f:
+        json.dump(credentials, f, indent=2)
+    os.chmod(tmp_path, 0o600)
+    os.replace(tmp_path, path)
+
+def get_secret(name: str, fetch: Callable[[], str], ttl: float,
+    refresh: bool=False) -> str:
+    """Return the secret called name from the store, or fetch it and store
+    it if it is missing, older than ttl seconds or refresh is set"""
+    with __lock:
+        entry = load_credentials().get(name)
+        if (not refresh and entry is not None and
+            time() - entry["fetched"] < ttl):
+            return entry["value"]
+
+        value = fetch()
+        credentials = load_credentials()
+        credentials[name] = { "value": value, "fetched": time() }
+        save_credentials(credentials)
+        return value
+
+def storage_key_name(storage_account_name: str) -> str:
+    return f"storage-account-key:{storage_account_name}"
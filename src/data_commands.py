@@ -0,0 +1,199 @@
+# Data commands
+
+import click
+import constants as C
+import json
+import os
+import prefetch_agent
+import shlex
+
+from azutil import (get_active_compute_name, get_compute_uri, has_data_cache,
+    get_storage_account_key, mount_storage_account)
+from dataclasses import dataclass, field
+from exec import open_connection
+from ez_state import Ez, EzRuntime
+from file_share import (FileShareClient, FileShareError, plan_pull, plan_push,
+    pull_files, push_files)
+from formatting import printf, printf_err
+from sync import format_bytes
+from time import time
+from transfer import CopyStats
+from typing import List, Optional
+
+@dataclass
+class PrefetchStats:
+    files: int=0
+    skipped: int=0
+    bytes_copied: int=0
+    seconds: float=0
+    failed: List[str]=field(default_factory=list)
+
+    def describe(self) -> str:
+        throughput = (self.bytes_copied / self.seconds if self.seconds > 0
+            else 0)
+        return (f"prefetched {self.files - self.skipped} files "
+            f"({format_bytes(self.bytes_copied)}) in {self.seconds:.1f}s at "
+            f"{format_bytes(throughput)}/s, skipped {self.skipped} already "
+            f"in {C.PREFETCH_DIR}")
+
+def prefetch_data(runtime: EzRuntime, ez: Ez, compute_name: str,
+    patterns: List[str], jobs: int=16) -> PrefetchStats:
+    """Copy the files in the workspace file share that match patterns to
+    the local disk of compute_name, where environments see them under
+    /scratch/data. The share is mounted first if it isn't mounted yet.
+
+    Raises:
+        IOError: if the compute has no local disk or the agent fails
+    """
+    uri = get_compute_uri(runtime, compute_name)
+    share_path = f"/home/{ez.user_name}/data"
+    remote_dir = f"/home/{ez.user_name}/.ez"
+    agent_path = f"{remote_dir}/prefetch_agent.py"
+    with open_connection(uri, ez.private_key_path) as c:
+        if not c.run(f"mountpoint -q {share_path}", hide="both",
+            warn=True).ok:
+            mount_storage_account(runtime, compute_name, share_path,
+                cache=has_data_cache(runtime, compute_name))
+        if not c.run(f"test -d {C.SCRATCH_DIR}", hide="both", warn=True).ok:
+            raise IOError(f"{compute_name} has no local disk to prefetch to")
+        c.run(f"mkdir -p {remote_dir}", hide="both")
+        c.put(prefetch_agent.__file__, agent_path)
+        args = " ".join(shlex.quote(a) for a in
+            [share_path, C.PREFETCH_DIR, str(jobs)] + list(patterns))
+        result = c.run(f"python3 {agent_path} {args}", hide="both", 
+            warn=True)
+        if not result.ok:
+            raise IOError(result.stderr.strip())
+    stats = json.loads(result.stdout)
+    return PrefetchStats(files=stats["files"], skipped=stats["skipped"],
+        bytes_copied=stats["bytes"], seconds=stats["seconds"],
+        failed=stats["failed"])
+
+@click.command()
+@click.option("--name", "-n", default="",
+    help="Compute to prefetch onto (default is the active compute)")
+@click.option("--jobs", "-j", type=click.IntRange(min=1), default=16,
+    help="Number of parallel reads from the file share (default 16)")
+@click.argument("patterns", nargs=-1, required=True)
+@click.pass_obj
+def prefetch(runtime: EzRuntime, name: str, jobs: int, patterns: List[str]):
+    """Copy files from the workspace file share to the compute's local disk
+
+PATTERNS are paths or globs relative to the root of the share, e.g.,
+imagenet/train or 'cifar/**/*.png'. Directories are copied recursively.
+The files are copied to the local temp or NVMe disk, where environments
+see them under /scratch/data with the same paths as under /data. Copies
+are verified with sha256, and files that were already copied are skipped.
+    """
+    ez = runtime.current()
+    name = get_active_compute_name(runtime, name)
+    if name == ".":
+        printf_err("Prefetch copies to the local disk of a remote compute")
+        exit(1)
+
+    try:
+        stats = prefetch_data(runtime, ez, name, patterns, jobs)
+    except IOError as e:
+        printf_err(f"Prefetch failed: {e}")
+        runtime.save()
+        exit(1)
+    runtime.save()
+
+    if stats.files == 0:
+        printf_err(f"No files in the file share match {' '.join(patterns)}")
+        exit(1)
+    printf(stats.describe(), indent=2)
+    if len(stats.failed) > 0:
+        printf_err(f"Could not copy {', '.join(stats.failed)}")
+        exit(1)
+    exit(0)
+
+def share_client(runtime: EzRuntime,
+    endpoint: Optional[str]=None) -> FileShareClient:
+    """Client for the workspace file share. The storage account key is read
+    from AZURE_STORAGE_KEY if it is set, e.g., for a storage emulator, and
+    otherwise from the local credential store."""
+    ez = runtime.current()
+    if "AZURE_STORAGE_KEY" in os.environ:
+        return FileShareClient(ez.storage_account_name, 
+            os.environ["AZURE_STORAGE_KEY"], ez.file_share_name, endpoint)
+    return FileShareClient(ez.storage_account_name, 
+        get_storage_account_key(ez.storage_account_name, ez.resource_group),
+        ez.file_share_name, endpoint, 
+        refresh_key=lambda: get_storage_account_key(ez.storage_account_name,
+            ez.resource_group, refresh=True))
+
+def report_transfer(verb: str, stats: CopyStats, elapsed: float) -> None:
+    throughput = stats.bytes_copied / elapsed if elapsed > 0 else 0
+    printf(f"{verb} {stats.files - stats.skipped} files "
+        f"({format_bytes(stats.bytes_copied)}) in {elapsed:.1f}s at "
+        f"{format_bytes(throughput)}/s, skipped {stats.skipped} unchanged, "
+        f"resumed {stats.resumed}", indent=2)
+
+@click.command()
+@click.option("--jobs", "-j", type=click.IntRange(min=1), default=16,
+    help="Number of ranges to transfer at the same time (default 16)")
+@click.option("--endpoint", default=None,
+    help=("File service URL, e.g., of a storage emulator (default "
+    "https://<storage account>.file.core.windows.net)"))
+@click.argument("src")
+@click.argument("dest", default="")
+@click.pass_obj
+def push(runtime: EzRuntime, jobs: int, endpoint: Optional[str], src: str,
+    dest: str):
+    """Upload a local file or directory to the workspace file share
+
+DEST is a directory in the share, the root of the share by default. It is
+/data in environments that mount the share. Files are uploaded in parallel
+4MB ranges. Files that are already in the share with the same content are
+skipped, and an interrupted push resumes when it is run again.
+    """
+    client = share_client(runtime, endpoint)
+    try:
+        copies = plan_push(client, src, dest)
+        started = time()
+        stats = push_files(client, copies, jobs,
+            description=f"Pushing {src}")
+    except FileNotFoundError as e:
+        printf_err(f"No such file or directory: {e}")
+        exit(1)
+    except (FileShareError, IOError) as e:
+        printf_err(f"Push failed: {e}. Run the command again to resume.")
+        exit(1)
+    report_transfer("pushed", stats, time() - started)
+    runtime.save()
+    exit(0)
+
+@click.command()
+@click.option("--jobs", "-j", type=click.IntRange(min=1), default=16,
+    help="Number of ranges to transfer at the same time (default 16)")
+@click.option("--endpoint", default=None,
+    help=("File service URL, e.g., of a storage emulator (default "
+    "https://<storage account>.file.core.windows.net)"))
+@click.argument("src")
+@click.argument("dest", default=".")
+@click.pass_obj
+def pull(runtime: EzRuntime, jobs: int, endpoint: Optional[str], src: str,
+    dest: str):
+    """Download a file or directory from the workspace file share
+
+SRC is a path in the share and DEST a local directory, the current
+directory by default. Files are downloaded in parallel 4MB ranges and
+verified against their Content-MD5. Local files with the same content are
+skipped, and an interrupted pull resumes when it is run again.
+    """
+    client = share_client(runtime, endpoint)
+    try:
+        copies = plan_pull(client, src, dest)
+        started = time()
+        stats = pull_files(client, copies, jobs,
+            description=f"Pulling {src}")
+    except FileNotFoundError as e:
+        printf_err(f"No such file or directory in the share: {e}")
+        exit(1)
+    except (FileShareError, IOError) as e:
+        printf_err(f"Pull failed: {e}. Run the command again to resume.")
+        exit(1)
+    report_transfer("pulled", stats, time() - started)
+    runtime.save()
+    exit(0)
@@ -0,0 +1,175 @@
+# Generate layer-optimized Dockerfiles for environments
+
+import constants as C
+import json
+import os
+
+from exec import exec_cmd
+from formatting import printf
+from time import time
+
+# Resolved digests are kept for a week, after which the tag is looked up
+# again to pick up security updates to the base image
+DIGEST_TTL_SECONDS = 7 * 24 * 60 * 60
+
+def __load_digests() -> dict:
+    path = os.path.expanduser(C.IMAGE_DIGEST_CACHE)
+    try:
+        with open(path, "rt") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return {}
+
+def __save_digests(digests: dict) -> None:
+    path = os.path.expanduser(C.IMAGE_DIGEST_CACHE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(digests, f, indent=2)
+
+def pin_image(image: str, refresh: bool=False) -> str:
+    """Return image pinned by digest, e.g., python:3.9@sha256:...
+
+    Pinning makes the build inputs, and so the content hash of the image,
+    change only when the base image really changes. Images that are already
+    pinned are returned as is. If the digest can't be resolved (e.g.,
+    Docker isn't installed locally) image is returned unpinned.
+
+    Args:
+        image (str): image name
+        refresh (bool, optional): look up the digest even if it is cached
+
+    Returns:
+        str: image pinned by digest
+    """
+    if "@sha256:" in image:
+        return image
+
+    digests = __load_digests()
+    entry = digests.get(image)
+    if (not refresh and entry is not None and
+        time() - entry["resolved"] < DIGEST_TTL_SECONDS):
+        return f"{image}@{entry['digest']}"
+
+    cmd = (f"docker buildx imagetools inspect {image} "
+        "--format '{{.Manifest.Digest}}'")
+    result = exec_cmd(cmd, description=f"Resolving digest of {image}")
+    digest = result.stdout.strip()
+    if result.exit_code != 0 or not digest.startswith("sha256:"):
+        printf(f"Warning: could not resolve the digest of {image}, using "
+            "it unpinned", indent=2)
+        return image
+
+    digests[image] = { "digest": digest, "resolved": time() }
+    __save_digests(digests)
+    return f"{image}@{digest}"
+
+def generate_dockerfile(base_image: str, user_name: str,
+    requirements: bool=False, environment: bool=False,
+    conda_image: str=C.CONDA_IMAGE, cache_mounts: bool=False) -> str:
+    """Generate a multi-stage Dockerfile for an environment
+
+    Layers are ordered from least to most volatile: OS packages, the user,
+    the conda environment (environment.yml) and then pip packages
+    (requirements.txt), so that editing requirements.txt only rebuilds the
+    last layer. The conda environment is created in its own prefix,
+    /opt/ez-env, with the conda of conda_image, and pip packages are
+    installed in a build stage that has compilers. Only the installed
+    environments are copied into the runtime image, so a base image's own
+    /opt/conda isn't copied again.
+    The OS packages aren't upgraded, as that makes every build different;
+    pin base_image by digest instead.
+
+    Args:
+        base_image (str): base image, ideally pinned by digest
+        user_name (str): user that the container runs as (uid 1000)
+        requirements (bool, optional): install requirements.txt with pip
+        environment (bool, optional): create the conda environment in
+            environment.yml
+        conda_image (str, optional): image whose conda creates the
+            environment
+        cache_mounts (bool, optional): use BuildKit cache mounts for the
+            pip and conda package caches
+
+    Returns:
+        str: Dockerfile
+    """
+    lines = []
+    if cache_mounts:
+        lines.append("# syntax=docker/dockerfile:1")
+    lines += [
+        "# Generated by ez. Do not edit: put your own Dockerfile in the "
+        "build directory",
+        "# of the repo instead.",
+        f"FROM {base_image} AS base",
+        "",
+    ]
+
+    def apt_install(packages: str) -> str:
+        return ("RUN apt-get update \\\n"
+            f"    && apt-get install -y --no-install-recommends {packages} \\\n"
+            "    && rm -rf /var/lib/apt/lists/*")
+
+    def cache(target: str) -> str:
+        if not cache_mounts:
+            return ""
+        return f"--mount=type=cache,target={target} "
+
+    # Conda stage: conda and its package cache stay here, and the base
+    # image's own /opt/conda, if any, is left alone
+    if environment:
+        lines += [
+            f"FROM {conda_image} AS conda",
+            "COPY environment.yml /tmp/environment.yml",
+            f"RUN {cache('/opt/conda/pkgs')}"
+            "$(ls /opt/conda/bin/mamba 2>/dev/null "
+            "|| echo /opt/conda/bin/conda) env create -p /opt/ez-env "
+            "-f /tmp/environment.yml",
+            "",
+        ]
+
+    # Build stage: compilers and package downloads stay here
+    if requirements:
+        lines += [
+            "FROM base AS build",
+            "USER root",
+            apt_install("build-essential ca-certificates"),
+        ]
+        if environment:
+            lines.append("COPY --from=conda /opt/ez-env /opt/ez-env")
+        # The venv sees the packages of the base image (or of the conda
+        # environment), e.g., torch, so pip doesn't install them again. It
+        # uses their pip, which doesn't need python3-venv (ensurepip).
+        python = "/opt/ez-env/bin/python" if environment else "python3"
+        lines += [
+            f"RUN {python} -m venv --system-site-packages --without-pip "
+            "/opt/venv",
+            "COPY requirements.txt /tmp/requirements.txt",
+            f"RUN {cache('/root/.cache/pip')}"
+            "/opt/venv/bin/python -m pip install "
+            f"{'' if cache_mounts else '--no-cache-dir '}"
+            "-r /tmp/requirements.txt",
+            "",
+        ]
+
+    # Runtime stage
+    lines += [
+        "FROM base AS runtime",
+        "USER root",
+        apt_install("curl git vim"),
+        f"RUN useradd -r -u 1000 -m -d /home/{user_name} {user_name}",
+    ]
+    if environment:
+        lines += [
+            "COPY --from=conda /opt/ez-env /opt/ez-env",
+            "ENV PATH=\"/opt/ez-env/bin:$PATH\"",
+        ]
+    if requirements:
+        lines += [
+            "COPY --from=build --chown=1000:1000 /opt/venv /opt/venv",
+            "ENV PATH=\"/opt/venv/bin:$PATH\"",
+        ]
+    lines += [
+        f"USER {user_name}",
+        f"WORKDIR /home/{user_name}",
+    ]
+    return "\n".join(lines) + "\n"
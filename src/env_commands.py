@@ -1,23 +1,50 @@
-import click, glob, json, os, shutil, subprocess
+import click, glob, hashlib, json, os, re, shlex, shutil, subprocess
 import constants as C
+import dockerfile
 
-from azutil import (get_active_env_name, get_vm_size, launch_vscode, 
+from artifacts import (copy_if_changed, remove_if_exists, write_if_changed,
+    write_json_if_changed)
+from azutil import (deallocate_vm, get_active_env_name, get_vm_size, 
+    launch_vscode, 
     pick_vm, is_gpu, jit_activate_vm, 
     get_active_compute_name, mount_storage_account,
-    get_compute_uri)
-from exec import exec_cmd, exit_on_error
+    get_compute_uri, get_share_key, has_automount, has_data_cache)
+from data_commands import PrefetchStats, prefetch_data
+from exec import exec_cmd, exit_on_error, open_connection, ssh_args
 from ez_state import Ez, EzRuntime
 from formatting import printf, printf_err
-from typing import Any
+from images import (build_image_acr, build_image_buildkit, image_name,
+    pull_image, report_image)
+from invoke import UnexpectedExit
+from jobs import (JobStatus, container_args, follow_script, job_script,
+    new_job_id, parse_status, status_script, submit_script)
+from mount_profiles import DEFAULT_PROFILE, PROFILES
+from pipeline import Stage, run_stages, scope_results, scope_stages
+from resources import merge_run_args, probe_local, size_resources
+from scheduler import (Assignment, SchedulingError, assign, env_request,
+    load_assignments, reclaim, save_assignments)
+from size_catalog import get_vm_size_info
+from sync import SyncStats, TreeSync, format_bytes, tree_state
+from time import sleep, time
+from transfer import copy_files, plan_download, plan_upload, remote_path
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 from os import getcwd, path
+from paramiko import SSHException
 
 @click.command()
 @click.option("--name", "-n", required=True, default="",
     help=("compute node to use (default is the current active compute node)"))
+@click.option("--jobs", "-j", type=int, default=8,
+    help="Maximum number of files to copy at the same time")
+@click.option("--compress", is_flag=True, default=False,
+    help="Compress data sent over the connection")
+@click.option("--checksum/--no-checksum", default=True,
+    help="Skip files whose destination has the same contents (default)")
 @click.argument("src")
 @click.argument("dest")
 @click.pass_obj
-def cp(runtime: EzRuntime, name: str, src: str, dest: str):
+def cp(runtime: EzRuntime, name: str, jobs: int, compress: bool, 
+    checksum: bool, src: str, dest: str):
     """
 Copy local files to/from an environment.
 
@@ -31,6 +58,10 @@ foo.txt :/remote/path    Copy foo.txt to active environment /remote/path dir
 :/remote/path/foo.txt .  Copy active environment /remote/path/foo.txt locally
 ./*.txt :/remote/path    Copy local .txt files to active environment /remote/path
 :/remote/path/*.txt ./   Copy active environment /remote/path/*.txt files locally
+./data :/data            Copy the local data directory to the environment
+
+Files are copied concurrently over a single connection. Large files that
+were partially copied by an interrupted ez env cp are resumed.
     """
     ez = runtime.current()
     if ez.active_remote_compute == ".":
@@ -58,72 +89,149 @@ foo.txt :/remote/path    Copy foo.txt to active environment /remote/path dir
         printf_err("Both src and dest cannot start with ':' "
                    "to indicate remote")
         exit(1)
-    elif src.startswith(":"):
-        cmd = (f"scp -i {ez.private_key_path} {ez.user_name}@"
-               f"{ez.active_remote_compute}.{ez.region}"
-               f".cloudapp.azure.com:/home/{ez.user_name}/code/"
-               f"{ez.active_remote_env}/{src[1:]} {dest}") 
-        subprocess.run(cmd.split(' '))
-    elif dest.startswith(":"):
-        cmd = (f"scp -i {ez.private_key_path} {src} {ez.user_name}@"
-               f"{ez.active_remote_compute}.{ez.region}"
-               f".cloudapp.azure.com:/home/{ez.user_name}/code/"
-               f"{ez.active_remote_env}/{dest[1:]}") 
-        subprocess.run(cmd.split(' '))
-    else:
+    elif not src.startswith(":") and not dest.startswith(":"):
         printf_err("One of src or dest must start with ':' to "
                    "indicate remote")
         exit(1)
+
+    upload = dest.startswith(":")
+    remote_root = f"/home/{ez.user_name}/code/{ez.active_remote_env}"
+    uri = get_compute_uri(runtime, name)
+    with open_connection(uri, ez.private_key_path, compress) as c:
+        try:
+            if upload:
+                target = remote_path(remote_root, dest[1:])
+                if dest.endswith("/"):
+                    target += "/"
+                copies = plan_upload(c.sftp(), [src], target)
+            else:
+                copies = plan_download(c.sftp(), 
+                    [remote_path(remote_root, src[1:])], dest)
+        except FileNotFoundError as e:
+            printf_err(f"No such file or directory: {e}")
+            exit(1)
+
+        started = time()
+        stats = copy_files(c, copies, upload, jobs, checksum,
+            description=f"Copying {src} to {dest}")
+        elapsed = time() - started
+
+    throughput = stats.bytes_copied / elapsed if elapsed > 0 else 0
+    printf(f"copied {stats.files - stats.skipped} files "
+        f"({format_bytes(stats.bytes_copied)}) in {elapsed:.1f}s at "
+        f"{format_bytes(throughput)}/s, skipped {stats.skipped} unchanged, "
+        f"resumed {stats.resumed}")
     runtime.save()
 
+# Exit code of container_shell_script when the container isn't running
+STALE_CONTAINER = 222
+
+def container_shell_script(container_id: str) -> str:
+    """Shell script that opens a shell in container_id, or exits with
+    STALE_CONTAINER if it isn't running"""
+    container_id = shlex.quote(container_id)
+    return (f"docker inspect --format '{{{{.State.Running}}}}' "
+        f"{container_id} 2>/dev/null | grep -q true || "
+        f"exit {STALE_CONTAINER}; "
+        f"exec docker exec -it -w /workspace {container_id} /bin/bash")
+
+# Label of the containers of environments, whose value is the env name
+ENV_LABEL = "ez.env"
+
+# docker ps format for find_env_containers
+DOCKER_PS_FORMAT = ("{{.ID}},{{.Image}},{{.Names}},"
+    f"{{{{.Label \"{ENV_LABEL}\"}}}}")
+
+def find_env_containers(docker_ps: str, 
+    env_name: str) -> List[Tuple[str, str, str]]:
+    """Return the (id, image, name) of the containers in the output of 
+    docker ps --format DOCKER_PS_FORMAT that run env_name. Containers are
+    matched by their ENV_LABEL, or by image and container name if they were
+    started before environments were labeled."""
+    labeled, unlabeled = [], []
+    for line in docker_ps.splitlines():
+        fields = line.strip().split(",")
+        if len(fields) == 3:
+            fields.append("")
+        if len(fields) != 4:
+            continue
+        if fields[3] == env_name:
+            labeled.append(tuple(fields[:3]))
+        elif fields[3] == "" and (env_name in fields[1] or 
+            env_name in fields[2]):
+            unlabeled.append(tuple(fields[:3]))
+    return labeled if len(labeled) > 0 else unlabeled
+
 @click.command()
 @click.option("--name", "-n", default="", help="Name of target compute")
 @click.option("--env-name", "-e", default="", 
     help="Environment name to start")
 @click.pass_obj
 def ssh(runtime: EzRuntime, name: str, env_name: str):
-    """SSH to an environment"""
+    """SSH to an environment
+
+    The id of the environment's container is cached and checked with docker
+    inspect when the shell is opened, so that an SSH to a running
+    environment takes a single round trip.
+    """
     ez = runtime.current()
     name = get_active_compute_name(runtime, name)
     env_name = get_active_env_name(runtime, env_name)
 
     if name != ".":
-        # Run docker ps on the remote VM to figure out what the container id
-        # of the running VS Code container is
-        cmd = (f"ssh -i {ez.private_key_path} {ez.user_name}@{name}."
-            f"{ez.region}.cloudapp.azure.com docker ps --format "
-            "{{.Image}},{{.ID}}")
+        # All ssh commands share one multiplexed connection to the compute
+        uri = get_compute_uri(runtime, name)
+        prefix = ssh_args(uri, ez.private_key_path)
+        shell_prefix = ssh_args(uri, ez.private_key_path, tty=True)
+        host = f"{name}.{ez.region}.cloudapp.azure.com"
     else:
-        # Run a local docker ps command to get the container id
-        cmd = "docker ps --format {{.Image}},{{.ID}}"
-    
-    result = exec_cmd(cmd)
-    exit_on_error(result)
-    containers = result.stdout.strip().split("\n")
-    vsc_containers = [c for c in containers if env_name in c]
-    if len(vsc_containers) != 1:
-        printf_err(f">1 container running with same env_name:")
+        prefix = shell_prefix = ["bash", "-c"]
+        host = "localhost"
+
+    containers = ez.computes.setdefault(name, {}).setdefault(
+        "containers", {})
+    container_id = containers.get(env_name)
+    if container_id is not None:
+        printf(f"opened SSH connection to container {container_id} on "
+            f"{host}")
+        result = subprocess.run(shell_prefix + 
+            [container_shell_script(container_id)])
+        if result.returncode != STALE_CONTAINER:
+            ez.active_remote_compute = name 
+            ez.active_remote_env = env_name
+            runtime.save()
+            exit(result.returncode)
+        del containers[env_name]
+
+    result = subprocess.run(prefix + 
+        [f"docker ps --format '{DOCKER_PS_FORMAT}'"],
+        capture_output=True, text=True)
+    if result.returncode != 0:
+        printf_err(result.stderr.strip())
+        exit(result.returncode)
+    env_containers = find_env_containers(result.stdout, env_name)
+    if len(env_containers) == 0:
+        printf_err(f"No running container for environment {env_name} on "
+            f"{host}. Start it with ez env go")
+        exit(1)
+    elif len(env_containers) > 1:
+        printf_err(f"{len(env_containers)} containers are running for "
+            f"environment {env_name} on {host}: "
+            f"{', '.join(c[2] for c in env_containers)}")
         exit(1)
 
-    image_name, container_id = vsc_containers[0].split(",")
-    if name != ".":
-        # Open a tunneled SSH connection into the running remote container
-        cmd = (f"ssh -tt -i {ez.private_key_path} "
-            f"{ez.user_name}@{name}.{ez.region}.cloudapp.azure.com "
-            f"docker exec -it -w /workspace {container_id} /bin/bash")
-        printf(f"opened SSH connection to container {container_id} running "
-            f"using image {image_name} on "
-            f"{name}.{ez.region}.cloudapp.azure.com")
-    else:
-        # Handle the local case
-        cmd = f"docker exec -it -w /workspace {container_id} /bin/bash"
-        printf(f"opened SSH connection to container {container_id} running "
-               f"using image {image_name} on localhost")
-    subprocess.run(cmd.split(' '))
+    container_id, image_name, _ = env_containers[0]
+    containers[env_name] = container_id
     ez.active_remote_compute = name 
     ez.active_remote_env = env_name
     runtime.save()
 
+    printf(f"opened SSH connection to container {container_id} running "
+        f"using image {image_name} on {host}")
+    result = subprocess.run(shell_prefix + 
+        [container_shell_script(container_id)])
+    exit(result.returncode)
+
 @click.command()
 @click.option("--name", "-n", required=True, default="",
     help="Compute name to migrate the environment to")
@@ -131,8 +239,16 @@ def ssh(runtime: EzRuntime, name: str, env_name: str):
     help="Environment name to start")
 @click.option("--mount", default="none",
     help="Mount {local|azure|none} drive to /data default none")
+@click.option("--clone-depth", type=int, default=0,
+    help="Shallow clone the repo on the compute with this many commits")
+@click.option("--partial-clone", is_flag=True, default=False,
+    help="Clone the repo on the compute without file contents, which are "
+    "fetched on demand")
+@click.option("--no-git-cache", is_flag=True, default=False,
+    help="Don't use the git object cache on the compute when cloning")
 @click.pass_obj
-def up(runtime: EzRuntime, name: str, env_name: str, mount: str):
+def up(runtime: EzRuntime, name: str, env_name: str, mount: str, 
+    clone_depth: int, partial_clone: bool, no_git_cache: bool):
     """Migrate the current environment to a new compute node"""
 
     ez = runtime.current()
@@ -158,32 +274,18 @@ def up(runtime: EzRuntime, name: str, env_name: str, mount: str):
     jit_activate_vm(runtime, name)
     ez.active_remote_compute = name
 
-    # Check to see if there are uncommitted changes
-    patch_file = None
-    result = exec_cmd('git status | grep "Changes not staged for commit"')
-    if result.exit_code == 0:
-        result = exec_cmd("git stash")
-        exit_on_error(result)
-        result = exec_cmd("git stash show -p --binary > ~/tmp/changes.patch",
-            description="Stashing uncommitted changes")
-        exit_on_error(result)
-
-        scp_cmd = (
-            f"scp -i {ez.private_key_path} "
-            f"~/tmp/changes.patch "
-            f"{ez.user_name}@{name}.{ez.region}.cloudapp.azure.com:"
-            f"/home/{ez.user_name}/changes.patch"
-        )
-        result = exec_cmd(scp_cmd, 
-            description=f"Copying changes to {name}")
-        exit_on_error(result)
-        patch_file = "changes.patch"
+    # Uncommitted and untracked changes in the working tree are synced to
+    # the compute after the repo is cloned there
+    result = exec_cmd("git rev-parse --show-toplevel")
+    exit_on_error(result)
+    local_root = result.stdout
 
     env_name = git_remote_uri.split("/")[-1]
 
     if mount == "azure" or mount == "local" or mount == "none":
         __go(runtime, ez, git_remote_uri, name, env_name, mount=mount, 
-            patch_file=patch_file)
+            sync_path=local_root, clone_depth=clone_depth, 
+            partial_clone=partial_clone, git_cache=not no_git_cache)
     else:
         printf_err("--mount must be azure|local|none")
 
@@ -192,6 +294,114 @@ def up(runtime: EzRuntime, name: str, env_name: str, mount: str):
     runtime.save()
     exit(0)
 
+@click.command()
+@click.option("--name", "-n", default="", help="Name of target compute")
+@click.option("--env-name", "-e", default="",
+    help="Environment to sync with (default is the active environment)")
+@click.option("--watch", is_flag=True, default=False,
+    help="Keep syncing as files change until interrupted")
+@click.option("--pull", "pull_dirs", multiple=True,
+    help=("Output directory to copy back from the environment, e.g., "
+          "checkpoints. Can be repeated, in addition to sync_outputs in "
+          "ez.json"))
+@click.option("--interval", type=float, default=0.5,
+    help="Seconds between checks for local changes with --watch")
+@click.option("--debounce", type=float, default=0.3,
+    help="Seconds without further changes before pushing a batch")
+@click.option("--pull-interval", type=float, default=2.0,
+    help="Seconds between pulls of the output directories with --watch")
+@click.pass_obj
+def sync(runtime: EzRuntime, name: str, env_name: str, watch: bool, 
+    pull_dirs: Tuple[str], interval: float, debounce: float, 
+    pull_interval: float):
+    """Sync the current repo with an environment
+
+    Pushes new and changed files in the working tree to the environment and
+    pulls new and changed files in the output directories back. Output
+    directories are listed in the sync_outputs array in ez.json or passed
+    with --pull.
+    """
+    ez = runtime.current()
+    name = get_active_compute_name(runtime, name)
+    env_name = get_active_env_name(runtime, env_name)
+    if name == ".":
+        printf_err("Not needed for locally running environments")
+        exit(1)
+
+    result = exec_cmd("git rev-parse --show-toplevel")
+    exit_on_error(result)
+    local_root = result.stdout
+
+    outputs = list(pull_dirs)
+    ez_json_path = f"{local_root}/ez.json"
+    if path.exists(ez_json_path):
+        with open(ez_json_path, "r") as f:
+            outputs += json.load(f).get("sync_outputs", [])
+
+    remote_env_path = f"/home/{ez.user_name}/code/{env_name}"
+    uri = get_compute_uri(runtime, name)
+    with open_connection(uri, ez.private_key_path, compress=True) as c:
+        tree_sync = TreeSync(c, local_root, remote_env_path, outputs)
+
+        def push():
+            started = time()
+            stats = tree_sync.push()
+            if stats.changed > 0 or stats.deleted > 0 or not watch:
+                printf(f"pushed {stats.changed} changed and {stats.deleted} "
+                    f"deleted files ({format_bytes(stats.bytes_sent)}) in "
+                    f"{time() - started:.2f}s")
+
+        def pull():
+            started = time()
+            stats = tree_sync.pull()
+            if stats.changed > 0 or (not watch and len(outputs) > 0):
+                printf(f"pulled {stats.changed} changed files "
+                    f"({format_bytes(stats.bytes_sent)}) from "
+                    f"{', '.join(outputs)} in {time() - started:.2f}s")
+
+        def attempt(transfer: Callable[[], None]) -> bool:
+            # A failed transfer, e.g., when the network drops, doesn't stop
+            # the watcher. The connection and the remote manifest are set
+            # up again on the next attempt.
+            try:
+                transfer()
+                return True
+            except (IOError, ValueError, SSHException, UnexpectedExit) as e:
+                printf_err(f"sync failed, retrying: {e}")
+                tree_sync.reset()
+                c.close()
+                return False
+
+        state = tree_state(local_root, tree_sync.outputs)
+        push()
+        pull()
+        if not watch:
+            exit(0)
+
+        printf(f"watching {local_root} for changes, press Ctrl+C to stop")
+        last_pull = time()
+        try:
+            while True:
+                sleep(interval)
+                current = tree_state(local_root, tree_sync.outputs)
+                if current != state:
+                    # Wait for a burst of changes, e.g., a save all or a
+                    # git checkout, to finish before pushing them together
+                    while True:
+                        sleep(debounce)
+                        state = current
+                        current = tree_state(local_root, tree_sync.outputs)
+                        if current == state:
+                            break
+                    if not attempt(push):
+                        # Push the changes again on the next cycle
+                        state = None
+                if time() - last_pull >= pull_interval:
+                    attempt(pull)
+                    last_pull = time()
+        except KeyboardInterrupt:
+            printf("stopped watching")
+
 def clone_git_repo(git_uri: str, env_name: str) -> str:
     """Clone git repo to env_name returning the path to the repo"""
     # env_name will be used for local name of repository and is the path
@@ -238,7 +448,10 @@ def read_repo_config(local_env_path: str) -> Any:
     
     return ez_json
 
-def generate_dockerfile(ez: Ez, local_env_path: str, ez_json: Any):
+def generate_dockerfile(ez: Ez, local_env_path: str, ez_json: Any,
+    cache_mounts: bool=False, refresh: bool=False) -> bool:
+    """Generate the .devcontainer directory, returning True if any file in
+    it changed"""
     devcontainer_dir = f"{local_env_path}/.devcontainer"
     if not os.path.exists(devcontainer_dir):
         os.mkdir(devcontainer_dir)
@@ -258,182 +471,226 @@ def generate_dockerfile(ez: Ez, local_env_path: str, ez_json: Any):
     # clone the project locally as well.
 
     # Copy files from the /build directory into the .devcontainer directory
+    changed = False
     build_files = glob.glob(f"{local_env_path}/build/*")
     for file in build_files:
         if os.path.isfile(file):
-            shutil.copy(file, devcontainer_dir)
+            changed |= copy_if_changed(file, devcontainer_dir)
 
     # Only generate a default Dockerfile if the user doesn't supply one in
     # their /build directory
     if not os.path.exists(f"{local_env_path}/build/Dockerfile"):
         # Need to generate build steps for cases where we have
         # requirements.txt or an environment.yml file in the /build directory
-        if os.path.exists(f"{devcontainer_dir}/requirements.txt"):
-            pip_install = """
-COPY requirements.txt .
-RUN pip install -v -r requirements.txt
-"""
-        else:
-            pip_install = ""
-
-        # The challenge here for both conda and pip is detecting whether the
-        # base image contains Python or not or whether we should always
-        # install Python onto the image.
-        if os.path.exists(f"{devcontainer_dir}/environment.yml"):
-            conda_install = f"""
-COPY environment.yml .
-RUN curl --remote-name {C.MINICONDA_INSTALLER} \\
-    && chmod +x Miniconda3-latest-Linux-x86_64.sh \\
-    && ./Miniconda3-latest-Linux-x86_64.sh -b 
-ENV PATH="/home/{ez.user_name}/miniconda3/bin:$PATH"
-
-RUN conda install -y mamba -n base -c conda-forge && \\
-    mamba env create -f environment.yml
-"""
-        else:
-            conda_install = ""
-
-        dockerfile = f"""
-FROM {ez_json["base_container_image"]}
-
-USER root
-RUN apt update \\
-    && apt upgrade -y \\
-    && apt install -y curl build-essential git vim
-
-RUN useradd -r -u 1000 -m -d /home/{ez.user_name} {ez.user_name}
-USER {ez.user_name}
-WORKDIR /home/{ez.user_name}
-
-{pip_install}
-{conda_install}
-    """
+        environment = os.path.exists(f"{devcontainer_dir}/environment.yml")
+        conda_image = C.CONDA_IMAGE
+        if environment:
+            conda_image = dockerfile.pin_image(conda_image, refresh)
+        text = dockerfile.generate_dockerfile(
+            dockerfile.pin_image(ez_json["base_container_image"], refresh),
+            ez.user_name,
+            requirements=os.path.exists(
+                f"{devcontainer_dir}/requirements.txt"),
+            environment=environment,
+            conda_image=conda_image,
+            cache_mounts=cache_mounts)
         dockerfile_path = f"{devcontainer_dir}/Dockerfile"
-        with open(dockerfile_path, "w", encoding="utf-8") as f:
-            f.write(dockerfile)
+        changed |= write_if_changed(dockerfile_path, text)
+    return changed
 
-def build_container(ez: Ez, local_env_path: str, env_name: str, 
-    compute_name: str, use_acr: bool):
-    """Build container only if using ACR or running locally in WSL2
+def build_container(runtime: EzRuntime, ez: Ez, local_env_path: str, 
+    image: str, compute_name: str, use_acr: bool, force: bool=False,
+    buildkit: str=None):
+    """Build container if using ACR or BuildKit. Otherwise VS Code builds
+    the container from the Dockerfile.
+
+    Images are tagged with a hash of the build context, so the image is only
+    built if the Dockerfile or the files it copies have changed, and envs
+    with identical build inputs share the image.
 
     Args:
-        ez (Ez): [description]
-        local_env_path (str): [description]
-        env_name (str): [description]
-        use_acr (bool): [description]
+        ez (Ez): workspace
+        local_env_path (str): path of the local clone of the repo
+        image (str): content-addressed name of the image
+        compute_name (str): compute that the env will run on
+        use_acr (bool): push the image to ACR, building it using ACR Tasks
+            unless buildkit is set
+        force (bool, optional): build even if the image exists
+        buildkit (str, optional): build with BuildKit on the local machine
+            ("local") or on compute_name ("compute")
     """
 
     devcontainer_dir = f"{local_env_path}/.devcontainer"
 
-    # Build the image using an ACR task if the --use-acr flag was set
-    if use_acr:
-        full_registry_name = (f"{ez.registry_name}.azurecr.io/"
-                              f"{ez.workspace_name}:{env_name}")
-        cmd = f"docker manifest inspect {full_registry_name}"
-        result = exec_cmd(cmd, 
-            description=f"checking if {full_registry_name} exists")
-
-        # Returns 0 if image already exists, 1 if it does not
-        if result.exit_code == 0:
-            printf(f"Skipping build, {full_registry_name} exists already")
-        else:
-            cmd = (f"az acr build --registry {ez.registry_name} "
-                f"--image {ez.workspace_name}:{env_name} .")
-            result = exec_cmd(cmd, 
-                description="Building container image using ACR Tasks", 
-                cwd=devcontainer_dir)
-            exit_on_error(result)
+    if buildkit is not None:
+        uri = None
+        if buildkit == "compute" and compute_name != ".":
+            uri = get_compute_uri(runtime, compute_name)
+        build_image_buildkit(ez, devcontainer_dir, image, uri, use_acr,
+            force)
+        report_image(ez, image, uri, use_acr)
+    elif use_acr:
+        # Build the image using an ACR task if the --use-acr flag was set
+        build_image_acr(ez, devcontainer_dir, image, force)
+        report_image(ez, image, pushed=True)
     
     # TODO: implement local docker build and generation of a WSL2 .vhdx
     # check compute_name as parameter
 
-def clone_remote_repo(runtime: EzRuntime, ez: Ez, git_uri: str, compute_name: str, 
-    env_name: str, patch_file: str):
+def git_cache_remote(git_uri: str) -> Tuple[str, str]:
+    """Return the name of the object cache repo for git_uri and the name of
+    the git_uri remote within it
+
+    Forks of a repo usually keep the repo name, so the cache is keyed by
+    repo name and each fork is a remote of the cache repo. This lets forks
+    and branches share objects.
+    """
+    repo_name = git_uri.rstrip("/").split("/")[-1].split(":")[-1]
+    if repo_name.endswith(".git"):
+        repo_name = repo_name[:-4]
+    repo_name = re.sub(r"[^A-Za-z0-9._-]", "_", repo_name)
+    remote_name = hashlib.sha1(git_uri.encode("utf-8")).hexdigest()[:12]
+    return f"{repo_name}.git", f"ez-{remote_name}"
+
+def remote_repo_script(git_uri: str, remote_env_path: str, 
+    depth: int=0, partial: bool=False, cache_dir: str=None) -> str:
+    """Generate a shell script that clones or updates git_uri at 
+    remote_env_path
+
+    Args:
+        git_uri (str): URI of the git repo
+        remote_env_path (str): path of the repo on the compute
+        depth (int, optional): shallow clone/pull depth, 0 for full history
+        partial (bool, optional): partial clone that fetches file contents
+            on demand (--filter=blob:none)
+        cache_dir (str, optional): directory of the git object caches on 
+            the compute. Not used for shallow or partial clones.
 
-    # Check to see if the remote compute has the GPU capability if needed
-    # and fail if it doesn't.
+    Returns:
+        str: shell script
+    """
+    path = shlex.quote(remote_env_path)
+    script = "set -e\n"
+    clone_options = ""
+
+    # Refresh the bare object cache for the repo incrementally and clone
+    # using it as an alternate object store, so only objects that are not in
+    # the cache come over the network. The cache never prunes objects as
+    # clones that borrow from it may still need them. Clones of the repo
+    # that run at the same time, e.g., for the computes of a sweep, set up
+    # and fetch the cache one at a time, holding a lock next to it.
+    if cache_dir is not None and depth == 0 and not partial:
+        cache_name, remote_name = git_cache_remote(git_uri)
+        cache = shlex.quote(f"{cache_dir}/{cache_name}")
+        lock = shlex.quote(f"{cache_dir}/{cache_name}.lock")
+        script += f"""mkdir -p {shlex.quote(cache_dir)}
+(
+    flock 9
+    if [ ! -d {cache} ]; then
+        git init -q --bare {cache}
+        git -C {cache} config gc.pruneExpire never
+    fi
+    git -C {cache} remote get-url {remote_name} > /dev/null 2>&1 || \\
+        git -C {cache} remote add {remote_name} {shlex.quote(git_uri)}
+    git -C {cache} fetch -q {remote_name}
+) 9> {lock}
+"""
+        clone_options += f" --reference-if-able {cache}"
+
+    if partial:
+        clone_options += " --filter=blob:none"
+    if depth > 0:
+        # Shallow histories can't be fast-forwarded, so move the checkout to
+        # the fetched commit, keeping any uncommitted changes
+        clone_options += f" --depth {depth}"
+        update = (f"git -C {path} fetch -q --depth {depth} && "
+            f"git -C {path} reset -q --keep @{{u}}")
+    else:
+        update = f"git -C {path} pull -q --ff-only"
+
+    # A failed update, e.g., because of conflicting changes in the remote
+    # repo, leaves the existing checkout in place
+    script += f"""if [ -d {path}/.git ]; then
+    {update} || \\
+        echo "git update failed, using existing checkout" >&2
+else
+    git clone{clone_options} {shlex.quote(git_uri)} {path}
+fi
+"""
+    return script
+
+def clone_remote_repo(runtime: EzRuntime, ez: Ez, git_uri: str, 
+    compute_name: str, env_name: str, depth: int=0, partial: bool=False, 
+    use_cache: bool=True):
+    """Clone or update git_uri on compute_name using a single remote 
+    command"""
 
     # TODO: Start the remote compute if necessary. Wait for it to complete
     # starting
     remote_env_path = f"/home/{ez.user_name}/code/{env_name}"
+    cache_dir = None
+    if use_cache:
+        cache_dir = f"/home/{ez.user_name}/{C.GIT_CACHE_DIR}"
 
-    # TODO: I don't like the design of the multiple commands - there
-    # should be just a single command that conditionally runs expressions
-    # on the remote machine. Keeping this for now in this mechanical
-    # refactoring
-
-    # In the remote case, it needs to conditionally clone the git repo
-    # onto the remote VM. If the repo was already cloned on the VM, then
-    # we need to cd into the dir and git pull that repo. Otherwise just do
-    # the clone. We ignore the return codes here as the commands will
-    # pass through the result of the conditional test which isn't 
-    # actually indicating an error, just whether the conditional was
-    # successful or not (and given the logic one of them MUST be 
-    # unsuccessful).
-    description = (f"clone/update {git_uri} on {compute_name} "
-                    f"at {remote_env_path}")
-    remote_pull_cmd = (f"[ -d '{remote_env_path}' ] && "
-                        f"cd {remote_env_path} && git pull")
-    result = exec_cmd(remote_pull_cmd, 
+    script = remote_repo_script(git_uri, remote_env_path, depth, 
+        partial, cache_dir)
+    result = exec_cmd(script, 
         uri=get_compute_uri(runtime, compute_name),
         private_key_path=ez.private_key_path,
-        description=description)
-
-    remote_clone_cmd = (f"[ ! -d '{remote_env_path}' ] && "
-                        f"git clone {git_uri} {remote_env_path}")
-    result = exec_cmd(remote_clone_cmd, 
-        uri=get_compute_uri(runtime, compute_name),
-        private_key_path=ez.private_key_path,
-        description=description)
-
-    # If a patch_file parameter is passed, then we need to apply the git
-    # patch file that was copied onto the server. 
-    if patch_file is not None:
-        cmd = (f"pushd {remote_env_path} && git apply "
-            f"/home/{ez.user_name}/{patch_file} && popd")
-        result = exec_cmd(cmd, uri=get_compute_uri(runtime, compute_name), 
-            private_key_path=ez.private_key_path, 
-            description=f"Applying patch file: {patch_file}")
-
-def write_settings_json(ez: Ez, compute_name: str, local_env_path: str):
-    if compute_name != ".":
-        # The .vscode directory contains a dynamically generated settings.json
-        # file which points to the VM that the remote container will run on.
+        description=(f"clone/update {git_uri} on {compute_name} "
+                     f"at {remote_env_path}"))
+    exit_on_error(result)
 
-        # If it is a remote launch, we will need to generate the information
-        # needed for the local devcontainer.json file, as well as for the
-        # settings.json file that contains the .vscode/settings.json file that
-        # contains "docker.host":
-        # "ssh://user@machine.region.cloudapp.azure.com"
+def sync_working_tree(runtime: EzRuntime, ez: Ez, compute_name: str, 
+    env_name: str, local_root: str) -> SyncStats:
+    """Sync the working tree at local_root, including uncommitted and
+    untracked files, to the env_name repo on compute_name"""
+    remote_env_path = f"/home/{ez.user_name}/code/{env_name}"
+    uri = get_compute_uri(runtime, compute_name)
+    with open_connection(uri, ez.private_key_path, compress=True) as c:
+        stats = TreeSync(c, local_root, remote_env_path).push()
+    printf(f"synced {stats.changed} changed and {stats.deleted} deleted "
+        f"files, sent {format_bytes(stats.bytes_sent)} of "
+        f"{format_bytes(stats.bytes_total)}", indent=2)
+    return stats
+
+def write_settings_json(ez: Ez, compute_name: str, 
+    local_env_path: str) -> bool:
+    """Point .vscode/settings.json at the Docker host of compute_name,
+    returning True if the file changed"""
+    # The .vscode directory contains a dynamically generated settings.json
+    # file which points to the VM that the remote container will run on,
+    # e.g., "docker.host": "ssh://user@machine.region.cloudapp.azure.com".
+    # Other settings in an existing settings.json are kept.
+    settings_json_path = f"{local_env_path}/.vscode/settings.json"
+    settings = {}
+    if os.path.exists(settings_json_path):
+        try:
+            with open(settings_json_path, "r", encoding="utf-8") as f:
+                settings = json.load(f)
+        except json.decoder.JSONDecodeError:
+            # e.g., comments, which VS Code allows. Replace the file as
+            # earlier versions of ez did.
+            settings = {}
 
-        # printf("Generating .vscode/settings.json")
+    if compute_name != ".":
         ssh_connection = (f"{ez.user_name}@{compute_name}.{ez.region}"
             ".cloudapp.azure.com")
-        settings_json = f"""
-    {{
-    "docker.host": "ssh://{ssh_connection}",
-    }}
-    """
-        vscode_dir = f"{local_env_path}/.vscode"
-        settings_json_path = f"{vscode_dir}/settings.json"
-        if not os.path.exists(vscode_dir):
-            os.mkdir(vscode_dir)
-        with open(settings_json_path, "w", encoding="utf-8") as f:
-            f.write(settings_json)
+        settings["docker.host"] = f"ssh://{ssh_connection}"
     else:
-        # local contrainer execution, so we need to generate a null 
-        # .vscode/settings.json file (or delete existing file if there)
+        # Local container execution uses the local Docker host
+        settings.pop("docker.host", None)
+        if len(settings) == 0:
+            return remove_if_exists(settings_json_path)
+    return write_json_if_changed(settings_json_path, settings)
 
-        # TODO: what really needs to be done is to remove an existing 
-        # docker.host key from an existing settings.json file if it is there
-        vscode_dir = f"{local_env_path}/.vscode"
-        if os.path.exists(vscode_dir):
-            if os.path.exists(f"{vscode_dir}/settings.json"):
-                os.remove(f"{vscode_dir}/settings.json")
-
-def write_devcontainer_json(runtime: EzRuntime, ez: Ez, compute_name: str, 
+def devcontainer_config(runtime: EzRuntime, ez: Ez, compute_name: str, 
     env_name: str, local_env_path: str, ez_json: Any, use_acr: bool, 
-    mount: str):
+    mount: str, vm_size: str=None, image: str=None, 
+    assignment: Optional[Assignment]=None, label: str=None) -> Any:
+    """Return the devcontainer.json configuration of the environment's
+    container. assignment is the share of the compute that the container
+    runs on, and label (env_name by default) identifies the container."""
 
     # Generate the devcontainer.json file. Much of this will eventually be
     # parameterized
@@ -476,13 +733,14 @@ def write_devcontainer_json(runtime: EzRuntime, ez: Ez, compute_name: str,
             printf_err(f"Resource group {ez.resource_group} "
                 "does not have an Azure Container Registry configured.")
             exit(1)
-        docker_source=f"""
-    "image": "{ez.registry_name}.azurecr.io/{ez.workspace_name}:{env_name}",
-""".strip()
+        if image is None:
+            image = image_name(ez, f"{local_env_path}/.devcontainer")
+        docker_source = { "image": f"{ez.registry_name}.azurecr.io/{image}" }
+    elif image is not None:
+        # Built with BuildKit on the compute that the container runs on
+        docker_source = { "image": image }
     else:
-        docker_source=f"""
-    "dockerFile": "./Dockerfile",
-""".strip()
+        docker_source = { "dockerFile": "./Dockerfile" }
 
     requires_gpu = ez_json["requires_gpu"]
 
@@ -492,34 +750,39 @@ def write_devcontainer_json(runtime: EzRuntime, ez: Ez, compute_name: str,
         returncode = os.system(f"which nvidia-smi > /dev/null")
         compute_has_gpu = returncode == 0
     else:
-        vm_size = get_vm_size(runtime, compute_name)
+        if vm_size is None:
+            vm_size = get_vm_size(runtime, compute_name)
         compute_has_gpu = is_gpu(vm_size)
-
-    if "run_args" in ez_json:
-        runargs = ",".join(ez_json["run_args"])
+        size_info = get_vm_size_info(runtime, vm_size)
 
     if requires_gpu and not compute_has_gpu:
         printf(f"Warning: repo requires a GPU and {compute_name} "
             "does not have one", indent=2)
-    if requires_gpu and compute_has_gpu:
-        # TODO: figure out how to right-size the --shm-size parameter
-        # perhaps this means that we must let the user specify and default
-        # to a reasonable value? What is clear is that --ipc=host is not a 
-        # good idea as that requires the container to be run as root!
-
-        # TODO: If ez.json has a run_args parameter, use it
-        if "run_args" in ez_json:
-            runargs = ",".join(f"\"{x}\"" for x in ez_json["run_args"])
-        else:
-            runargs = """
-            "--gpus=all",
-            "--shm-size=1g",
-    """.strip()
+    # run_args in ez.json replace the default arguments
+    if "run_args" in ez_json:
+        runargs = list(ez_json["run_args"])
+    elif requires_gpu and compute_has_gpu and assignment is None:
+        runargs = ["--gpus=all"]
     else:
-        if "run_args" in ez_json:
-            runargs = ",".join(f"\"{x}\"" for x in ez_json["run_args"])
-        else:
-            runargs = ""
+        runargs = []
+
+    # Size /dev/shm, CPU and memory limits and ulimits from the cores, RAM
+    # and GPUs of the compute (or of the share of it assigned to the 
+    # environment), unless ez.json sets them in resources or run_args. 
+    # --ipc=host isn't used as it requires running as root.
+    if assignment is not None:
+        runargs = merge_run_args(runargs, assignment.run_args())
+        resources = size_resources(assignment.size(vm_size), 
+            ez_json.get("resources"), reserve_host=False)
+        printf(f"assigned {assignment.describe()} of {compute_name}", 
+            indent=2)
+    else:
+        compute_info = probe_local() if compute_name == "." else size_info
+        resources = size_resources(compute_info, ez_json.get("resources"))
+    runargs = merge_run_args(runargs, resources.run_args())
+    runargs = merge_run_args(runargs, 
+        [f"--label={ENV_LABEL}={label or env_name}"])
+    printf(f"container resources: {resources.describe()}", indent=2)
 
     if compute_name == ".":
         # TODO: should this be interactive user?
@@ -534,8 +797,8 @@ def write_devcontainer_json(runtime: EzRuntime, ez: Ez, compute_name: str,
         ssh_dir = f"/home/{ez.user_name}/.ssh"
     
     ssh_target = f"/home/{container_user}/.ssh"
-    ssh_mount = (f"\"source={ssh_dir},target={ssh_target},"
-        f"type=bind,consistency=cached,readonly\",")
+    mounts = [f"source={ssh_dir},target={ssh_target},"
+        "type=bind,consistency=cached,readonly"]
 
     # Valid combinations
     # Compute   local    azure         none
@@ -543,55 +806,113 @@ def write_devcontainer_json(runtime: EzRuntime, ez: Ez, compute_name: str,
     # Remote    ~/data   mount ~/data   x
     # Special case is if ez.file_share_name is None maps to none
 
-    data_mount = ""
     if ez.file_share_name is not None:
         if mount == "local" or mount == "azure":
             if compute_name == ".":
                 data_dir = os.path.expanduser("~/data")
             else:
                 data_dir = f"/home/{ez.user_name}/data"
-            data_mount = (f"\"source={data_dir},target=/data,type=bind,"
-                f"consistency=cached\",")
-
-    mounts = f"""
-    "mounts": [
-        {ssh_mount}
-        {data_mount}
-    ],
-""".strip()
-
-    workspace_mount = (f"\"source={mount_path},target=/workspace,type=bind,"
-        "consistency=cached\"")
-    devcontainer_json = f"""
-{{
-    {docker_source}
-    "containerUser": "{container_user}",
-    "workspaceFolder": "/workspace",
-    "workspaceMount": {workspace_mount},
-    {mounts}
-    "extensions": [
-        "ms-python.python",
-        "ms-python.vscode-pylance"
-    ],
-    "runArgs": [
-        {runargs}
-    ],
-}}
-"""
+            mounts.append(f"source={data_dir},target=/data,type=bind,"
+                "consistency=cached")
+
+    # Provisioning puts a scratch directory on the local temp or NVMe disk
+    # of VMs that have one, which is much faster than the OS disk
+    if compute_name != "." and size_info.has_local_disk:
+        mounts.append(f"source={C.SCRATCH_DIR},target=/scratch,type=bind")
+
+    devcontainer_json = {
+        **docker_source,
+        "containerUser": container_user,
+        "workspaceFolder": "/workspace",
+        "workspaceMount": (f"source={mount_path},target=/workspace,"
+            "type=bind,consistency=cached"),
+        "mounts": mounts,
+        "extensions": [
+            "ms-python.python",
+            "ms-python.vscode-pylance"
+        ],
+        "runArgs": runargs,
+    }
+    return devcontainer_json
+
+def write_devcontainer_json(runtime: EzRuntime, ez: Ez, compute_name: str, 
+    env_name: str, local_env_path: str, ez_json: Any, use_acr: bool, 
+    mount: str, vm_size: str=None, image: str=None, 
+    assignment: Optional[Assignment]=None) -> bool:
+    """Write .devcontainer/devcontainer.json, returning True if it changed"""
+    devcontainer_json = devcontainer_config(runtime, ez, compute_name, 
+        env_name, local_env_path, ez_json, use_acr, mount, vm_size, image,
+        assignment)
     devcontainer_json_path = f"{local_env_path}/.devcontainer/devcontainer.json"
-    with open(devcontainer_json_path, "w", encoding="utf-8") as f:
-        f.write(devcontainer_json)
+    return write_json_if_changed(devcontainer_json_path, devcontainer_json)
+
+def running_envs(runtime: EzRuntime, ez: Ez, compute_name: str) -> Set[str]:
+    """Names of the environments with a running container on compute_name,
+    and of the job slots that queued or running jobs may use"""
+    result = exec_cmd(f"docker ps --filter label={ENV_LABEL} "
+        f"--format '{{{{.Label \"{ENV_LABEL}\"}}}}' && "
+        f"{{ cat ~/{C.JOBS_DIR}/*/reserved 2>/dev/null; true; }}", 
+        get_compute_uri(runtime, compute_name), ez.private_key_path)
+    exit_on_error(result)
+    return set(result.stdout.split())
+
+def schedule_envs(runtime: EzRuntime, ez: Ez, compute_name: str, 
+    env_names: List[str], ez_json: Any, 
+    vm_size: str) -> List[Optional[Assignment]]:
+    """Assign GPUs, cores and memory of compute_name to each of env_names,
+    after reclaiming the assignments of environments that are no longer 
+    running, and record the assignments in ez state"""
+    info = get_vm_size_info(runtime, vm_size)
+    if not info.is_known:
+        return [None] * len(env_names)
+    compute = ez.computes.setdefault(compute_name, {})
+    assignments = load_assignments(compute)
+    stale = reclaim(assignments, running_envs(runtime, ez, compute_name), 
+        set(env_names))
+    if len(stale) > 0:
+        printf(f"reclaimed resources of stopped envs {', '.join(stale)}", 
+            indent=2)
+    gpus, cpus = env_request(info, ez_json)
+    try:
+        for i, env_name in enumerate(env_names):
+            assignments[env_name] = assign(info, assignments, env_name, gpus,
+                cpus, envs=len(env_names) - i)
+    except SchedulingError as e:
+        printf_err(f"{e}. Stop another environment on {compute_name} or "
+            "lower the resources in ez.json")
+        exit(1)
+    save_assignments(compute, assignments)
+    return [assignments[env_name] for env_name in env_names]
 
 def mount_data_drive(runtime: EzRuntime, ez: Ez, compute_name: str, 
-    mount: str):
+    mount: str, profile: str=DEFAULT_PROFILE):
 
-    # Mount /data drive only if azure
+    # Mount /data drive only if azure. Computes with a persistent mount
+    # mount the share themselves on first access.
     if mount == "azure":
         if compute_name == ".":
             mount_path = os.path.expanduser("~/data")
         else:
             mount_path = f"/home/{ez.user_name}/data"
-        mount_storage_account(runtime, compute_name, mount_path)
+            if has_automount(runtime, compute_name, mount_path):
+                return
+        mount_storage_account(runtime, compute_name, mount_path, 
+            profile=profile, cache=has_data_cache(runtime, compute_name))
+
+def prefetch_to_local_disk(runtime: EzRuntime, ez: Ez, compute_name: str,
+    patterns: List[str]) -> Optional[PrefetchStats]:
+    """Prefetch data while the environment starts. A failed prefetch doesn't
+    stop the environment, which can still read the files from /data."""
+    try:
+        return prefetch_data(runtime, ez, compute_name, patterns)
+    except SystemExit:
+        # ez helpers such as mount_storage_account report their error before
+        # they exit
+        printf_err("Prefetch failed")
+    except Exception as e:
+        # Including SSH errors and failed remote commands
+        printf_err(f"Prefetch failed: {e}")
+    return None
 
 def run_vscode(runtime: EzRuntime, ez: Ez, compute_name: str, 
     env_name: str, local_env_path: str):
@@ -606,25 +927,138 @@ def run_vscode(runtime: EzRuntime, ez: Ez, compute_name: str,
     if compute_name != ".":
         ez.active_remote_compute_type = "vm"
 
+def query_vm_size(runtime: EzRuntime, compute_name: str) -> str:
+    """Return the size of compute_name, warming the size catalog cache that
+    write_devcontainer_json reads from"""
+    vm_size = get_vm_size(runtime, compute_name)
+    get_vm_size_info(runtime, vm_size)
+    return vm_size
+
+def __env_stages(runtime: EzRuntime, ez: Ez, git_uri: str, 
+    compute_name: str, env_name: str, use_acr: bool=False, 
+    build: bool=False, mount: str="none", sync_path: str=None, 
+    clone_depth: int=0, partial_clone: bool=False, git_cache: bool=True, 
+    buildkit: str=None, mount_profile: str=DEFAULT_PROFILE, 
+    prefetch: Optional[List[str]]=None,
+    assign_to: List[str]=None) -> List[Stage]:
+    """Stages that get the repo, the container image, the share of the
+    compute, the data drive and prefetched data of env_name ready on
+    compute_name. The compute's GPUs, cores and memory are assigned to each
+    of assign_to, which is env_name by default."""
+
+    # The stages run concurrently as soon as the stages they depend on are
+    # done. The local repo stages, the remote clone, the VM size query and
+    # the Azure Files mount don't depend on each other, so the time to
+    # launch VS Code approaches the time of the slowest of them.
+    remote = compute_name != "."
+    stages = [
+        Stage("local_env_path", f"Cloning/updating {git_uri} locally",
+            lambda r: clone_git_repo(git_uri, env_name)),
+        Stage("ez_json", "Reading ez.json",
+            lambda r: read_repo_config(r["local_env_path"]),
+            ["local_env_path"]),
+        Stage("dockerfile", "Generating Dockerfile",
+            lambda r: generate_dockerfile(ez, r["local_env_path"], 
+                r["ez_json"], cache_mounts=buildkit is not None, 
+                refresh=build),
+            ["ez_json"]),
+        Stage("image_name", "Hashing container build context",
+            lambda r: image_name(ez, f"{r['local_env_path']}/.devcontainer"),
+            ["dockerfile"]),
+        Stage("container", "Building container image",
+            lambda r: build_container(runtime, ez, r["local_env_path"], 
+                r["image_name"], compute_name, use_acr, build, buildkit),
+            ["image_name"]),
+    ]
+
+    if remote:
+        stages += [
+            Stage("remote_repo", f"Cloning/updating {git_uri} on "
+                f"{compute_name}",
+                lambda r: clone_remote_repo(runtime, ez, git_uri, 
+                    compute_name, env_name, clone_depth, 
+                    partial_clone, git_cache)),
+            Stage("vm_size", f"Querying {compute_name} for its size",
+                lambda r: query_vm_size(runtime, compute_name)),
+        ]
+        if sync_path is not None:
+            stages.append(Stage("working_tree", 
+                f"Syncing {sync_path} to {compute_name}",
+                lambda r: sync_working_tree(runtime, ez, compute_name, 
+                    env_name, sync_path),
+                ["remote_repo"]))
+
+    if remote and use_acr:
+        # Start pulling the image onto the compute as soon as it is in the
+        # registry, while the other stages run
+        stages.append(Stage("image_pull", f"Pulling image onto {compute_name}",
+            lambda r: pull_image(ez, r["image_name"], 
+                get_compute_uri(runtime, compute_name)),
+            ["container"]))
+
+    if remote:
+        stages.append(Stage("assignments", 
+            f"Assigning GPUs and cores of {compute_name}",
+            lambda r: schedule_envs(runtime, ez, compute_name, 
+                assign_to or [env_name], r["ez_json"], r["vm_size"]),
+            ["ez_json", "vm_size"]))
+
+    automount = remote and has_automount(runtime, compute_name,
+        f"/home/{ez.user_name}/data")
+    if mount == "azure" and not automount:
+        # The key is usually in the local credential store. When it isn't,
+        # the az lookup runs alongside the other stages.
+        stages += [
+            Stage("storage_key", "Retrieving storage account key",
+                lambda r: get_share_key(runtime)),
+            Stage("data_drive", "Mounting Azure File Share",
+                lambda r: mount_data_drive(runtime, ez, compute_name, mount,
+                    mount_profile),
+                ["storage_key"]),
+        ]
+
+    if remote and prefetch:
+        # Copying data to the local disk overlaps with the container build
+        stages.append(Stage("prefetch", f"Prefetching data on {compute_name}",
+            lambda r: prefetch_to_local_disk(runtime, ez, compute_name,
+                prefetch),
+            ["data_drive"] if mount == "azure" and not automount else []))
+    return stages
+
 def __go(runtime: EzRuntime, ez: Ez, git_uri: str, compute_name: str, 
     env_name: str, use_acr: bool=False, build: bool=False, mount: str="none",
-    patch_file: str=None):
-
-    local_env_path = clone_git_repo(git_uri, env_name)
-    ez_json = read_repo_config(local_env_path)
-    generate_dockerfile(ez, local_env_path, ez_json)
-    build_container(ez, local_env_path, env_name, compute_name, use_acr)
-
-    if compute_name != ".":
-        clone_remote_repo(runtime, ez, git_uri, compute_name, env_name, 
-            patch_file)
-
-    write_settings_json(ez, compute_name, local_env_path)
-    write_devcontainer_json(runtime, ez, compute_name, env_name, 
-        local_env_path, ez_json, use_acr, mount)
-
-    mount_data_drive(runtime, ez, compute_name, mount)
-    run_vscode(runtime, ez, compute_name, env_name, local_env_path)
+    sync_path: str=None, clone_depth: int=0, partial_clone: bool=False,
+    git_cache: bool=True, buildkit: str=None, 
+    mount_profile: str=DEFAULT_PROFILE,
+    prefetch: Optional[List[str]]=None):
+
+    remote = compute_name != "."
+    stages = __env_stages(runtime, ez, git_uri, compute_name, env_name, 
+        use_acr, build, mount, sync_path, clone_depth, partial_clone, 
+        git_cache, buildkit, mount_profile, prefetch)
+    stages += [
+        Stage("settings_json", "Writing .vscode/settings.json",
+            lambda r: write_settings_json(ez, compute_name, 
+                r["local_env_path"]),
+            ["local_env_path"]),
+        Stage("devcontainer_json", 
+            "Writing .devcontainer/devcontainer.json",
+            lambda r: write_devcontainer_json(runtime, ez, compute_name, 
+                env_name, r["local_env_path"], r["ez_json"], use_acr, mount,
+                r.get("vm_size"), 
+                r["image_name"] if use_acr or buildkit is not None else None,
+                r["assignments"][0] if remote else None),
+            ["image_name", "assignments"] if remote else ["image_name"]),
+    ]
+
+    results = run_stages(stages, f"Preparing {env_name} on {compute_name}")
+    if results.get("prefetch") is not None:
+        printf(results["prefetch"].describe(), indent=2)
+    if not any(results[name] for name in 
+        ["dockerfile", "settings_json", "devcontainer_json"]):
+        printf("config unchanged, reusing container", indent=2)
+    run_vscode(runtime, ez, compute_name, env_name, 
+        results["local_env_path"])
 
 @click.command()
 @click.option("--git-uri", "-g", required=True, prompt="URI of GitHub repo",
@@ -635,13 +1069,35 @@ def __go(runtime: EzRuntime, ez: Ez, git_uri: str, compute_name: str,
     help="Environment name to start")
 @click.option("--mount", default="none",
     help="Mount {local|azure|none} drive to /data default none")
+@click.option("--mount-profile", type=click.Choice(list(PROFILES.keys())),
+    default=DEFAULT_PROFILE,
+    help=f"Mount options for --mount azure (default {DEFAULT_PROFILE})")
 @click.option("--use-acr", is_flag=True, default=False,
     help="Generate container using Azure Container Registry")
 @click.option("--build", is_flag=True, default=False,
-    help="When used with --use-acr forces a build of the container")
+    help=("When used with --use-acr forces a build of the container even "
+          "if an image with the same build inputs exists"))
+@click.option("--buildkit", type=click.Choice(["local", "compute"]), 
+    default=None,
+    help=("Build the container with BuildKit on this machine or on the "
+          "compute, caching pip and conda packages between builds. With "
+          "--use-acr the image and its build cache are pushed to ACR"))
+@click.option("--clone-depth", type=int, default=0,
+    help="Shallow clone the repo on the compute with this many commits")
+@click.option("--partial-clone", is_flag=True, default=False,
+    help="Clone the repo on the compute without file contents, which are "
+    "fetched on demand")
+@click.option("--no-git-cache", is_flag=True, default=False,
+    help="Don't use the git object cache on the compute when cloning")
+@click.option("--prefetch", multiple=True,
+    help=("Copy files matching this path or glob in the file share to "
+    "/scratch/data on the compute while the environment starts. Can be "
+    "repeated"))
 @click.pass_obj
 def go(runtime: EzRuntime, git_uri: str, name: str, env_name: str, mount: str, 
-    use_acr: bool, build: bool):
+    mount_profile: str, use_acr: bool, build: bool, buildkit: str, 
+    clone_depth: int, partial_clone: bool, no_git_cache: bool, 
+    prefetch: List[str]):
     """Create and run an environment"""
 
     # If compute name is "-" OR there is no active compute defined, prompt
@@ -666,9 +1122,231 @@ def go(runtime: EzRuntime, git_uri: str, name: str, env_name: str, mount: str,
         env_name = git_uri.split("/")[-1]
         printf(f"using {env_name} (repo name) as the env name", indent=2)
 
+    if buildkit == "local" and name != "." and not use_acr:
+        printf_err("--buildkit local needs --use-acr to get the image to "
+            f"{name}. Use --buildkit compute to build on {name}")
+        exit(1)
+
+    if len(prefetch) > 0 and name == ".":
+        printf_err("--prefetch copies to the local disk of a remote compute")
+        exit(1)
+
     if mount == "azure" or mount == "local" or mount == "none":
-        __go(runtime, ez, git_uri, name, env_name, use_acr, build, mount)
+        __go(runtime, ez, git_uri, name, env_name, use_acr, build, mount,
+            clone_depth=clone_depth, partial_clone=partial_clone,
+            git_cache=not no_git_cache, buildkit=buildkit, 
+            mount_profile=mount_profile, prefetch=list(prefetch))
     else:
         printf_err("--mount must be azure|local|none")
     runtime.save()
-    exit(0)
\ No newline at end of file
+    exit(0)
+
+def __compute_uri(runtime: EzRuntime, compute_name: str) -> Optional[str]:
+    return None if compute_name == "." else get_compute_uri(runtime, 
+        compute_name)
+
+def prepare_job_slots(runtime: EzRuntime, ez: Ez, git_uri: str, 
+    slots: Dict[str, int], env_name: str, use_acr: bool=False,
+    build: bool=False, mount: str="none", 
+    mount_profile: str=DEFAULT_PROFILE, 
+    prefetch: Optional[List[str]]=None) -> Dict[str, List[List[str]]]:
+    """Get env_name ready on computes like ez env go, but for jobs instead 
+    of VS Code. slots has the number of job slots of each compute, and the
+    docker run arguments of each slot of each compute are returned.
+
+    The computes are prepared at the same time, sharing the local clone of
+    the repo, and the image when it comes from ACR. Each slot gets its own
+    share of the compute's GPUs, cores and memory, so jobs that run at the
+    same time don't share GPUs.
+    """
+    remote = any(name != "." for name in slots)
+
+    # Jobs start their container from an image, which is built with
+    # BuildKit where it runs unless it comes from ACR
+    buildkit = None if use_acr else ("compute" if remote else "local")
+    shared = { "local_env_path", "ez_json", "dockerfile", "image_name", 
+        "storage_key" }
+    if buildkit != "compute":
+        shared.add("container")
+    stages = []
+    for compute_name, max_jobs in slots.items():
+        for stage in scope_stages(__env_stages(runtime, ez, git_uri, 
+            compute_name, env_name, use_acr, build, mount, 
+            buildkit=buildkit, mount_profile=mount_profile, 
+            prefetch=prefetch, assign_to=[f"{env_name}/{slot}" 
+            for slot in range(max_jobs)]), compute_name, shared):
+            if all(stage.name != s.name for s in stages):
+                stages.append(stage)
+    results = run_stages(stages, 
+        f"Preparing {env_name} on {', '.join(slots)}",
+        max_workers=8 * len(slots))
+
+    slot_args = {}
+    for compute_name, max_jobs in slots.items():
+        r = scope_results(results, compute_name)
+        if r.get("prefetch") is not None:
+            printf(f"{compute_name}: {r['prefetch'].describe()}", indent=2)
+        assignments = r.get("assignments") or [None] * max_jobs
+        slot_args[compute_name] = [container_args(devcontainer_config(
+            runtime, ez, compute_name, env_name, r["local_env_path"], 
+            r["ez_json"], use_acr, mount, r.get("vm_size"), 
+            r["image_name"], assignment, label=f"{env_name}/{slot}")) 
+            for slot, assignment in enumerate(assignments)]
+    return slot_args
+
+def queue_job(runtime: EzRuntime, ez: Ez, compute_name: str, env_name: str,
+    command: str, slot_args: List[List[str]]) -> str:
+    """Queue command to run in the next free job slot of compute_name, 
+    returning the id of the job"""
+    job_id = new_job_id(env_name)
+    reserved = ([f"{env_name}/{slot}" for slot in range(len(slot_args))] 
+        if compute_name != "." else [])
+    script = job_script(job_id, env_name, command, slot_args, reserved)
+    result = exec_cmd(submit_script(job_id, script), 
+        __compute_uri(runtime, compute_name), ez.private_key_path)
+    exit_on_error(result)
+    return job_id
+
+def job_statuses(runtime: EzRuntime, ez: Ez, 
+    compute_name: str) -> List[JobStatus]:
+    """Status of the jobs on compute_name, oldest first"""
+    result = exec_cmd(status_script(), __compute_uri(runtime, compute_name),
+        ez.private_key_path)
+    exit_on_error(result)
+    return parse_status(result.stdout)
+
+def follow_job(runtime: EzRuntime, ez: Ez, compute_name: str, 
+    job_id: str) -> int:
+    """Print the log of job_id until it is done, returning its exit code.
+    Interrupting leaves the job running."""
+    if compute_name != ".":
+        prefix = ssh_args(get_compute_uri(runtime, compute_name), 
+            ez.private_key_path)
+    else:
+        prefix = ["bash", "-c"]
+    try:
+        return subprocess.run(prefix + [follow_script(job_id)]).returncode
+    except KeyboardInterrupt:
+        printf(f"job {job_id} is still running on {compute_name}. Follow "
+            f"it with ez env logs -n {compute_name} {job_id}")
+        runtime.save()
+        exit(130)
+
+@click.command()
+@click.option("--git-uri", "-g", required=True,
+    help="URI of git repo to load in the environment")
+@click.option("--name", "-n", default="",
+    help="Compute to run the job on (default is the active compute)")
+@click.option("--env-name", "-e", default="",
+    help="Environment name (default is the repo name)")
+@click.option("--mount", type=click.Choice(["local", "azure", "none"]),
+    default="none", help="Mount {local|azure|none} drive to /data")
+@click.option("--mount-profile", type=click.Choice(list(PROFILES.keys())),
+    default=DEFAULT_PROFILE,
+    help=f"Mount options for --mount azure (default {DEFAULT_PROFILE})")
+@click.option("--use-acr", is_flag=True, default=False,
+    help="Generate container using Azure Container Registry")
+@click.option("--build", is_flag=True, default=False,
+    help="Build the container image even if it exists")
+@click.option("--prefetch", multiple=True,
+    help=("Copy files matching this path or glob in the file share to "
+    "/scratch/data on the compute before the job starts. Can be repeated"))
+@click.option("--max-jobs", type=click.IntRange(min=1), default=None,
+    help=("Number of jobs that run at the same time on the compute. It is "
+    "remembered for the compute (default 1)"))
+@click.option("--detach", "-d", is_flag=True, default=False,
+    help="Return once the job is queued instead of following its log")
+@click.option("--stop", is_flag=True, default=False,
+    help="Deallocate the compute when the job is done, unless other jobs "
+    "are queued or running on it")
+@click.argument("command", nargs=-1, required=True)
+@click.pass_obj
+def run(runtime: EzRuntime, git_uri: str, name: str, env_name: str, 
+    mount: str, mount_profile: str, use_acr: bool, build: bool, 
+    prefetch: List[str], max_jobs: Optional[int], detach: bool, stop: bool,
+    command: List[str]):
+    """Run a command in an environment without VS Code
+
+COMMAND and its arguments run in the environment's container in /workspace,
+e.g., ez env run -g <repo> -- python train.py --epochs 10. The arguments
+are passed as they are, so use bash -c '...' for pipes, redirections or
+variables. Jobs are queued on the compute and start when one of its
+--max-jobs slots is free, so any number of jobs can be queued. The log and
+exit code of each job are kept on the compute: list jobs with ez env jobs
+and follow one with ez env logs. The command exits with the exit code of
+the job.
+    """
+    ez = runtime.current()
+    name = get_active_compute_name(runtime, name)
+    if env_name == "":
+        env_name = git_uri.split("/")[-1]
+    if stop and (detach or name == "."):
+        printf_err("--stop deallocates a remote compute after following "
+            "the job, and can't be used with --detach")
+        exit(1)
+    if len(prefetch) > 0 and name == ".":
+        printf_err("--prefetch copies to the local disk of a remote compute")
+        exit(1)
+
+    compute = ez.computes.setdefault(name, {})
+    if max_jobs is not None:
+        compute["max_jobs"] = max_jobs
+    slot_args = prepare_job_slots(runtime, ez, git_uri, 
+        { name: compute.get("max_jobs", 1) }, env_name, use_acr, build, 
+        mount, mount_profile, list(prefetch))[name]
+    job_id = queue_job(runtime, ez, name, env_name, shlex.join(command), 
+        slot_args)
+    runtime.save()
+    printf(f"queued job {job_id} on {name}")
+    if detach:
+        printf(f"follow it with ez env logs -n {name} {job_id}", indent=2)
+        exit(0)
+
+    exit_code = follow_job(runtime, ez, name, job_id)
+    printf(f"job {job_id} exited with {exit_code}")
+    if stop:
+        pending = [job for job in job_statuses(runtime, ez, name) 
+            if not job.finished]
+        if len(pending) > 0:
+            printf(f"not stopping {name}: {len(pending)} jobs are queued or "
+                "running", indent=2)
+        else:
+            deallocate_vm(runtime, name)
+    runtime.save()
+    exit(exit_code)
+
+@click.command()
+@click.option("--name", "-n", default="",
+    help="Compute to list the jobs of (default is the active compute)")
+@click.pass_obj
+def jobs(runtime: EzRuntime, name: str):
+    """List the jobs on a compute"""
+    ez = runtime.current()
+    name = get_active_compute_name(runtime, name)
+    statuses = job_statuses(runtime, ez, name)
+    if len(statuses) == 0:
+        printf(f"No jobs on {name}")
+    for status in statuses:
+        printf(status.describe())
+    exit(0)
+
+@click.command()
+@click.option("--name", "-n", default="",
+    help="Compute that runs the job (default is the active compute)")
+@click.argument("job_id", default="")
+@click.pass_obj
+def logs(runtime: EzRuntime, name: str, job_id: str):
+    """Follow the log of a job until it is done
+
+JOB_ID is a job listed by ez env jobs, the most recent job by default. The
+command exits with the exit code of the job.
+    """
+    ez = runtime.current()
+    name = get_active_compute_name(runtime, name)
+    if job_id == "":
+        statuses = job_statuses(runtime, ez, name)
+        if len(statuses) == 0:
+            printf_err(f"No jobs on {name}")
+            exit(1)
+        job_id = statuses[-1].job_id
+    exit(follow_job(runtime, ez, name, job_id))
@@ -1,14 +1,33 @@
 # Helper functions for executing commands local and remote
 
+import constants as C
+import os
 import pandas as pd
 import subprocess
 
+from contextlib import contextmanager
 from fabric import Connection
 from formatting import format_output_string, printf_err
 from io import StringIO
 from rich.progress import (Progress, SpinnerColumn, TextColumn, 
     TimeElapsedColumn)
-from typing import Optional, Union
+from typing import List, Optional, Union
+
+# Rich can only show one live progress display at a time. Callers that show
+# their own progress while running commands concurrently turn off the
+# per-command displays.
+show_progress = True
+
+@contextmanager
+def progress_disabled():
+    """Context manager that turns off per-command progress displays"""
+    global show_progress
+    previous = show_progress
+    show_progress = False
+    try:
+        yield
+    finally:
+        show_progress = previous
 
 class ExecResult:
     exit_code: int 
@@ -83,7 +102,7 @@ def exec_cmd(cmd: Union[str, list[str]], uri: str=None,
     cwd: str=None) -> Union[ExecResult, list[ExecResult]]:
 
     # Description sets up a master context for showing things
-    if description is not None:
+    if description is not None and show_progress:
         description = format_output_string(description)
         with Progress(
             SpinnerColumn(),
@@ -137,10 +156,7 @@ def exec_cmd_remote(cmd: Union[str, list[str]], uri: str,
     str=None) -> Union[ExecResult, list[ExecResult]]:
     """Execute cmd on uri using private_key_path in cwd"""
 
-    connect_args={
-        "key_filename": [private_key_path]
-    }
-    with Connection(uri, connect_kwargs=connect_args) as connection:
+    with open_connection(uri, private_key_path) as connection:
         if cwd is not None:
             connection.cd(cwd)
         if type(cmd) is str:
@@ -155,6 +171,30 @@ def exec_cmd_remote(cmd: Union[str, list[str]], uri: str,
 
         return result
 
+def open_connection(uri: str, private_key_path: str, 
+    compress: bool=False) -> Connection:
+    """Open an SSH connection to uri using private_key_path. Use compress for
+    connections that transfer files."""
+    connect_args={
+        "key_filename": [private_key_path],
+        "compress": compress
+    }
+    return Connection(uri, connect_kwargs=connect_args)
+
+def ssh_args(uri: str, private_key_path: str, tty: bool=False) -> List[str]:
+    """Return the ssh command line for uri. ssh commands to the same host
+    share one multiplexed connection that stays open for 10 minutes after
+    the last command, so later commands skip the SSH handshake."""
+    control_dir = os.path.expanduser(C.SSH_CONTROL_DIR)
+    os.makedirs(control_dir, mode=0o700, exist_ok=True)
+    args = ["ssh", "-i", private_key_path,
+        "-o", "ControlMaster=auto",
+        "-o", f"ControlPath={control_dir}/%C",
+        "-o", "ControlPersist=10m"]
+    if tty:
+        args.append("-tt")
+    return args + [uri]
+
 def exec_single_cmd_remote(connection: Connection, cmd: str) -> ExecResult:
     """Execute cmd on connection, ensuring that result no exceptions are
 thrown"""
@@ -5,7 +5,9 @@ import platform
 import subprocess
 
 import compute_commands
+import data_commands
 import env_commands
+import sweep_commands
 import workspace_commands
 
 from ez_state import EzRuntime
@@ -141,6 +143,7 @@ For support, please create a GitHub issue at https://github.com/jflam/ez
 """)
 
 ez.add_command(init)
+ez.add_command(sweep_commands.sweep)
 
 # workspace sub-commands
 
@@ -195,4 +198,19 @@ def env():
 env.add_command(env_commands.cp)
 env.add_command(env_commands.ssh)
 env.add_command(env_commands.up)
-env.add_command(env_commands.go)
\ No newline at end of file
+env.add_command(env_commands.sync)
+env.add_command(env_commands.go)
+env.add_command(env_commands.run)
+env.add_command(env_commands.jobs)
+env.add_command(env_commands.logs)
+
+# data sub-commands
+
+@ez.group()
+def data():
+    """Manage data in the workspace file share"""
+    pass
+
+data.add_command(data_commands.prefetch)
+data.add_command(data_commands.push)
+data.add_command(data_commands.pull)
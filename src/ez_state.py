@@ -4,7 +4,7 @@ import json, os
 from dataclasses import dataclass, field
 from datetime import datetime
 from formatting import printf
-from typing import Dict
+from typing import Any, Dict
 
 @dataclass
 class Ez:
@@ -14,16 +14,29 @@ class Ez:
     registry_name: str=""
     storage_account_name: str=""
     file_share_name: str=""
+    # SMB or NFS, "" until it is queried
+    file_share_protocol: str=""
     subscription: str=""
     region: str=""
     private_key_path: str=""
     user_name: str=""
 
+    # Defaults for compute create
+    os_disk_size_gb: int=256
+    ephemeral_os_disk: bool=False
+    accelerated_networking: bool=False
+    proximity_placement_group: str=""
+    enable_hibernation: bool=False
+
     # Remotes
     active_remote_compute: str=""
     active_remote_compute_type: str=""
     active_remote_env: str=""
 
+    # Per-compute state keyed by compute name, e.g., the options that the
+    # compute was created with
+    computes: Dict[str, Dict[str, Any]]=field(default_factory=dict)
+
     # Authentication state
     last_auth_check: datetime=None
 
@@ -0,0 +1,542 @@
+# Copy files between this machine and the workspace file share using the
+# Azure Files REST API
+#
+# Files are transferred in 4MB ranges (the largest range that Put Range
+# accepts) over several HTTPS connections at once, which is much faster over
+# a WAN than copying through an SMB mount. Completed ranges are recorded in
+# a journal so that an interrupted transfer resumes where it stopped, and
+# uploaded files get a Content-MD5 so that unchanged files are skipped.
+
+import base64
+import constants as C
+import exec
+import hashlib
+import hmac
+import http.client
+import json
+import os
+import posixpath
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree as ET
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from email.utils import formatdate
+from rich.progress import (BarColumn, DownloadColumn, Progress, TextColumn,
+    TimeRemainingColumn, TransferSpeedColumn)
+from transfer import PART_SUFFIX, CopyStats, FileCopy
+from typing import Callable, Dict, List, Optional, Tuple
+
+API_VERSION = "2021-06-08"
+RANGE_SIZE = 4 * 1024 * 1024
+
+# Requests that fail with a connection error or a 500/503 (e.g., when the
+# share throttles) are retried with exponential backoff
+RETRIES = 4
+RETRY_DELAY = 0.5
+
+# How often the journal of a transfer is written while it runs
+JOURNAL_INTERVAL = 1.0
+
+class FileShareError(Exception):
+    def __init__(self, status: int, reason: str, body: bytes=b""):
+        self.status = status
+        self.reason = reason
+        self.body = body
+        super().__init__(f"{status} {reason}")
+
+@dataclass
+class RemoteFile:
+    path: str
+    size: int
+    md5: str=""
+    etag: str=""
+
+def file_md5(path: str) -> str:
+    """base64 MD5 of the file at path, as in Content-MD5 headers"""
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(RANGE_SIZE)
+            if not data:
+                break
+            md5.update(data)
+    return base64.b64encode(md5.digest()).decode("ascii")
+
+def data_md5(data: bytes) -> str:
+    return base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+
+def shared_key_signature(account: str, key: str, method: str, path: str,
+    query: Dict[str, str], headers: Dict[str, str]) -> str:
+    """Sign a request with the storage account key (Shared Key
+    authorization). path is the URL-encoded path of the request."""
+    headers = { name.lower(): value for name, value in headers.items() }
+    content_length = headers.get("content-length", "")
+    standard = [method, headers.get("content-encoding", ""),
+        headers.get("content-language", ""),
+        "" if content_length == "0" else content_length,
+        headers.get("content-md5", ""), headers.get("content-type", ""),
+        "", headers.get("if-modified-since", ""),
+        headers.get("if-match", ""), headers.get("if-none-match", ""),
+        headers.get("if-unmodified-since", ""), headers.get("range", "")]
+    canonical_headers = [f"{name}:{headers[name].strip()}" for name
+        in sorted(headers) if name.startswith("x-ms-")]
+    resource = f"/{account}{path}"
+    for name in sorted(query, key=str.lower):
+        resource += f"\n{name.lower()}:{query[name]}"
+    string_to_sign = "\n".join(standard + canonical_headers + [resource])
+    digest = hmac.new(base64.b64decode(key), string_to_sign.encode("utf-8"),
+        hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("ascii")
+
+class FileShareClient:
+    """Client for a file share in a storage account
+
+    endpoint is the file service URL, https://<account>.file.core.windows.net
+    by default. Emulators and test servers use path-style URLs like
+    http://127.0.0.1:10004/<account>. Each thread gets its own connection.
+    If a request is rejected with 403, refresh_key (if given) is called once
+    to look up the key again, in case it was rotated.
+    """
+
+    def __init__(self, account: str, key: str, share: str,
+        endpoint: Optional[str]=None, timeout: float=60,
+        refresh_key: Optional[Callable[[], str]]=None):
+        self.account = account
+        self.key = key
+        self.refresh_key = refresh_key
+        self.key_lock = threading.Lock()
+        self.share = share
+        self.endpoint = endpoint or f"https://{account}.file.core.windows.net"
+        url = urllib.parse.urlsplit(self.endpoint)
+        self.https = url.scheme == "https"
+        self.host = url.netloc
+        self.base_path = url.path.rstrip("/")
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def __connection(self) -> http.client.HTTPConnection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            if self.https:
+                connection = http.client.HTTPSConnection(self.host,
+                    timeout=self.timeout)
+            else:
+                connection = http.client.HTTPConnection(self.host,
+                    timeout=self.timeout)
+            self.local.connection = connection
+        return connection
+
+    def __reset_connection(self) -> None:
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    def request(self, method: str, path: str,
+        query: Optional[Dict[str, str]]=None,
+        headers: Optional[Dict[str, str]]=None, body: bytes=b"",
+        ok: Tuple[int, ...]=(200, 201, 202, 206)
+        ) -> Tuple[int, Dict[str, str], bytes]:
+        """Send a signed request for path (relative to the root of the share)
+
+        Returns:
+            Tuple[int, Dict[str, str], bytes]: status, lowercase headers and
+                body of the response
+
+        Raises:
+            FileShareError: if the status is not in ok
+        """
+        query, headers = query or {}, headers or {}
+        url_path = urllib.parse.quote(
+            posixpath.join(f"{self.base_path}/{self.share}", path.strip("/"))
+            .rstrip("/"))
+        url = url_path
+        if query:
+            url += "?" + urllib.parse.urlencode(query)
+
+        # A refresh of the key doesn't count as one of the RETRIES attempts
+        refreshed = False
+        attempt = 0
+        while True:
+            key = self.key
+            request_headers = {
+                "x-ms-date": formatdate(usegmt=True),
+                "x-ms-version": API_VERSION,
+                "Content-Length": str(len(body)),
+                **headers,
+            }
+            signature = shared_key_signature(self.account, key, method,
+                url_path, query, request_headers)
+            request_headers["Authorization"] = (
+                f"SharedKey {self.account}:{signature}")
+            try:
+                connection = self.__connection()
+                connection.request(method, url, body=body,
+                    headers=request_headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException):
+                self.__reset_connection()
+                if attempt == RETRIES - 1:
+                    raise
+                time.sleep(RETRY_DELAY * 2 ** attempt)
+                attempt += 1
+                continue
+
+            if response.status in (500, 503) and attempt < RETRIES - 1:
+                time.sleep(RETRY_DELAY * 2 ** attempt)
+                attempt += 1
+                continue
+            if (response.status == 403 and self.refresh_key is not None and
+                not refreshed):
+                with self.key_lock:
+                    # Another thread may have refreshed it already
+                    if self.key == key:
+                        self.key = self.refresh_key()
+                refreshed = True
+                continue
+            if response.status not in ok:
+                raise FileShareError(response.status, response.reason, data)
+            return (response.status,
+                { name.lower(): value for name, value
+                    in response.getheaders() }, data)
+
+    def create_directories(self, path: str) -> None:
+        """Create path and its parents if they don't exist"""
+        parts = [p for p in path.strip("/").split("/") if p]
+        for i in range(len(parts)):
+            self.request("PUT", "/".join(parts[:i + 1]),
+                { "restype": "directory" }, {
+                    "x-ms-file-permission": "inherit",
+                    "x-ms-file-attributes": "Directory",
+                    "x-ms-file-creation-time": "now",
+                    "x-ms-file-last-write-time": "now",
+                }, ok=(201, 409))
+
+    def properties(self, path: str) -> Optional[RemoteFile]:
+        """Size, Content-MD5 and ETag of the file at path, or None if there
+        is no such file"""
+        status, headers, _ = self.request("HEAD", path, ok=(200, 404))
+        if status == 404:
+            return None
+        return RemoteFile(path, int(headers.get("content-length", "0")),
+            headers.get("content-md5", ""), headers.get("etag", ""))
+
+    def list_files(self, path: str) -> List[RemoteFile]:
+        """List the files under the directory at path, recursively. Only
+        the paths and sizes are returned."""
+        files = []
+        marker = ""
+        while True:
+            query = { "restype": "directory", "comp": "list" }
+            if marker:
+                query["marker"] = marker
+            status, _, body = self.request("GET", path, query, ok=(200, 404))
+            if status == 404:
+                raise FileNotFoundError(path)
+            root = ET.fromstring(body)
+            entries = root.find("Entries")
+            for entry in entries if entries is not None else []:
+                name = posixpath.join(path, entry.findtext("Name")).strip("/")
+                if entry.tag == "Directory":
+                    files += self.list_files(name)
+                elif entry.tag == "File":
+                    files.append(RemoteFile(name, int(entry.findtext(
+                        "Properties/Content-Length") or 0)))
+            marker = root.findtext("NextMarker") or ""
+            if not marker:
+                return files
+
+    def create_file(self, path: str, size: int) -> None:
+        """Create (or replace) the file at path with size zero bytes"""
+        self.request("PUT", path, headers={
+            "x-ms-type": "file",
+            "x-ms-content-length": str(size),
+            "x-ms-file-permission": "inherit",
+            "x-ms-file-attributes": "None",
+            "x-ms-file-creation-time": "now",
+            "x-ms-file-last-write-time": "now",
+        })
+
+    def put_range(self, path: str, offset: int, data: bytes) -> None:
+        self.request("PUT", path, { "comp": "range" }, {
+            "x-ms-range": f"bytes={offset}-{offset + len(data) - 1}",
+            "x-ms-write": "update",
+            "Content-MD5": data_md5(data),
+        }, data)
+
+    def set_md5(self, path: str, size: int, md5: str) -> None:
+        """Set the Content-MD5 of the whole file, used to skip unchanged
+        files"""
+        self.request("PUT", path, { "comp": "properties" }, {
+            "x-ms-content-length": str(size),
+            "x-ms-content-md5": md5,
+            "x-ms-file-permission": "preserve",
+            "x-ms-file-attributes": "preserve",
+            "x-ms-file-creation-time": "preserve",
+            "x-ms-file-last-write-time": "preserve",
+        })
+
+    def get_range(self, path: str, offset: int, length: int) -> bytes:
+        """Read length bytes at offset, verifying their MD5"""
+        _, headers, data = self.request("GET", path, headers={
+            "x-ms-range": f"bytes={offset}-{offset + length - 1}",
+            "x-ms-range-get-content-md5": "true",
+        })
+        if len(data) != length or ("content-md5" in headers and
+            headers["content-md5"] != data_md5(data)):
+            raise IOError(f"{path}: corrupt range at {offset}")
+        return data
+
+def __journal_path(direction: str, local: str, remote: str) -> str:
+    name = hashlib.sha256(f"{direction}\0{os.path.abspath(local)}\0"
+        f"{remote}".encode("utf-8")).hexdigest()[:32]
+    return os.path.join(os.path.expanduser(C.TRANSFER_JOURNAL_DIR),
+        f"{name}.json")
+
+def load_journal(path: str, identity: Dict[str, str]) -> List[int]:
+    """Offsets of the ranges completed by an earlier transfer of the same
+    file, or [] if it was a different version of the file"""
+    try:
+        with open(path, "rt") as f:
+            journal = json.load(f)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return []
+    if (journal.get("identity") != identity or
+        journal.get("range_size") != RANGE_SIZE):
+        return []
+    return journal["done"]
+
+def save_journal(path: str, identity: Dict[str, str],
+    done: List[int]) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wt") as f:
+        json.dump({ "identity": identity, "range_size": RANGE_SIZE,
+            "done": sorted(done) }, f)
+    os.replace(tmp_path, path)
+
+class PendingTransfer:
+    """A file being transferred, the ranges left to copy and its journal"""
+    def __init__(self, copy: FileCopy, journal_path: str,
+        identity: Dict[str, str], done: List[int]):
+        self.copy = copy
+        self.journal_path = journal_path
+        self.identity = identity
+        self.done = set(done)
+        self.pending = [offset for offset in range(0, copy.size, RANGE_SIZE)
+            if offset not in self.done]
+
+    def save(self) -> None:
+        save_journal(self.journal_path, self.identity, list(self.done))
+
+def __run_ranges(transfers: List[PendingTransfer], jobs: int,
+    description: str, copy_range: Callable[[FileCopy, int, int], None],
+    finish: Callable[[FileCopy], None]) -> int:
+    """Run copy_range for every pending range of transfers, up to jobs at a
+    time, then finish for each file whose ranges are all done. Journals
+    are saved as ranges complete, including when a range fails.
+
+    Returns:
+        int: number of bytes copied
+    """
+    lock = threading.Lock()
+    last_save = [time.time()]
+    total = sum(min(RANGE_SIZE, t.copy.size - offset)
+        for t in transfers for offset in t.pending)
+
+    def save_journals(force: bool=False) -> None:
+        with lock:
+            if force or time.time() - last_save[0] >= JOURNAL_INTERVAL:
+                for transfer in transfers:
+                    if len(transfer.pending) > 0:
+                        transfer.save()
+                last_save[0] = time.time()
+
+    with Progress(
+        TextColumn("[progress.description]{task.description}"),
+        BarColumn(),
+        DownloadColumn(),
+        TransferSpeedColumn(),
+        TimeRemainingColumn(),
+        disable=not exec.show_progress,
+    ) as progress, ThreadPoolExecutor(max_workers=jobs) as executor:
+        task = progress.add_task(description, total=total)
+
+        def run(transfer: PendingTransfer, offset: int) -> None:
+            length = min(RANGE_SIZE, transfer.copy.size - offset)
+            copy_range(transfer.copy, offset, length)
+            with lock:
+                transfer.done.add(offset)
+            progress.advance(task, length)
+            save_journals()
+
+        futures = [executor.submit(run, t, offset)
+            for t in transfers for offset in t.pending]
+        try:
+            for future in futures:
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+            save_journals(force=True)
+            raise
+
+    for transfer in transfers:
+        finish(transfer.copy)
+        if os.path.exists(transfer.journal_path):
+            os.remove(transfer.journal_path)
+    return total
+
+def plan_push(client: FileShareClient, source: str,
+    dest: str) -> List[FileCopy]:
+    """List the files to copy from the local file or directory source to
+    dest in the share. A directory is copied into dest/<its name>."""
+    source = os.path.normpath(source)
+    if not os.path.exists(source):
+        raise FileNotFoundError(source)
+    target = posixpath.join(dest.strip("/"), os.path.basename(source))
+    if os.path.isfile(source):
+        return [FileCopy(source, target, os.stat(source).st_size)]
+    copies = []
+    for parent, _, names in os.walk(source):
+        for name in sorted(names):
+            path = os.path.join(parent, name)
+            rel = os.path.relpath(path, source).replace(os.sep, "/")
+            copies.append(FileCopy(path, posixpath.join(target, rel),
+                os.stat(path).st_size))
+    return copies
+
+def plan_pull(client: FileShareClient, source: str,
+    dest: str) -> List[FileCopy]:
+    """List the files to copy from the file or directory source in the share
+    to the local directory dest"""
+    source = source.strip("/")
+    name = posixpath.basename(source)
+    remote = client.properties(source) if source else None
+    if remote is not None:
+        return [FileCopy(source, os.path.join(dest, name), remote.size)]
+    copies = []
+    for remote in client.list_files(source):
+        rel = posixpath.relpath(remote.path, source) if source else remote.path
+        copies.append(FileCopy(remote.path,
+            os.path.join(dest, name, *rel.split("/")), remote.size))
+    return copies
+
+def __remote_properties(client: FileShareClient, paths: List[str],
+    jobs: int) -> Dict[str, Optional[RemoteFile]]:
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return dict(zip(paths, executor.map(client.properties, paths)))
+
+def push_files(client: FileShareClient, copies: List[FileCopy],
+    jobs: int=16, description: str="") -> CopyStats:
+    """Upload copies (local src, remote dest) to the share, skipping files
+    whose Content-MD5 in the share matches and resuming interrupted uploads
+
+    Returns:
+        CopyStats: what was copied
+    """
+    stats = CopyStats(files=len(copies))
+    remote = __remote_properties(client, [c.dest for c in copies], jobs)
+    transfers = []
+    for copy in copies:
+        existing = remote[copy.dest]
+        if (existing is not None and existing.size == copy.size and
+            existing.md5 != "" and existing.md5 == file_md5(copy.src)):
+            stats.skipped += 1
+            continue
+
+        st = os.stat(copy.src)
+        identity = { "size": str(st.st_size), "mtime": str(st.st_mtime_ns) }
+        journal_path = __journal_path("push", copy.src,
+            f"{client.endpoint}/{client.share}/{copy.dest}")
+        done = load_journal(journal_path, identity)
+        if (len(done) > 0 and existing is not None and 
+            existing.size == st.st_size):
+            stats.resumed += 1
+        else:
+            done = []
+        transfers.append(PendingTransfer(copy, journal_path, identity, done))
+    stats.bytes_total = sum(t.copy.size for t in transfers)
+
+    for directory in sorted({ posixpath.dirname(t.copy.dest)
+        for t in transfers } - { "" }):
+        client.create_directories(directory)
+    for transfer in transfers:
+        if len(transfer.done) == 0:
+            client.create_file(transfer.copy.dest, transfer.copy.size)
+
+    def copy_range(copy: FileCopy, offset: int, length: int) -> None:
+        with open(copy.src, "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        client.put_range(copy.dest, offset, data)
+
+    def finish(copy: FileCopy) -> None:
+        client.set_md5(copy.dest, copy.size, file_md5(copy.src))
+
+    stats.bytes_copied = __run_ranges(transfers, jobs, description,
+        copy_range, finish)
+    return stats
+
+def pull_files(client: FileShareClient, copies: List[FileCopy],
+    jobs: int=16, description: str="") -> CopyStats:
+    """Download copies (remote src, local dest) from the share, skipping
+    local files that match the Content-MD5 in the share and resuming
+    interrupted downloads. Files with a Content-MD5 are verified.
+
+    Returns:
+        CopyStats: what was copied
+    """
+    stats = CopyStats(files=len(copies))
+    remote = __remote_properties(client, [c.src for c in copies], jobs)
+    transfers = []
+    for copy in copies:
+        properties = remote[copy.src]
+        if properties is None:
+            raise FileNotFoundError(copy.src)
+        copy.size = properties.size
+        if (properties.md5 != "" and os.path.isfile(copy.dest) and
+            os.stat(copy.dest).st_size == copy.size and
+            file_md5(copy.dest) == properties.md5):
+            stats.skipped += 1
+            continue
+
+        identity = { "size": str(properties.size), "etag": properties.etag }
+        journal_path = __journal_path("pull", copy.dest,
+            f"{client.endpoint}/{client.share}/{copy.src}")
+        part = f"{copy.dest}{PART_SUFFIX}"
+        done = load_journal(journal_path, identity)
+        if (len(done) > 0 and os.path.isfile(part) and
+            os.stat(part).st_size == copy.size):
+            stats.resumed += 1
+        else:
+            done = []
+            os.makedirs(os.path.dirname(copy.dest) or ".", exist_ok=True)
+            with open(part, "wb") as f:
+                f.truncate(copy.size)
+        transfers.append(PendingTransfer(copy, journal_path, identity, done))
+    stats.bytes_total = sum(t.copy.size for t in transfers)
+    expected_md5 = { copy.src: remote[copy.src].md5 for copy in copies }
+
+    def copy_range(copy: FileCopy, offset: int, length: int) -> None:
+        data = client.get_range(copy.src, offset, length)
+        with open(f"{copy.dest}{PART_SUFFIX}", "r+b") as f:
+            f.seek(offset)
+            f.write(data)
+
+    def finish(copy: FileCopy) -> None:
+        part = f"{copy.dest}{PART_SUFFIX}"
+        md5 = expected_md5[copy.src]
+        if md5 != "" and file_md5(part) != md5:
+            os.remove(part)
+            raise IOError(f"{copy.src}: checksum mismatch after download")
+        os.replace(part, copy.dest)
+
+    stats.bytes_copied = __run_ranges(transfers, jobs, description,
+        copy_range, finish)
+    return stats
@@ -0,0 +1,201 @@
+# Build and tag container images for environments
+
+import hashlib
+import json
+import os
+import shlex
+
+from exec import exec_cmd, exit_on_error, open_connection
+from ez_state import Ez
+from formatting import printf
+from time import time
+from sync import format_bytes
+from transfer import copy_files, plan_upload
+from typing import Any, Optional, Tuple
+
+# Files in the .devcontainer directory that are not part of the image build
+# context, e.g., because they depend on the compute the env runs on
+NOT_BUILD_INPUTS = ["devcontainer.json"]
+
+def context_hash(context_dir: str) -> str:
+    """Return a hash of the files in the build context directory, which
+    includes the generated Dockerfile. Images built from contexts with the
+    same hash are identical, whichever env they were built for."""
+    context_hash = hashlib.sha256()
+    for parent, dirs, names in os.walk(context_dir):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(parent, name)
+            rel = os.path.relpath(path, context_dir).replace(os.sep, "/")
+            if rel in NOT_BUILD_INPUTS:
+                continue
+            executable = os.stat(path).st_mode & 0o111 != 0
+            context_hash.update(f"{rel}\0{executable}\0".encode("utf-8"))
+            with open(path, "rb") as f:
+                context_hash.update(hashlib.sha256(f.read()).digest())
+    return context_hash.hexdigest()
+
+def image_name(ez: Ez, context_dir: str) -> str:
+    """Return the content-addressed name of the image for context_dir, e.g.,
+    myworkspace:3f2a9c1b7d4e5f60"""
+    return f"{ez.workspace_name}:{context_hash(context_dir)[:16]}"
+
+def acr_image_exists(ez: Ez, image: str) -> bool:
+    """True if image is already in the workspace's container registry"""
+    cmd = (f"az acr repository show --name {ez.registry_name} "
+        f"--image {image}")
+    result = exec_cmd(cmd, description=f"Checking if {image} exists")
+    return result.exit_code == 0
+
+def build_image_acr(ez: Ez, context_dir: str, image: str,
+    force: bool=False) -> None:
+    """Build image from context_dir using ACR Tasks unless the registry
+    already has it"""
+    if not force and acr_image_exists(ez, image):
+        printf(f"Skipping build, {ez.registry_name}.azurecr.io/{image} "
+            "already exists", indent=2)
+        return
+
+    cmd = f"az acr build --registry {ez.registry_name} --image {image} ."
+    result = exec_cmd(cmd,
+        description="Building container image using ACR Tasks",
+        cwd=context_dir)
+    exit_on_error(result)
+
+# BuildKit builder that ez creates on the build host. It uses the
+# docker-container driver, which keeps the RUN --mount=type=cache caches
+# between builds and can export build cache to a registry.
+BUILDER_NAME = "ez"
+
+def buildkit_script(ez: Ez, image: str, push: bool) -> str:
+    """Shell script that builds image from the current directory with
+    BuildKit. Images that are pushed go to the workspace's registry and
+    import and export their build cache from it; other images are loaded
+    into the build host's Docker."""
+    script = (f"docker buildx inspect {BUILDER_NAME} > /dev/null 2>&1 || "
+        f"docker buildx create --name {BUILDER_NAME} "
+        "--driver docker-container > /dev/null\n")
+    build = f"docker buildx build --builder {BUILDER_NAME}"
+    if push:
+        registry = f"{ez.registry_name}.azurecr.io"
+        cache = f"{registry}/{ez.workspace_name}:buildcache"
+        build += (f" --tag {registry}/{image} --push"
+            f" --cache-from type=registry,ref={cache}"
+            f" --cache-to type=registry,ref={cache},mode=max")
+    else:
+        build += f" --tag {image} --load"
+    return script + build + " .\n"
+
+def build_image_buildkit(ez: Ez, context_dir: str, image: str, 
+    uri: str=None, push: bool=False, force: bool=False) -> None:
+    """Build image from context_dir with BuildKit on this machine, or on
+    the compute at uri
+
+    Args:
+        ez (Ez): workspace
+        context_dir (str): local build context directory
+        image (str): content-addressed name of the image
+        uri (str, optional): compute to build on, None to build locally
+        push (bool, optional): push the image to the workspace's registry
+        force (bool, optional): build even if the image exists
+    """
+    if not force:
+        if push:
+            exists = acr_image_exists(ez, image)
+        else:
+            result = exec_cmd(f"docker image inspect {image}", uri=uri,
+                private_key_path=ez.private_key_path,
+                description=f"Checking if {image} exists")
+            exists = result.exit_code == 0
+        if exists:
+            printf(f"Skipping build, {image} already exists", indent=2)
+            return
+
+    script = buildkit_script(ez, image, push)
+    if uri is None:
+        if push:
+            result = exec_cmd(f"az acr login --name {ez.registry_name}",
+                description=f"Logging in to {ez.registry_name}")
+            exit_on_error(result)
+        result = exec_cmd(script, 
+            description="Building container image using BuildKit",
+            cwd=context_dir)
+        exit_on_error(result)
+        return
+
+    # Copy the build context to the compute. The compute logs in to the
+    # registry when ACR is enabled on it.
+    tag = image.split(":")[-1]
+    remote_dir = f"/home/{ez.user_name}/.ez/build/{tag}"
+    with open_connection(uri, ez.private_key_path, compress=True) as c:
+        copies = plan_upload(c.sftp(), [f"{context_dir}/*"], f"{remote_dir}/")
+        copy_files(c, copies, upload=True)
+    result = exec_cmd(f"cd {shlex.quote(remote_dir)} && {script}", uri=uri,
+        private_key_path=ez.private_key_path,
+        description="Building container image using BuildKit on the compute")
+    exit_on_error(result)
+
+def manifest_stats(manifest: Any) -> Optional[Tuple[int, int]]:
+    """Return the compressed size and number of layers of an image
+    manifest, or None for a manifest list"""
+    if "layers" not in manifest:
+        return None
+    return sum(l["size"] for l in manifest["layers"]), len(manifest["layers"])
+
+def report_image(ez: Ez, image: str, uri: str=None, 
+    pushed: bool=False) -> None:
+    """Print the size and number of layers of image, which is in the
+    workspace's registry if pushed, otherwise in Docker on uri (or this
+    machine). Smaller images with fewer layers pull faster onto computes."""
+    if pushed:
+        def show(name: str) -> Any:
+            result = exec_cmd(f"az acr manifest show --registry "
+                f"{ez.registry_name} --name {name}")
+            return json.loads(result.stdout) if result.exit_code == 0 else {}
+
+        manifest = show(image)
+        if "manifests" in manifest:
+            # BuildKit pushes an index, use the linux/amd64 image in it
+            for m in manifest["manifests"]:
+                if m.get("platform", {}).get("architecture") == "amd64":
+                    manifest = show(f"{image.split(':')[0]}@{m['digest']}")
+                    break
+        stats = manifest_stats(manifest)
+        if stats is None:
+            return
+        size, layers = stats
+        printf(f"image {image} is {format_bytes(size)} compressed in "
+            f"{layers} layers", indent=2)
+    else:
+        result = exec_cmd(f"docker image inspect --format "
+            "'{{.Size}} {{len .RootFS.Layers}}' " + image, uri=uri, 
+            private_key_path=ez.private_key_path)
+        if result.exit_code != 0:
+            return
+        size, layers = result.stdout.split()
+        printf(f"image {image} is {format_bytes(int(size))} in {layers} "
+            "layers", indent=2)
+
+def pull_image(ez: Ez, image: str, uri: str) -> None:
+    """Pull image from the workspace's registry onto the compute at uri so
+    that the container starts from a warm image, and report the throughput.
+    Failures are reported but not fatal as VS Code pulls the image again
+    when it starts the container."""
+    ref = f"{ez.registry_name}.azurecr.io/{image}"
+    started = time()
+    result = exec_cmd(f"docker pull {ref} | grep '^Status:' && "
+        f"docker image inspect --format '{{{{.Size}}}}' {ref}", uri=uri,
+        private_key_path=ez.private_key_path,
+        description=f"Pulling {ref}")
+    elapsed = time() - started
+    if result.exit_code != 0:
+        printf(f"Warning: could not pull {ref}: {result.stderr}", indent=2)
+        return
+
+    status, size = result.stdout.splitlines()[-2:]
+    if "up to date" in status:
+        printf(f"image {ref} is already on the compute", indent=2)
+    else:
+        throughput = int(size) / elapsed if elapsed > 0 else 0
+        printf(f"pulled {ref} ({format_bytes(int(size))}) in {elapsed:.1f}s "
+            f"at {format_bytes(throughput)}/s", indent=2)
@@ -0,0 +1,197 @@
+# Headless jobs that run a command in an environment's container
+#
+# Jobs are spooled on the compute in ~/.ez/jobs, one directory per job with
+# the runner script, the command, the log and, once the job is done, its
+# exit code. A job waits for one of the compute's job slots, which are lock
+# files that the runner holds with flock while the job's container runs, so
+# at most that many jobs run at once and queued jobs start unattended,
+# oldest first, as slots free up. Everything that describes a job is on the
+# compute, so jobs keep running and keep their status when the client
+# disconnects.
+
+import constants as C
+import secrets
+import shlex
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, List, Optional
+
+# How often queued jobs check for a free slot
+SLOT_POLL_SECONDS = 5
+
+# Exit code reported for jobs whose runner went away, e.g., when the compute
+# was restarted
+LOST_EXIT_CODE = 255
+
+@dataclass
+class JobStatus:
+    job_id: str
+    env_name: str
+    state: str
+    exit_code: Optional[int]=None
+    slot: Optional[int]=None
+    command: str=""
+
+    @property
+    def finished(self) -> bool:
+        return self.state in ["done", "lost"]
+
+    def describe(self) -> str:
+        if self.state == "done":
+            state = f"exited with {self.exit_code}"
+        elif self.state == "running":
+            state = f"running in slot {self.slot}"
+        else:
+            state = self.state
+        return f"{self.job_id} {self.env_name}: {state}: {self.command}"
+
+def new_job_id(env_name: str) -> str:
+    """Job ids sort in submission order, which is the order that queued
+    jobs start in. The random suffix keeps the ids of jobs that are queued
+    at the same time, e.g., by a sweep, apart."""
+    now = datetime.now()
+    return (f"{now:%Y%m%d-%H%M%S}-{now.microsecond // 1000:03d}-{env_name}-"
+        f"{secrets.token_hex(2)}")
+
+def container_args(devcontainer_json: Any) -> List[str]:
+    """docker run arguments that start a container configured like
+    devcontainer_json, which must use an image, without VS Code"""
+    args = ["--rm", "--init",
+        "--user", devcontainer_json["containerUser"],
+        "--workdir", devcontainer_json["workspaceFolder"],
+        "--mount", devcontainer_json["workspaceMount"]]
+    for mount in devcontainer_json["mounts"]:
+        args += ["--mount", mount]
+    return args + devcontainer_json["runArgs"] + [devcontainer_json["image"]]
+
+def __bash_array(args: List[str]) -> str:
+    return f"({' '.join(shlex.quote(arg) for arg in args)})"
+
+def job_script(job_id: str, env_name: str, command: str,
+    slot_args: List[List[str]], reserved: Optional[List[str]]=None,
+    poll_seconds: float=SLOT_POLL_SECONDS) -> str:
+    """Runner script of a job, which waits for a free slot and then runs
+    command in a container started with the docker run arguments of that
+    slot.
+
+    Args:
+        job_id (str): id of the job, from new_job_id
+        env_name (str): environment that the job runs in
+        command (str): shell command to run in the container
+        slot_args (List[List[str]]): docker run arguments, including the
+            image, of each slot
+        reserved (Optional[List[str]], optional): names of the compute resource
+            assignments that the job may use, which are kept while the job
+            is queued or running
+        poll_seconds (float, optional): how often to check for a free slot
+    """
+    cases = "\n".join(f"    {slot}) args={__bash_array(args)} ;;"
+        for slot, args in enumerate(slot_args))
+    reserved_names = " ".join(shlex.quote(name) for name in reserved or [])
+    return f"""#!/bin/bash
+jobs=~/{C.JOBS_DIR}
+dir=$jobs/{job_id}
+cd "$dir" || exit 1
+echo $$ > pid.tmp && mv pid.tmp pid
+printf '%s\\n' {shlex.quote(env_name)} > env
+printf '%s\\n' {shlex.quote(command)} > command
+printf '%s\\n' {reserved_names} > reserved
+touch log queued
+
+# Only the oldest queued job takes a slot so that jobs start in order.
+# Queued jobs whose runner is gone, e.g., after a reboot, don't hold up
+# the queue.
+take_slot() {{
+    local oldest=""
+    for queued in $(ls -d "$jobs"/*/queued 2>/dev/null | sort); do
+        if kill -0 "$(cat "$(dirname "$queued")/pid")" 2>/dev/null; then
+            oldest=$(dirname "$queued")
+            break
+        fi
+        rm -f "$queued"
+    done
+    [ "$oldest" = "$dir" ] || return 1
+    for ((slot = 0; slot < {len(slot_args)}; slot++)); do
+        exec 9>"$jobs/slot-$slot.lock"
+        flock -n 9 && return 0
+        exec 9>&-
+    done
+    return 1
+}}
+until take_slot; do sleep {poll_seconds}; done
+
+case $slot in
+{cases}
+esac
+echo $slot > slot
+rm -f queued
+docker run --name "ez-job-$RANDOM$RANDOM" "${{args[@]}}" \\
+    bash -lc "$(cat command)" >> log 2>&1 < /dev/null
+echo $? > exit_code.tmp
+mv exit_code.tmp exit_code
+rm -f reserved
+"""
+
+def submit_script(job_id: str, script: str) -> str:
+    """Shell command that spools the job and starts its runner in the
+    background. Only the runner is put in the background, as a background
+    list would hold the caller's stdout open until the job is done. The
+    command returns once the runner has written its pid, so that a job
+    that is waited on right away isn't taken for lost, and fails if the
+    runner doesn't start."""
+    job_dir = f"~/{C.JOBS_DIR}/{job_id}"
+    return (f"mkdir -p {job_dir} && cat > {job_dir}/run.sh <<'EZ_{job_id}'\n"
+        f"{script}EZ_{job_id}\n"
+        f"cd {job_dir} && {{ nohup setsid bash run.sh > /dev/null 2>&1 "
+        "< /dev/null & } && "
+        "for _ in $(seq 100); do [ -e pid ] && break; sleep 0.1; done; "
+        "[ -e pid ]")
+
+def follow_script(job_id: str) -> str:
+    """Shell command that prints the log of a job as it is written, and
+    exits with the exit code of the job when it is done"""
+    job_dir = f"~/{C.JOBS_DIR}/{job_id}"
+    return (f"cd {job_dir} 2>/dev/null || {{ echo 'No job {job_id}' >&2; "
+        f"exit {LOST_EXIT_CODE}; }}; "
+        "tail -n +1 -f log & tail=$!; "
+        "while [ ! -e exit_code ] && kill -0 $(cat pid) 2>/dev/null; "
+        "do sleep 1; done; sleep 1; kill $tail; "
+        f"exit $(cat exit_code 2>/dev/null || echo {LOST_EXIT_CODE})")
+
+def wait_script(job_id: str) -> str:
+    """Shell command that waits until a job is done and prints its exit
+    code"""
+    job_dir = f"~/{C.JOBS_DIR}/{job_id}"
+    return (f"cd {job_dir} && "
+        "while [ ! -e exit_code ] && kill -0 $(cat pid) 2>/dev/null; "
+        "do sleep 1; done; "
+        f"cat exit_code 2>/dev/null || echo {LOST_EXIT_CODE}")
+
+def status_script() -> str:
+    """Shell command that prints a tab separated line per job for
+    parse_status"""
+    return (f"cd ~/{C.JOBS_DIR} 2>/dev/null || exit 0; "
+        "for job in $(ls -d */ 2>/dev/null | sort); do job=${job%/}; "
+        "if [ -e $job/exit_code ]; then state=done; "
+        "elif ! kill -0 $(cat $job/pid 2>/dev/null) 2>/dev/null; "
+        "then state=lost; elif [ -e $job/queued ]; then state=queued; "
+        "else state=running; fi; "
+        "printf '%s\\t%s\\t%s\\t%s\\t%s\\t%s\\n' $job $state "
+        "\"$(cat $job/exit_code 2>/dev/null)\" "
+        "\"$(cat $job/slot 2>/dev/null)\" \"$(cat $job/env 2>/dev/null)\" "
+        "\"$(head -1 $job/command 2>/dev/null)\"; done")
+
+def parse_status(output: str) -> List[JobStatus]:
+    jobs = []
+    for line in output.splitlines():
+        fields = line.split("\t")
+        if len(fields) != 6:
+            continue
+        job_id, state, exit_code, slot, env_name, command = fields
+        if state == "lost":
+            exit_code = str(LOST_EXIT_CODE)
+        jobs.append(JobStatus(job_id=job_id, env_name=env_name, state=state,
+            exit_code=int(exit_code) if exit_code else None,
+            slot=int(slot) if slot else None, command=command))
+    return jobs
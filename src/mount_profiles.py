@@ -0,0 +1,198 @@
+# Mount options for the workspace file share tuned for different workloads
+
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+@dataclass
+class MountProfile:
+    name: str
+    description: str
+    # Options added to the base CIFS (SMB) and NFS mount options
+    cifs_options: List[str]=field(default_factory=list)
+    nfs_options: List[str]=field(default_factory=list)
+
+# Up to 4 connections to the share: SMB multichannel for CIFS (premium
+# shares, Linux 5.5+) and nconnect for NFS
+PROFILES = {
+    "throughput": MountProfile("throughput",
+        "Large sequential reads and writes, e.g., checkpoints and archives",
+        cifs_options=["multichannel", "max_channels=4", "cache=strict",
+            "actimeo=30", "rsize=1048576", "wsize=1048576"],
+        nfs_options=["nconnect=4", "actimeo=30", "rsize=1048576",
+            "wsize=1048576"]),
+    "metadata-heavy": MountProfile("metadata-heavy",
+        "Many small files, e.g., source trees and image folders",
+        cifs_options=["multichannel", "max_channels=4", "cache=strict",
+            "actimeo=60"],
+        nfs_options=["nconnect=4", "actimeo=60"]),
+    "read-only-dataset": MountProfile("read-only-dataset",
+        "Datasets that don't change while mounted. Caches data and "
+        "attributes aggressively",
+        cifs_options=["ro", "multichannel", "max_channels=4", "cache=loose",
+            "actimeo=3600"],
+        nfs_options=["ro", "nconnect=4", "actimeo=3600", "nocto"]),
+}
+
+DEFAULT_PROFILE = "throughput"
+
+def share_source(account: str, share: str, protocol: str="SMB") -> str:
+    """What to mount for the share: //host/share or host:/account/share"""
+    host = f"{account}.file.core.windows.net"
+    if protocol == "NFS":
+        return f"{host}:/{account}/{share}"
+    return f"//{host}/{share}"
+
+def mount_options(account: str, profile: str, protocol: str="SMB",
+    credentials: Optional[List[str]]=None, uid: str="",
+    cache: bool=False) -> List[str]:
+    """Mount options for the share with the options of profile. credentials
+    are the options that authenticate SMB mounts."""
+    mount_profile = PROFILES[profile]
+    fsc = ["fsc"] if cache else []
+    if protocol == "NFS":
+        return (["vers=4", "minorversion=1", "sec=sys"] +
+            mount_profile.nfs_options + fsc)
+    return ((credentials or []) + ["serverino", f"uid={uid}", "file_mode=0777",
+        "dir_mode=0777"] + mount_profile.cifs_options + fsc)
+
+def mount_command(account: str, share: str, mount_path: str, profile: str,
+    protocol: str="SMB", key: str="", uid: str="", cache: bool=False) -> str:
+    """Return the command that mounts the share with the options of profile
+
+    Args:
+        account (str): storage account name
+        share (str): file share name
+        mount_path (str): where to mount the share
+        profile (str): name of the mount profile
+        protocol (str, optional): SMB or NFS (NFS 4.1 shares on premium
+            storage accounts)
+        key (str, optional): storage account key for SMB
+        uid (str, optional): user that owns the files for SMB
+        cache (bool, optional): cache reads on the local disk with FS-Cache
+            (fsc), which needs cachefilesd running on the compute
+
+    Returns:
+        str: mount command
+    """
+    fs_type = "nfs" if protocol == "NFS" else "cifs"
+    options = mount_options(account, profile, protocol,
+        [f"username={account}", f"password={key}"], uid, cache)
+    source = share_source(account, share, protocol)
+    return (f"sudo mount -t {fs_type} {source} {mount_path} "
+        f"-o {','.join(options)}")
+
+def automount_script(account: str, share: str, mount_path: str,
+    profile: str, protocol: str="SMB", key: str="", uid: str="",
+    cache: bool=False) -> str:
+    """Return a script, run as root, that makes systemd mount the share at
+    mount_path on first access, including after reboots
+
+    The storage account key is kept in a credentials file that only root
+    can read instead of in the mount options. The script ends by accessing
+    mount_path, so that it fails if the share can't be mounted.
+    """
+    fs_type = "nfs" if protocol == "NFS" else "cifs"
+    credentials_path = f"/etc/smbcredentials/{account}.cred"
+    credentials = ([] if protocol == "NFS" else
+        [f"credentials={credentials_path}"])
+    options = mount_options(account, profile, protocol, credentials, uid,
+        cache) + ["_netdev", "nofail"]
+    lines = ["set -o errexit"]
+    if protocol != "NFS":
+        lines += [
+            "umask 077",
+            "mkdir -p /etc/smbcredentials",
+            f"cat > {credentials_path} << 'EOF'",
+            f"username={account}",
+            f"password={key}",
+            "EOF",
+            "umask 022",
+        ]
+    lines += [
+        f"unit=$(systemd-escape --path {mount_path})",
+        "cat > /etc/systemd/system/$unit.mount << 'EOF'",
+        "[Unit]",
+        "Description=ez workspace file share",
+        "Wants=network-online.target",
+        "After=network-online.target",
+        "",
+        "[Mount]",
+        f"What={share_source(account, share, protocol)}",
+        f"Where={mount_path}",
+        f"Type={fs_type}",
+        f"Options={','.join(options)}",
+        "TimeoutSec=30",
+        "EOF",
+        "cat > /etc/systemd/system/$unit.automount << 'EOF'",
+        "[Unit]",
+        "Description=Mount the ez workspace file share on first access",
+        "",
+        "[Automount]",
+        f"Where={mount_path}",
+        "",
+        "[Install]",
+        "WantedBy=multi-user.target",
+        "EOF",
+        "systemctl daemon-reload",
+        "systemctl stop $unit.automount 2> /dev/null || true",
+        f"umount {mount_path} 2> /dev/null || true",
+        "systemctl enable --now $unit.automount",
+        # Show why the mount failed, e.g., mount error(13) for a bad key
+        f"ls {mount_path} > /dev/null || "
+        "{ journalctl -u $unit.mount -n 20 --no-pager >&2; exit 1; }",
+    ]
+    return "\n".join(lines) + "\n"
+
+def remove_automount_script(mount_path: str) -> str:
+    """Return a script, run as root, that removes the automount of
+    mount_path created by automount_script"""
+    return "\n".join([
+        f"unit=$(systemd-escape --path {mount_path})",
+        "systemctl disable --now $unit.automount 2> /dev/null || true",
+        f"umount {mount_path} 2> /dev/null || true",
+        "rm -f /etc/systemd/system/$unit.automount "
+        "/etc/systemd/system/$unit.mount",
+        "systemctl daemon-reload",
+    ]) + "\n"
+
+# Run on the compute with python3 - <dir>. Creates the test files in the
+# share on the first run, then drops the page cache and measures the read
+# throughput of a large file and the rate of stat + read of small files.
+BENCH_SCRIPT = """
+import os, sys, time
+root = sys.argv[1]
+big = os.path.join(root, "big.bin")
+small = os.path.join(root, "small")
+if not os.path.exists(big):
+    os.makedirs(small, exist_ok=True)
+    with open(big + ".tmp", "wb") as f:
+        for _ in range(256):
+            f.write(os.urandom(1024 * 1024))
+    os.replace(big + ".tmp", big)
+    for i in range(1000):
+        with open(os.path.join(small, str(i)), "wb") as f:
+            f.write(os.urandom(4096))
+os.system("sync; echo 3 | sudo tee /proc/sys/vm/drop_caches > /dev/null")
+start = time.time()
+with open(big, "rb") as f:
+    while f.read(4 * 1024 * 1024):
+        pass
+read_seconds = time.time() - start
+start = time.time()
+names = os.listdir(small)
+for name in names:
+    path = os.path.join(small, name)
+    os.stat(path)
+    with open(path, "rb") as f:
+        f.read()
+ops_seconds = time.time() - start
+print(os.path.getsize(big) / read_seconds, 2 * len(names) / ops_seconds)
+"""
+
+def bench_command(directory: str) -> str:
+    return f"python3 - {directory} << 'EOF'\n{BENCH_SCRIPT}\nEOF"
+
+def parse_bench(stdout: str) -> Tuple[float, float]:
+    """Return the read throughput in bytes/s and metadata ops/s"""
+    throughput, ops = stdout.strip().splitlines()[-1].split()
+    return float(throughput), float(ops)
@@ -0,0 +1,167 @@
+# Run a graph of dependent stages concurrently
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from exec import progress_disabled
+from formatting import format_output_string, printf
+from rich.progress import (Progress, SpinnerColumn, TextColumn,
+    TimeElapsedColumn)
+from time import time
+from typing import Any, Callable, Dict, List, Set
+
+@dataclass
+class Stage:
+    name: str
+    description: str
+    # Called with the results of the stages completed so far, keyed by
+    # stage name
+    func: Callable[[Dict[str, Any]], Any]
+    depends_on: List[str]=field(default_factory=list)
+
+def check_stages(stages: List[Stage]) -> None:
+    """Validate that the stage graph can be run
+
+    Raises:
+        ValueError: if names are duplicated, a dependency doesn't exist or
+        the dependencies contain a cycle
+    """
+    names = set()
+    for stage in stages:
+        if stage.name in names:
+            raise ValueError(f"duplicate stage {stage.name}")
+        names.add(stage.name)
+    for stage in stages:
+        for dependency in stage.depends_on:
+            if dependency not in names:
+                raise ValueError(f"stage {stage.name} depends on unknown "
+                    f"stage {dependency}")
+
+    # Repeatedly remove stages whose dependencies are all removed
+    remaining = { stage.name: set(stage.depends_on) for stage in stages }
+    while len(remaining) > 0:
+        ready = [name for name, deps in remaining.items()
+            if len(deps & remaining.keys()) == 0]
+        if len(ready) == 0:
+            raise ValueError("stage dependencies contain a cycle: "
+                f"{', '.join(remaining.keys())}")
+        for name in ready:
+            del remaining[name]
+
+def scope_results(results: Dict[str, Any], scope: str) -> Dict[str, Any]:
+    """Results of the stages of scope, and of the shared stages, keyed by
+    the names that the stages had before scope_stages"""
+    prefix = f"{scope}/"
+    return { **{ name: result for name, result in results.items()
+        if "/" not in name }, **{ name[len(prefix):]: result
+        for name, result in results.items() if name.startswith(prefix) } }
+
+def scope_stages(stages: List[Stage], scope: str,
+    shared: Set[str]) -> List[Stage]:
+    """Name stages after scope, e.g., a compute, so that the stages of
+    several scopes run as one graph. Stages in shared keep their names, so
+    that they run once for all of the scopes, and the stages see the
+    results by their own names."""
+    def scoped(name: str) -> str:
+        return name if name in shared else f"{scope}/{name}"
+
+    def describe(stage: Stage) -> str:
+        if stage.name in shared or scope in stage.description:
+            return stage.description
+        return f"{stage.description} on {scope}"
+
+    return [Stage(scoped(stage.name), describe(stage),
+        lambda r, func=stage.func: func(scope_results(r, scope)),
+        [scoped(d) for d in stage.depends_on]) for stage in stages]
+
+def critical_path(stages: List[Stage], timings: Dict[str, float]) -> float:
+    """Return the duration of the longest chain of dependent stages, which
+    is the shortest possible time to run all stages"""
+    finish = {}
+    def finish_time(stage: Stage) -> float:
+        if stage.name not in finish:
+            by_name = { s.name: s for s in stages }
+            start = max([finish_time(by_name[d]) for d in stage.depends_on],
+                default=0)
+            finish[stage.name] = start + timings.get(stage.name, 0)
+        return finish[stage.name]
+    return max([finish_time(stage) for stage in stages], default=0)
+
+def run_stages(stages: List[Stage], description: str,
+    max_workers: int=8) -> Dict[str, Any]:
+    """Run stages, starting each stage as soon as the stages that it depends
+    on have completed
+
+    Shows a single progress display with a line per stage and prints the
+    time taken by each stage when done. Per-command progress displays are
+    turned off while the stages run as they can't be nested.
+
+    Args:
+        stages (List[Stage]): stages to run
+        description (str): description of the overall task
+        max_workers (int, optional): maximum number of concurrent stages
+
+    Returns:
+        Dict[str, Any]: results of each stage keyed by stage name
+
+    Raises:
+        The first exception (including SystemExit from exit_on_error) raised
+        by a stage. Stages that haven't started yet are not run.
+    """
+    check_stages(stages)
+    results = {}
+    timings = {}
+    started = time()
+
+    with Progress(
+        SpinnerColumn(),
+        TextColumn("[progress.description]{task.description}"),
+        TimeElapsedColumn(),
+    ) as progress, progress_disabled(), ThreadPoolExecutor(
+        max_workers=max_workers) as executor:
+
+        overall_task = progress.add_task(format_output_string(description))
+
+        def run(stage: Stage, task_id: Any) -> Any:
+            stage_started = time()
+            progress.start_task(task_id)
+            result = stage.func(results)
+            timings[stage.name] = time() - stage_started
+            progress.update(task_id, completed=100,
+                description=format_output_string(
+                f"Completed: {stage.description}", indent=2))
+            return result
+
+        pending = list(stages)
+        running = {}
+        while len(pending) > 0 or len(running) > 0:
+            for stage in list(pending):
+                if all(d in results for d in stage.depends_on):
+                    pending.remove(stage)
+                    task_id = progress.add_task(format_output_string(
+                        f"Running: {stage.description}", indent=2),
+                        start=False)
+                    future = executor.submit(run, stage, task_id)
+                    running[future] = stage
+
+            done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    results[stage.name] = future.result()
+                except BaseException:
+                    # Let the stages that are already running finish but
+                    # don't start any new ones
+                    pending.clear()
+                    wait(running.keys())
+                    raise
+
+        progress.update(overall_task, completed=100,
+            description=format_output_string(f"Completed: {description}"))
+
+    total = time() - started
+    for stage in stages:
+        printf(f"timing: {stage.description} {timings[stage.name]:.1f}s",
+            indent=2)
+    printf(f"timing: total {total:.1f}s (longest chain of stages "
+        f"{critical_path(stages, timings):.1f}s)", indent=2)
+    return results
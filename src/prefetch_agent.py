@@ -0,0 +1,174 @@
+# Dataset prefetch agent
+#
+# This module is copied to the compute and run there with python3 to copy
+# files from the workspace file share to the local disk. It must only depend
+# on the Python standard library.
+#
+# Files are split into parts that are copied concurrently, so that both
+# many small files and a few large files keep many reads in flight against
+# the share. Each part is verified by reading the copy back from disk and
+# comparing its sha256 with the sha256 of the data read from the share.
+
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+PART_SIZE = 64 * 1024 * 1024
+READ_SIZE = 4 * 1024 * 1024
+
+# Suffix of the files that are being copied. They are renamed when all of
+# their parts are copied and verified.
+TMP_SUFFIX = ".ez-prefetch"
+
+def list_files(src_root, patterns):
+    """List the files under src_root that match the patterns, which are
+    relative to src_root and may use ** to match any number of directories.
+    Directories match all of the files under them. Returns a dict of
+    path -> os.stat_result"""
+    files = {}
+
+    def add(path):
+        rel = os.path.relpath(path, src_root)
+        if not rel.startswith(".."):
+            files[rel.replace(os.sep, "/")] = os.stat(path)
+
+    for pattern in patterns:
+        for match in glob.glob(os.path.join(src_root, pattern.lstrip("/")),
+            recursive=True):
+            if os.path.isdir(match):
+                for parent, _, names in os.walk(match):
+                    for name in names:
+                        add(os.path.join(parent, name))
+            elif os.path.isfile(match):
+                add(match)
+    return files
+
+def is_current(src_stat, dest):
+    """True if dest is a complete copy of a file with src_stat. Copies get
+    the modification time of the source."""
+    try:
+        dest_stat = os.stat(dest)
+    except FileNotFoundError:
+        return False
+    return (dest_stat.st_size == src_stat.st_size and
+        dest_stat.st_mtime_ns == src_stat.st_mtime_ns)
+
+def read_hash(path, offset, length):
+    part_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        f.seek(offset)
+        remaining = length
+        while remaining > 0:
+            data = f.read(min(READ_SIZE, remaining))
+            if not data:
+                break
+            part_hash.update(data)
+            remaining -= len(data)
+    return part_hash.hexdigest()
+
+def copy_part(src, tmp, offset, length):
+    """Copy length bytes at offset of src into tmp and verify the copy
+
+    Returns:
+        bool: True if the data read back from tmp matches the source
+    """
+    src_hash = hashlib.sha256()
+    with open(src, "rb") as fin, open(tmp, "r+b") as fout:
+        fin.seek(offset)
+        fout.seek(offset)
+        remaining = length
+        while remaining > 0:
+            data = fin.read(min(READ_SIZE, remaining))
+            if not data:
+                # The source shrank while it was being copied
+                return False
+            src_hash.update(data)
+            fout.write(data)
+            remaining -= len(data)
+        fout.flush()
+        os.fsync(fout.fileno())
+        # Read the copy back from the disk rather than the page cache
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fout.fileno(), offset, length,
+                os.POSIX_FADV_DONTNEED)
+    return read_hash(tmp, offset, length) == src_hash.hexdigest()
+
+def copy_files(src_root, dest_root, files, jobs):
+    """Copy files (path -> os.stat_result) from src_root to dest_root
+
+    Returns:
+        list: paths that could not be copied
+    """
+    parts = []
+    for path, st in files.items():
+        dest = os.path.join(dest_root, path)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with open(dest + TMP_SUFFIX, "wb") as f:
+            f.truncate(st.st_size)
+        for offset in range(0, max(st.st_size, 1), PART_SIZE):
+            parts.append((path, offset, min(PART_SIZE, st.st_size - offset)))
+
+    def copy(part):
+        path, offset, length = part
+        try:
+            return copy_part(os.path.join(src_root, path),
+                os.path.join(dest_root, path) + TMP_SUFFIX, offset, length)
+        except OSError:
+            return False
+
+    failed = set()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for part, ok in zip(parts, executor.map(copy, parts)):
+            if not ok:
+                failed.add(part[0])
+
+    for path, st in files.items():
+        dest = os.path.join(dest_root, path)
+        if path in failed:
+            os.remove(dest + TMP_SUFFIX)
+        else:
+            os.utime(dest + TMP_SUFFIX, ns=(st.st_atime_ns, st.st_mtime_ns))
+            os.replace(dest + TMP_SUFFIX, dest)
+    return sorted(failed)
+
+def prefetch(src_root, dest_root, patterns, jobs=16):
+    """Copy the files under src_root that match patterns to the same paths
+    under dest_root, skipping files that were already copied. Files that
+    fail to copy or verify are retried once.
+
+    Returns:
+        dict: files matched, skipped, bytes copied, seconds and failed paths
+    """
+    started = time.time()
+    files = list_files(src_root, patterns)
+    pending = { path: st for path, st in files.items()
+        if not is_current(st, os.path.join(dest_root, path)) }
+    failed = copy_files(src_root, dest_root, pending, jobs)
+    if len(failed) > 0:
+        failed = copy_files(src_root, dest_root,
+            { path: pending[path] for path in failed }, jobs)
+    return {
+        "files": len(files),
+        "skipped": len(files) - len(pending),
+        "bytes": sum(st.st_size for path, st in pending.items()
+            if path not in failed),
+        "seconds": time.time() - started,
+        "failed": failed,
+    }
+
+def main(argv):
+    if len(argv) < 5:
+        print("usage: prefetch_agent.py SRC_ROOT DEST_ROOT JOBS PATTERN...",
+            file=sys.stderr)
+        return 1
+    src_root, dest_root, jobs = argv[1], argv[2], int(argv[3])
+    print(json.dumps(prefetch(src_root, dest_root, argv[4:], jobs)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
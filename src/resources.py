@@ -0,0 +1,125 @@
+# Size container resources from the capabilities of the compute
+
+import os
+import subprocess
+
+from dataclasses import dataclass, field
+from size_catalog import VmSize
+from typing import Any, Dict, List, Tuple
+
+# Resources left for the host OS, Docker and the VS Code server
+HOST_RESERVED_CORES = 1
+HOST_RESERVED_MEMORY_GB = 2
+
+# Fraction of RAM available as /dev/shm. PyTorch DataLoader workers pass
+# batches through shared memory, and Docker's default of 64MB makes them
+# crash or fall back to slow paths.
+SHM_FRACTION = 0.25
+
+# Limits recommended for deep learning containers: pinned memory for fast
+# host to GPU copies, large stacks and many open files for data loaders
+DEFAULT_ULIMITS = {
+    "memlock": "-1",
+    "stack": "67108864",
+    "nofile": "65536:65536",
+}
+
+@dataclass
+class ContainerResources:
+    shm_size: str=""
+    cpus: str=""
+    memory: str=""
+    ulimits: Dict[str, str]=field(default_factory=dict)
+
+    def run_args(self) -> List[str]:
+        """docker run arguments for the resources"""
+        args = []
+        if self.shm_size:
+            args.append(f"--shm-size={self.shm_size}")
+        if self.cpus:
+            args.append(f"--cpus={self.cpus}")
+        if self.memory:
+            args.append(f"--memory={self.memory}")
+        for name, value in self.ulimits.items():
+            args.append(f"--ulimit={name}={value}")
+        return args
+
+    def describe(self) -> str:
+        parts = []
+        if self.shm_size:
+            parts.append(f"shm-size {self.shm_size}")
+        if self.cpus:
+            parts.append(f"{self.cpus} cpus")
+        if self.memory:
+            parts.append(f"{self.memory} memory")
+        if self.ulimits:
+            parts.append("ulimits " + " ".join(f"{name}={value}"
+                for name, value in self.ulimits.items()))
+        return ", ".join(parts) if parts else "docker defaults"
+
+def allocatable(info: VmSize) -> Tuple[int, int]:
+    """Cores and GB of memory of the compute left for containers"""
+    cores = max(1, info.cores - HOST_RESERVED_CORES)
+    memory_gb = max(1, int(info.memory_gb - max(HOST_RESERVED_MEMORY_GB,
+        info.memory_gb * 0.1)))
+    return cores, memory_gb
+
+def size_resources(info: VmSize, overrides: Dict[str, Any]=None,
+    reserve_host: bool=True) -> ContainerResources:
+    """Size the container for a compute with the capabilities in info
+
+    Args:
+        info (VmSize): capabilities of the compute
+        overrides (Dict[str, Any], optional): the resources object from
+            ez.json, with any of shm_size, cpus, memory (e.g., "16g") and
+            ulimits (e.g., {"nofile": "1024:1024"}) to use instead of the
+            computed values
+        reserve_host (bool, optional): leave cores and memory for the host.
+            False when info describes the share of a compute assigned to
+            the container, which already excludes them.
+
+    Returns:
+        ContainerResources: resources for the container
+    """
+    resources = ContainerResources(ulimits=dict(DEFAULT_ULIMITS))
+    if info.is_known:
+        if reserve_host:
+            cores, memory_gb = allocatable(info)
+        else:
+            cores, memory_gb = info.cores, int(info.memory_gb)
+        resources.cpus = str(cores)
+        resources.memory = f"{memory_gb}g"
+        resources.shm_size = f"{max(1, int(info.memory_gb * SHM_FRACTION))}g"
+
+    overrides = overrides or {}
+    for name in ["shm_size", "cpus", "memory"]:
+        if name in overrides:
+            setattr(resources, name, str(overrides[name]))
+    resources.ulimits.update({ name: str(value) for name, value
+        in overrides.get("ulimits", {}).items() })
+    return resources
+
+def merge_run_args(run_args: List[str],
+    resource_args: List[str]) -> List[str]:
+    """Append resource_args to run_args, except for options (or ulimits)
+    that run_args already sets"""
+    def key(arg: str) -> str:
+        arg = arg.replace(" ", "=")
+        if arg.startswith("--ulimit="):
+            return arg.split("=")[1]
+        return arg.split("=")[0]
+
+    keys = { key(arg) for arg in run_args }
+    return run_args + [arg for arg in resource_args if key(arg) not in keys]
+
+def probe_local() -> VmSize:
+    """Return the cores, RAM and GPUs of this machine"""
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    try:
+        result = subprocess.run(["nvidia-smi", "-L"], capture_output=True,
+            text=True)
+        gpus = len(result.stdout.splitlines()) if result.returncode == 0 else 0
+    except FileNotFoundError:
+        gpus = 0
+    return VmSize(name="local", cores=os.cpu_count() or 1,
+        memory_gb=memory / 1024 ** 3, gpus=gpus)
@@ -0,0 +1,178 @@
+# Partition the GPUs, cores and memory of a compute between environments
+#
+# Each environment that runs on a compute is assigned GPU indices, a set of
+# cores and a memory limit that no other environment on the compute uses,
+# so that several experiments can run side by side on a large VM without
+# contending for the same devices. The assignments are kept in ez state,
+# and those of environments whose containers are no longer running are
+# reclaimed.
+
+import math
+
+from dataclasses import asdict, dataclass, field
+from resources import allocatable
+from size_catalog import VmSize
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+class SchedulingError(Exception):
+    pass
+
+@dataclass
+class Assignment:
+    gpus: List[int]=field(default_factory=list)
+    cpus: List[int]=field(default_factory=list)
+    memory_gb: int=0
+
+    def run_args(self) -> List[str]:
+        """docker run arguments that restrict the container to the
+        assigned GPUs and cores"""
+        args = []
+        if self.gpus:
+            # The quotes keep docker from splitting the device list
+            devices = ",".join(str(gpu) for gpu in self.gpus)
+            args.append(f"--gpus=\"device={devices}\"")
+        if self.cpus:
+            args.append(f"--cpuset-cpus={format_cpuset(self.cpus)}")
+        return args
+
+    def size(self, name: str) -> VmSize:
+        """The share of the compute as a VmSize, to size the container
+        resources from"""
+        return VmSize(name=name, cores=len(self.cpus),
+            memory_gb=self.memory_gb, gpus=len(self.gpus))
+
+    def describe(self) -> str:
+        gpus = (f"GPUs {','.join(str(gpu) for gpu in self.gpus)}"
+            if self.gpus else "no GPUs")
+        return (f"{gpus}, cores {format_cpuset(self.cpus)}, "
+            f"{self.memory_gb}GB memory")
+
+def format_cpuset(cpus: List[int]) -> str:
+    """Format core indices as a cpuset list, e.g., 0-3,8"""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(start) if start == end else f"{start}-{end}"
+        for start, end in ranges)
+
+def load_assignments(compute: Dict[str, Any]) -> Dict[str, Assignment]:
+    """Assignments recorded in the ez state of a compute"""
+    return { env: Assignment(**assignment) for env, assignment
+        in compute.get("assignments", {}).items() }
+
+def save_assignments(compute: Dict[str, Any],
+    assignments: Dict[str, Assignment]) -> None:
+    compute["assignments"] = { env: asdict(assignment) for env, assignment
+        in sorted(assignments.items()) }
+
+def reclaim(assignments: Dict[str, Assignment], running: Set[str],
+    keep: Set[str]) -> List[str]:
+    """Remove the assignments of environments that aren't in running or
+    keep
+
+    Returns:
+        List[str]: environments whose assignments were removed
+    """
+    stale = sorted(env for env in assignments
+        if env not in running and env not in keep)
+    for env in stale:
+        del assignments[env]
+    return stale
+
+def env_request(info: VmSize, ez_json: Any) -> Tuple[int, Optional[int]]:
+    """Number of GPUs and cores that an environment asks for
+
+    The resources object in ez.json can set gpus (a number or "all") and
+    cpus. Otherwise environments that require a GPU get one GPU, and the
+    number of cores is decided by assign.
+    """
+    resources = ez_json.get("resources") or {}
+    if "gpus" in resources:
+        gpus = (info.gpus if resources["gpus"] == "all"
+            else int(resources["gpus"]))
+    elif ez_json.get("requires_gpu", False) and info.gpus > 0:
+        gpus = 1
+    else:
+        gpus = 0
+    cpus = (math.ceil(float(resources["cpus"])) if "cpus" in resources
+        else None)
+    return gpus, cpus
+
+def __pick_cpus(free: List[int], count: int) -> List[int]:
+    """Pick count of the free cores, preferring a contiguous range, which
+    keeps an environment's cores on the same NUMA node on large VMs"""
+    for i in range(len(free) - count + 1):
+        if free[i + count - 1] - free[i] == count - 1:
+            return free[i:i + count]
+    return free[:count]
+
+def assign(info: VmSize, assignments: Dict[str, Assignment], env_name: str,
+    gpus: int, cpus: Optional[int]=None, envs: int=1) -> Assignment:
+    """Assign GPUs, cores and memory of the compute to env_name
+
+    An existing assignment of env_name of the same size is kept, so that
+    the container configuration doesn't change. Without a cpus request,
+    environments with GPUs get the same fraction of the cores (and memory)
+    as of the GPUs. Environments without GPUs split the free cores with the
+    other environments that are being assigned, and on computes with GPUs
+    get no more than the cores of a GPU, so that other environments can
+    still start next to them. Memory is split in proportion to the cores.
+
+    Args:
+        info (VmSize): capabilities of the compute
+        assignments (Dict[str, Assignment]): assignments of the
+            environments on the compute
+        env_name (str): environment to assign resources to
+        gpus (int): number of GPUs
+        cpus (Optional[int], optional): number of cores
+        envs (int, optional): number of environments, including env_name,
+            that still have to be assigned cores from the free cores
+
+    Raises:
+        SchedulingError: if the compute doesn't have enough free resources
+
+    Returns:
+        Assignment: the resources of env_name
+    """
+    total_cores, total_memory_gb = allocatable(info)
+    if cpus is None and gpus > 0 and info.gpus > 0:
+        cpus = max(1, total_cores * gpus // info.gpus)
+
+    current = assignments.get(env_name)
+    if (current is not None and len(current.gpus) == gpus and
+        (cpus is None or len(current.cpus) == cpus)):
+        return current
+
+    others = [a for env, a in assignments.items() if env != env_name]
+    used_gpus = { gpu for a in others for gpu in a.gpus }
+    used_cpus = { cpu for a in others for cpu in a.cpus }
+    free_gpus = [gpu for gpu in range(info.gpus) if gpu not in used_gpus]
+    # The lowest cores are left to the host
+    free_cpus = [cpu for cpu in range(info.cores - total_cores, info.cores)
+        if cpu not in used_cpus]
+    free_memory_gb = total_memory_gb - sum(a.memory_gb for a in others)
+
+    if gpus > len(free_gpus):
+        raise SchedulingError(f"{env_name} needs {gpus} GPUs but "
+            f"{len(free_gpus)} of the {info.gpus} GPUs of {info.name} are "
+            "free")
+    if cpus is None:
+        cpus = len(free_cpus) // envs
+        if info.gpus > 0:
+            cpus = min(cpus, total_cores // info.gpus)
+        cpus = max(1, cpus)
+    if cpus < 1 or cpus > len(free_cpus):
+        raise SchedulingError(f"{env_name} needs {max(cpus, 1)} cores but "
+            f"{len(free_cpus)} of the {total_cores} cores of {info.name} "
+            "are free")
+    memory_gb = min(free_memory_gb,
+        max(1, total_memory_gb * cpus // total_cores))
+    if memory_gb < 1:
+        raise SchedulingError(f"{env_name} needs memory but all of the "
+            f"memory of {info.name} is assigned")
+
+    return Assignment(gpus=free_gpus[:gpus],
+        cpus=__pick_cpus(free_cpus, cpus), memory_gb=memory_gb)
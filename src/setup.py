@@ -11,10 +11,29 @@ setup(
                 'ez_state',
                 'exec',
                 'formatting',
-                'azutil'],
+                'azutil',
+                'size_catalog',
+                'pipeline',
+                'sync',
+                'sync_agent',
+                'transfer',
+                'images',
+                'dockerfile',
+                'artifacts',
+                'resources',
+                'mount_profiles',
+                'data_commands',
+                'file_share',
+                'credentials',
+                'scheduler',
+                'jobs',
+                'sweep',
+                'sweep_commands',
+                'prefetch_agent'],
     install_requires=['Click', 'rich', 'fabric', 'pandas'],
     data_files=[('scripts', ['scripts/provision-cpu', 
-                             'scripts/provision-gpu'])],
+                             'scripts/provision-gpu',
+                             'scripts/ez-local-disk'])],
     entry_points='''
         [console_scripts]
         ez=ez:ez
@@ -0,0 +1,190 @@
+# Catalog of Azure VM size capabilities
+
+import constants as C
+import json
+import os
+
+from dataclasses import dataclass
+from exec import exec_cmd
+from ez_state import EzRuntime
+from typing import Any, Dict, List
+
+@dataclass
+class VmSize:
+    name: str=""
+    cores: int=0
+    memory_gb: float=0
+    gpus: int=0
+
+    # Local disks. The resource (temp) disk is mounted at /mnt by the Azure
+    # Linux images, NVMe disks are raw block devices. Both are wiped when the
+    # VM is deallocated.
+    resource_disk_gb: int=0
+    nvme_disk_gb: int=0
+
+    # Performance options that are only available on some sizes
+    ephemeral_os_disk: bool=False
+    cached_disk_gb: int=0
+    accelerated_networking: bool=False
+    hibernation: bool=False
+
+    @property
+    def is_known(self) -> bool:
+        """False if the capabilities of the size couldn't be retrieved"""
+        return self.cores > 0
+
+    @property
+    def has_local_disk(self) -> bool:
+        """True if the size has a local temp or NVMe disk"""
+        return self.resource_disk_gb > 0 or self.nvme_disk_gb > 0
+
+def parse_sku(sku: Any) -> VmSize:
+    """Convert a single entry from az vm list-skus into a VmSize
+
+    Args:
+        sku (Any): parsed JSON object for the SKU
+
+    Returns:
+        VmSize: capabilities of the SKU
+    """
+    capabilities = {}
+    for capability in sku.get("capabilities") or []:
+        capabilities[capability["name"]] = capability["value"]
+
+    def number(name: str) -> float:
+        try:
+            return float(capabilities.get(name, 0))
+        except ValueError:
+            return 0
+
+    def flag(name: str) -> bool:
+        return capabilities.get(name, "False").lower() == "true"
+
+    return VmSize(
+        name=sku["name"],
+        cores=int(number("vCPUs")),
+        memory_gb=number("MemoryGB"),
+        gpus=int(number("GPUs")),
+        resource_disk_gb=int(number("MaxResourceVolumeMB") / 1024),
+        nvme_disk_gb=int(number("NvmeDiskSizeInMiB") / 1024),
+        ephemeral_os_disk=flag("EphemeralOSDiskSupported"),
+        cached_disk_gb=int(number("CachedDiskBytes") / 1024 ** 3),
+        accelerated_networking=flag("AcceleratedNetworkingEnabled"),
+        hibernation=flag("HibernationSupported"),
+    )
+
+@dataclass
+class CreateOptions:
+    os_disk_size_gb: int=256
+    ephemeral_os_disk: bool=False
+    accelerated_networking: bool=False
+    proximity_placement_group: str=""
+    hibernation: bool=False
+
+    # Filled in by validate_create_options
+    ephemeral_os_disk_placement: str=""
+
+def validate_create_options(info: VmSize, 
+    options: CreateOptions) -> List[str]:
+    """Check that options are a valid combination for the size
+
+    Picks where the ephemeral OS disk goes: the cache disk if the OS disk
+    fits, otherwise the temp disk (which shrinks the space left for the
+    Docker data-root and scratch).
+
+    Args:
+        info (VmSize): capabilities of the size
+        options (CreateOptions): requested options, updated in place
+
+    Returns:
+        List[str]: errors, empty if the combination is valid
+    """
+    errors = []
+
+    # Let Azure decide if we don't know anything about the size
+    if not info.is_known:
+        return errors
+
+    if options.ephemeral_os_disk:
+        if not info.ephemeral_os_disk:
+            errors.append(f"{info.name} does not support ephemeral OS disks")
+        elif info.cached_disk_gb >= options.os_disk_size_gb:
+            options.ephemeral_os_disk_placement = "CacheDisk"
+        elif info.resource_disk_gb >= options.os_disk_size_gb:
+            options.ephemeral_os_disk_placement = "ResourceDisk"
+        else:
+            largest = max(info.cached_disk_gb, info.resource_disk_gb)
+            errors.append(f"{options.os_disk_size_gb}GB OS disk does not "
+                f"fit on the {largest}GB local disk of {info.name} for an "
+                "ephemeral OS disk. Use a smaller --os-disk-size")
+
+    if options.accelerated_networking and not info.accelerated_networking:
+        errors.append(f"{info.name} does not support accelerated networking")
+
+    if options.hibernation:
+        if not info.hibernation:
+            errors.append(f"{info.name} does not support hibernation")
+        if options.ephemeral_os_disk:
+            errors.append("Hibernation needs a managed OS disk and cannot "
+                "be used with an ephemeral OS disk")
+
+    return errors
+
+def __load_cache() -> Dict[str, Dict[str, Any]]:
+    path = os.path.expanduser(C.SIZE_CATALOG_CACHE)
+    if os.path.exists(path):
+        try:
+            with open(path, "rt") as f:
+                return json.load(f)
+        except json.decoder.JSONDecodeError:
+            pass
+    return {}
+
+def __save_cache(cache: Dict[str, Dict[str, Any]]) -> None:
+    path = os.path.expanduser(C.SIZE_CATALOG_CACHE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(cache, f)
+
+def get_vm_size_info(runtime: EzRuntime, vm_size: str) -> VmSize:
+    """Return the capabilities of vm_size in the current workspace region
+
+    SKU capabilities don't change, so the result of the (slow) az vm
+    list-skus query is cached in ~/.ez/size_catalog.json. Unknown sizes
+    return a VmSize with no capabilities.
+
+    Args:
+        runtime (EzRuntime): ez runtime
+        vm_size (str): Azure VM size, e.g., Standard_NC6s_v3
+
+    Returns:
+        VmSize: capabilities of vm_size
+    """
+    vm_size = vm_size.strip()
+    if vm_size == "" or vm_size == ".":
+        return VmSize(name=vm_size)
+
+    ez = runtime.current()
+    cache = __load_cache()
+    region_cache = cache.setdefault(ez.region, {})
+    # Entries cached by an older ez are missing newer capabilities
+    entry = region_cache.get(vm_size)
+    if entry is not None and set(VmSize.__dataclass_fields__) <= set(entry):
+        return VmSize(**entry)
+
+    cmd = (f"az vm list-skus --location {ez.region} --size {vm_size} "
+        f"--resource-type virtualMachines --output json")
+    result = exec_cmd(cmd,
+        description=f"Querying capabilities of {vm_size}")
+    if result.exit_code != 0:
+        runtime.debug_print(f"RESULT: {result.stderr}")
+        return VmSize(name=vm_size)
+
+    # --size is a partial match, so look for the exact size name
+    for sku in json.loads(result.stdout):
+        if sku["name"] == vm_size:
+            info = parse_sku(sku)
+            region_cache[vm_size] = info.__dict__
+            __save_cache(cache)
+            return info
+    return VmSize(name=vm_size)
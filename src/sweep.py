@@ -0,0 +1,179 @@
+# Parameter sweeps: expand a parameter grid into trials and run them on the
+# job slots of several computes
+#
+# Trials are dealt round robin to a queue per compute. Each slot of a
+# compute takes trials from the front of its compute's queue and, when it
+# is empty, steals from the back of the longest queue of another compute, so
+# computes that finish early take over the work of slower ones and the
+# sweep ends at about the same time on every compute. A failed trial is
+# queued again on another compute that it hasn't failed on, to get past
+# problems of a single compute such as a bad GPU or a full disk.
+
+import itertools
+import random
+import re
+import threading
+
+from collections import deque
+from dataclasses import dataclass, field
+from time import time
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+@dataclass
+class Trial:
+    index: int
+    params: Dict[str, str]
+    # Computes that the trial ran on, in order
+    attempts: List[str]=field(default_factory=list)
+    exit_code: Optional[int]=None
+    seconds: float=0
+    metrics: Dict[str, Any]=field(default_factory=dict)
+
+    @property
+    def trial_id(self) -> str:
+        return f"trial-{self.index:04d}"
+
+    def describe(self) -> str:
+        params = " ".join(f"{name}={value}"
+            for name, value in self.params.items())
+        metrics = " ".join(f"{name}={value}"
+            for name, value in self.metrics.items()
+            if isinstance(value, (int, float, str)))
+        return (f"{self.trial_id} {params} on {self.attempts[-1]}: exited "
+            f"with {self.exit_code} in {self.seconds:.0f}s {metrics}").strip()
+
+def parse_params(specs: List[str]) -> Dict[str, List[str]]:
+    """Parse name=value1,value2 parameter specs
+
+    Raises:
+        ValueError: if a spec has no name or no values
+    """
+    params = {}
+    for spec in specs:
+        name, _, values = spec.partition("=")
+        if not re.fullmatch(r"\w+", name) or values == "":
+            raise ValueError(f"{spec} is not name=value1,value2,...")
+        params[name] = values.split(",")
+    return params
+
+def expand_grid(params: Dict[str, List[str]], samples: Optional[int]=None,
+    seed: int=0) -> List[Trial]:
+    """Trials for the combinations of the parameter values, or for samples
+    of them picked at random"""
+    names = list(params)
+    grid = [dict(zip(names, values))
+        for values in itertools.product(*params.values())]
+    if samples is not None and samples < len(grid):
+        grid = random.Random(seed).sample(grid, samples)
+    return [Trial(index=i, params=p) for i, p in enumerate(grid)]
+
+def format_command(template: str, params: Dict[str, str]) -> str:
+    """Replace the {name} placeholders of parameters in template. Other
+    braces, e.g., in Python format strings, are left as they are."""
+    return re.sub(r"\{(\w+)\}", lambda m: params.get(m.group(1), m.group(0)),
+        template)
+
+class TrialQueue:
+    """Work-stealing queue of the trials of a sweep"""
+
+    def __init__(self, trials: List[Trial], computes: List[str],
+        max_attempts: int=2):
+        self.queues: Dict[str, Deque[Trial]] = { c: deque()
+            for c in computes }
+        for i, trial in enumerate(trials):
+            self.queues[computes[i % len(computes)]].append(trial)
+        self.max_attempts = max_attempts
+        self.running = 0
+        self.finished: List[Trial] = []
+        self.__cond = threading.Condition()
+
+    def __steal(self, compute: str) -> Optional[Trial]:
+        others = sorted((q for c, q in self.queues.items() if c != compute),
+            key=len, reverse=True)
+        for queue in others:
+            for trial in reversed(queue):
+                if compute not in trial.attempts:
+                    queue.remove(trial)
+                    return trial
+        return None
+
+    def take(self, compute: str) -> Optional[Trial]:
+        """Next trial for a slot of compute. Waits while other trials run,
+        as they may fail and be queued again, and returns None when there
+        is nothing left that compute can run."""
+        with self.__cond:
+            while True:
+                queue = self.queues[compute]
+                trial = queue.popleft() if len(queue) > 0 else None
+                if trial is None:
+                    trial = self.__steal(compute)
+                if trial is not None:
+                    self.running += 1
+                    return trial
+                if self.running == 0:
+                    return None
+                self.__cond.wait()
+
+    def finish(self, trial: Trial, compute: str, exit_code: int) -> bool:
+        """Record that trial exited with exit_code on compute. Returns True
+        if the trial failed and is queued again on another compute."""
+        with self.__cond:
+            self.running -= 1
+            trial.attempts.append(compute)
+            trial.exit_code = exit_code
+            others = [c for c in self.queues if c not in trial.attempts]
+            retry = (exit_code != 0 and len(others) > 0 and
+                len(trial.attempts) < self.max_attempts)
+            if retry:
+                target = min(others, key=lambda c: len(self.queues[c]))
+                self.queues[target].appendleft(trial)
+            else:
+                self.finished.append(trial)
+            self.__cond.notify_all()
+            return retry
+
+RunTrial = Callable[[str, Trial], Tuple[int, Dict[str, Any]]]
+
+def run_sweep(trials: List[Trial], slots: Dict[str, int], run: RunTrial,
+    max_attempts: int=2,
+    on_finish: Callable[[Trial, bool], None]=None) -> List[Trial]:
+    """Run trials on the slots of each compute
+
+    Args:
+        trials (List[Trial]): trials to run
+        slots (Dict[str, int]): number of trials that run at the same time
+            on each compute
+        run (RunTrial): runs a trial on a compute, returning its exit code
+            and metrics. It is called from a thread per slot.
+        max_attempts (int, optional): times that a failing trial is run,
+            each time on a different compute
+        on_finish (Callable[[Trial, bool], None], optional): called when a
+            trial is done, with True if it will be retried
+
+    Returns:
+        List[Trial]: the trials, in order
+    """
+    queue = TrialQueue(trials, list(slots), max_attempts)
+
+    def work(compute: str):
+        while (trial := queue.take(compute)) is not None:
+            started = time()
+            try:
+                exit_code, metrics = run(compute, trial)
+            except (Exception, SystemExit) as e:
+                # ez commands exit on errors, which must not end the slot
+                # with the trial still counted as running
+                exit_code, metrics = -1, { "error": str(e) }
+            trial.seconds = time() - started
+            trial.metrics = metrics
+            retry = queue.finish(trial, compute, exit_code)
+            if on_finish is not None:
+                on_finish(trial, retry)
+
+    threads = [threading.Thread(target=work, args=(compute,), daemon=True)
+        for compute, count in slots.items() for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(queue.finished, key=lambda t: t.index)
@@ -0,0 +1,173 @@
+# Sweep command
+
+import click
+import json
+import os
+import shlex
+import threading
+
+from azutil import get_active_compute_name, get_compute_uri, get_vm_size
+from dataclasses import asdict
+from datetime import datetime
+from env_commands import prepare_job_slots, queue_job
+from exec import exec_cmd
+from ez_state import Ez, EzRuntime
+from formatting import printf, printf_err
+from jobs import wait_script
+from mount_profiles import DEFAULT_PROFILE, PROFILES
+from size_catalog import get_vm_size_info
+from sweep import Trial, expand_grid, format_command, parse_params, run_sweep
+from time import time
+from typing import Any, Dict, List, Optional, Tuple
+
+# Directory of the workspace that trials write their metrics to
+SWEEP_DIR = ".ez-sweep"
+
+def trial_command(template: List[str], sweep_id: str, trial: Trial) -> str:
+    """Command of a trial, which gets its own directory in EZ_TRIAL_DIR
+    (and the {trial_dir} placeholder) for metrics.json. The placeholders
+    are replaced in each argument of template before the arguments are
+    quoted, so parameter values are passed as they are."""
+    trial_dir = f"/workspace/{SWEEP_DIR}/{sweep_id}/{trial.trial_id}"
+    params = { **trial.params, "trial_dir": trial_dir }
+    command = shlex.join(format_command(arg, params) for arg in template)
+    return (f"export EZ_TRIAL_DIR={trial_dir}; mkdir -p $EZ_TRIAL_DIR && "
+        f"{command}")
+
+def run_trial(runtime: EzRuntime, ez: Ez, sweep_id: str, env_name: str,
+    template: List[str], slot_args: List[List[str]], compute_name: str,
+    trial: Trial) -> Tuple[int, Dict[str, Any]]:
+    """Run trial as a job on compute_name and wait for it, returning its
+    exit code and the metrics that it wrote
+
+    Raises:
+        IOError: if the job's status can't be read from the compute
+    """
+    job_id = queue_job(runtime, ez, compute_name, env_name,
+        trial_command(template, sweep_id, trial), slot_args)
+    metrics_path = (f"~/code/{env_name}/{SWEEP_DIR}/{sweep_id}/"
+        f"{trial.trial_id}/metrics.json")
+    result = exec_cmd(f"{wait_script(job_id)}; cat {metrics_path} "
+        "2>/dev/null", get_compute_uri(runtime, compute_name),
+        ez.private_key_path)
+    if result.exit_code != 0:
+        raise IOError(result.stderr)
+    exit_code, _, metrics = result.stdout.partition("\n")
+    try:
+        metrics = json.loads(metrics) if metrics else {}
+    except json.decoder.JSONDecodeError:
+        metrics = {}
+    return int(exit_code), metrics if isinstance(metrics, dict) else {}
+
+def compute_slots(runtime: EzRuntime, compute_name: str,
+    slots: Optional[int]) -> int:
+    """Number of trials that run at the same time on compute_name, one per
+    GPU unless slots is set"""
+    if slots is not None:
+        return slots
+    info = get_vm_size_info(runtime, get_vm_size(runtime, compute_name))
+    return max(1, info.gpus)
+
+@click.command()
+@click.option("--git-uri", "-g", required=True,
+    help="URI of git repo to load in the environment")
+@click.option("--name", "-n", "names", multiple=True,
+    help=("Compute to run trials on. Can be repeated (default is the "
+    "active compute)"))
+@click.option("--env-name", "-e", default="",
+    help="Environment name (default is the repo name)")
+@click.option("--param", "-p", "params", multiple=True, required=True,
+    help=("Values of a parameter as name=value1,value2. Can be repeated, "
+    "and a trial runs for each combination of the values"))
+@click.option("--samples", type=click.IntRange(min=1), default=None,
+    help="Run this many combinations picked at random instead of all")
+@click.option("--seed", type=int, default=0,
+    help="Random seed for --samples (default 0)")
+@click.option("--slots", type=click.IntRange(min=1), default=None,
+    help=("Trials that run at the same time on each compute (default is "
+    "its number of GPUs, or 1)"))
+@click.option("--retries", type=click.IntRange(min=0), default=1,
+    help=("Times that a failed trial is run again, each time on another "
+    "compute (default 1)"))
+@click.option("--mount", type=click.Choice(["local", "azure", "none"]),
+    default="none", help="Mount {local|azure|none} drive to /data")
+@click.option("--mount-profile", type=click.Choice(list(PROFILES.keys())),
+    default=DEFAULT_PROFILE,
+    help=f"Mount options for --mount azure (default {DEFAULT_PROFILE})")
+@click.option("--use-acr", is_flag=True, default=False,
+    help="Generate container using Azure Container Registry")
+@click.argument("command", nargs=-1, required=True)
+@click.pass_obj
+def sweep(runtime: EzRuntime, git_uri: str, names: List[str],
+    env_name: str, params: List[str], samples: Optional[int], seed: int,
+    slots: Optional[int], retries: int, mount: str, mount_profile: str,
+    use_acr: bool, command: List[str]):
+    """Run a command for each combination of parameter values on computes
+
+COMMAND is a template where {name} is replaced by the value of parameter
+name, e.g., ez sweep -g <repo> -n gpu1 -n gpu2 -p lr=0.1,0.01 -p bs=32,64
+-- python train.py --lr {lr} --batch-size {bs}. Trials run as ez env run
+jobs with the arguments passed as they are (use bash -c '...' for shell
+syntax), and computes that run out of trials take queued trials from the
+others. A trial can write metrics to $EZ_TRIAL_DIR/metrics.json, which are
+collected with its exit code in <sweep id>/results.json.
+    """
+    ez = runtime.current()
+    names = list(dict.fromkeys(names)) or [get_active_compute_name(runtime,
+        "")]
+    if "." in names:
+        printf_err("Sweeps run on remote computes")
+        exit(1)
+    if env_name == "":
+        env_name = git_uri.split("/")[-1]
+    try:
+        trials = expand_grid(parse_params(params), samples, seed)
+    except ValueError as e:
+        printf_err(str(e))
+        exit(1)
+    sweep_id = f"sweep-{datetime.now():%Y%m%d-%H%M%S}"
+    template = list(command)
+
+    # The computes are prepared at the same time, so adding computes doesn't
+    # add to the setup time
+    slot_args = prepare_job_slots(runtime, ez, git_uri,
+        { name: compute_slots(runtime, name, slots) for name in names },
+        env_name, use_acr, mount=mount, mount_profile=mount_profile)
+    runtime.save()
+
+    printf(f"running {len(trials)} trials of {sweep_id} on "
+        f"{sum(len(args) for args in slot_args.values())} slots of "
+        f"{', '.join(names)}")
+    lock = threading.Lock()
+    def report(trial: Trial, retry: bool):
+        with lock:
+            printf(trial.describe() +
+                (", retrying on another compute" if retry else ""), indent=2)
+
+    started = time()
+    done = run_sweep(trials,
+        { name: len(args) for name, args in slot_args.items() },
+        lambda name, trial: run_trial(runtime, ez, sweep_id, env_name,
+            template, slot_args[name], name, trial),
+        max_attempts=retries + 1, on_finish=report)
+    elapsed = time() - started
+
+    os.makedirs(sweep_id, exist_ok=True)
+    results_path = f"{sweep_id}/results.json"
+    with open(results_path, "wt") as f:
+        json.dump({
+            "command": shlex.join(template),
+            "computes": names,
+            "seconds": round(elapsed, 1),
+            "trials": [{ "trial_id": t.trial_id, **asdict(t) }
+                for t in done],
+        }, f, indent=2)
+
+    failed = [t for t in done if t.exit_code != 0]
+    per_compute = ", ".join(f"{name}: "
+        f"{sum(1 for t in done if t.attempts[-1] == name)}" for name in names)
+    printf(f"{len(done) - len(failed)} of {len(done)} trials succeeded in "
+        f"{elapsed:.0f}s ({per_compute}), results in {results_path}")
+    if len(failed) > 0:
+        printf_err(f"Failed trials: {', '.join(t.trial_id for t in failed)}")
+    exit(1 if len(failed) > 0 else 0)
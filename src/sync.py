@@ -0,0 +1,247 @@
+# Sync a local git working tree to a remote environment
+
+import io
+import json
+import os
+import shlex
+import sync_agent
+import tempfile
+import uuid
+
+from dataclasses import dataclass, field
+from fabric import Connection
+from typing import Any, Dict, List, Optional, Tuple
+
+@dataclass
+class Delta:
+    # Files to send: (path, None) sends the whole file, (path, [indices])
+    # sends only the blocks at those indices
+    files: List[Tuple[str, Optional[List[int]]]]=field(default_factory=list)
+    delete: List[str]=field(default_factory=list)
+    bytes_to_send: int=0
+
+@dataclass
+class SyncStats:
+    files: int=0
+    changed: int=0
+    deleted: int=0
+    bytes_sent: int=0
+    bytes_total: int=0
+
+def compute_delta(local: Dict[str, Any], remote: Dict[str, Any]) -> Delta:
+    """Compute what needs to be sent to make the remote tree match local
+
+    Args:
+        local (Dict[str, Any]): manifest of the local tree
+        remote (Dict[str, Any]): manifest of the remote tree
+
+    Returns:
+        Delta: files or blocks to send and files to delete. Only remote
+        files that are tracked by git are deleted, so files created by runs
+        in the remote environment are left alone.
+    """
+    delta = Delta()
+    for path, entry in sorted(local.items()):
+        remote_entry = remote.get(path)
+        if remote_entry is not None:
+            if (remote_entry["sha256"] == entry["sha256"] and
+                remote_entry["executable"] == entry["executable"]):
+                continue
+            if len(entry["blocks"]) > 0 and len(remote_entry["blocks"]) > 0:
+                changed = [i for i, block in enumerate(entry["blocks"])
+                    if i >= len(remote_entry["blocks"])
+                    or remote_entry["blocks"][i] != block]
+                delta.files.append((path, changed))
+                delta.bytes_to_send += sum(min(sync_agent.BLOCK_SIZE,
+                    entry["size"] - i * sync_agent.BLOCK_SIZE)
+                    for i in changed)
+                continue
+        delta.files.append((path, None))
+        delta.bytes_to_send += entry["size"]
+
+    delta.delete = sorted(path for path, entry in remote.items()
+        if entry["tracked"] and path not in local)
+    return delta
+
+def write_delta(local_root: str, local: Dict[str, Any], delta: Delta,
+    out: Any) -> None:
+    """Write the stream for delta that sync_agent.apply_stream applies"""
+    sync_agent.write_files(local_root, delta_header(local, delta), out)
+
+def delta_header(manifest: Dict[str, Any], delta: Delta) -> Dict[str, Any]:
+    """Return the stream header for delta, using the sizes and hashes of the
+    files in manifest"""
+    files = []
+    for path, blocks in delta.files:
+        entry = manifest[path]
+        files.append({
+            "path": path,
+            "size": entry["size"],
+            "executable": entry["executable"],
+            "sha256": entry["sha256"],
+            "blocks": blocks })
+    return { "delete": delta.delete, "files": files }
+
+def is_under(path: str, dirs: List[str]) -> bool:
+    """True if path is in one of dirs"""
+    return any(path == d or path.startswith(f"{d}/") for d in dirs)
+
+def tree_state(root: str,
+    exclude: Optional[List[str]]=None) -> Dict[str, Tuple]:
+    """Return the size, mtime and mode of the files in the working tree at
+    root. Comparing two states is a cheap way to detect edits."""
+    state = {}
+    for path in sync_agent.list_files(root):
+        if is_under(path, exclude or []):
+            continue
+        try:
+            st = os.lstat(os.path.join(root, path))
+        except FileNotFoundError:
+            continue
+        state[path] = (st.st_size, st.st_mtime_ns, st.st_mode)
+    return state
+
+class TreeSync:
+    """Pushes the local working tree to remote_root over connection
+
+    The remote tree is described by a manifest of content hashes computed by
+    sync_agent on the compute. Only files (or blocks of large files) whose
+    hashes differ are sent, in a single stream over the one SSH connection.
+    The local tree, including the git index and stash, is not modified.
+
+    outputs are directories, relative to the root of the tree, that are
+    written in the remote environment, e.g., checkpoints. They are not
+    pushed, and pull copies new and changed files in them back to the local
+    tree.
+    """
+
+    def __init__(self, connection: Connection, local_root: str,
+        remote_root: str, outputs: Optional[List[str]]=None):
+        self.connection = connection
+        self.local_root = local_root
+        self.remote_root = remote_root
+        self.outputs = [o.strip("/") for o in outputs or []]
+        self.remote_dir = f"/home/{connection.user}/.ez"
+        self.agent_path = f"{self.remote_dir}/sync_agent.py"
+        self.hash_cache = {}
+        self.output_cache = {}
+        self.remote = None
+
+    def __agent(self, *args: str) -> Any:
+        quoted = " ".join(shlex.quote(a) for a in args)
+        result = self.connection.run(f"python3 {self.agent_path} {quoted}",
+            hide="both")
+        return json.loads(result.stdout)
+
+    def start(self) -> None:
+        """Copy the agent to the compute and read the remote manifest"""
+        self.connection.run(f"mkdir -p {self.remote_dir}", hide="both")
+        self.connection.put(sync_agent.__file__, self.agent_path)
+        remote = self.__agent("manifest", self.remote_root)
+        self.remote = { path: entry for path, entry in remote.items()
+            if not is_under(path, self.outputs) }
+
+    def reset(self) -> None:
+        """Read the remote manifest again on the next push, e.g., after a
+        push failed part way"""
+        self.remote = None
+
+    def local_manifest(self) -> Dict[str, Any]:
+        files = { path: tracked for path, tracked 
+            in sync_agent.list_files(self.local_root).items()
+            if not is_under(path, self.outputs) }
+        return sync_agent.manifest(self.local_root, files, self.hash_cache)
+
+    def push(self) -> SyncStats:
+        """Make the remote tree match the local tree
+
+        Returns:
+            SyncStats: what was sent
+        """
+        if self.remote is None:
+            self.start()
+
+        local = self.local_manifest()
+        delta = compute_delta(local, self.remote)
+        stats = SyncStats(files=len(local), changed=len(delta.files),
+            deleted=len(delta.delete), bytes_sent=delta.bytes_to_send,
+            bytes_total=sum(e["size"] for e in local.values()))
+        if len(delta.files) == 0 and len(delta.delete) == 0:
+            return stats
+
+        failed = self.__send(local, delta)
+        if len(failed) > 0:
+            # The remote copy changed underneath us, send whole files
+            retry = Delta(files=[(path, None) for path in failed])
+            retry.bytes_to_send = sum(local[p]["size"] for p in failed)
+            stats.bytes_sent += retry.bytes_to_send
+            failed = self.__send(local, retry)
+            if len(failed) > 0:
+                raise IOError(f"could not sync {', '.join(failed)}")
+
+        # The remote tree now matches the local tree for everything sent
+        for path in delta.delete:
+            self.remote.pop(path, None)
+        for path, _ in delta.files:
+            self.remote[path] = local[path]
+        return stats
+
+    def pull(self) -> SyncStats:
+        """Copy new and changed files in the output directories from the
+        remote tree to the local tree. Local files are never deleted.
+
+        Returns:
+            SyncStats: what was received
+        """
+        if len(self.outputs) == 0:
+            return SyncStats()
+
+        remote = self.__agent("manifest", self.remote_root, *self.outputs)
+        files = sync_agent.list_dir_files(self.local_root, self.outputs)
+        local = sync_agent.manifest(self.local_root, files, 
+            self.output_cache)
+        delta = compute_delta(remote, local)
+        stats = SyncStats(files=len(remote), changed=len(delta.files),
+            bytes_sent=delta.bytes_to_send,
+            bytes_total=sum(e["size"] for e in remote.values()))
+        if len(delta.files) == 0:
+            return stats
+
+        failed = self.__receive(remote, delta)
+        if len(failed) > 0:
+            # The local copy changed underneath us, receive whole files
+            retry = Delta(files=[(path, None) for path in failed])
+            stats.bytes_sent += sum(remote[p]["size"] for p in failed)
+            failed = self.__receive(remote, retry)
+            if len(failed) > 0:
+                raise IOError(f"could not sync {', '.join(failed)}")
+        return stats
+
+    def __receive(self, remote: Dict[str, Any], delta: Delta) -> List[str]:
+        name = f"{self.remote_dir}/sync-{uuid.uuid4().hex}"
+        header = json.dumps(delta_header(remote, delta)).encode("utf-8")
+        self.connection.put(io.BytesIO(header), f"{name}.json")
+        self.__agent("pack", self.remote_root, f"{name}.json", 
+            f"{name}.stream")
+        with tempfile.TemporaryFile() as f:
+            self.connection.get(f"{name}.stream", f)
+            self.connection.run(f"rm -f {name}.stream", hide="both")
+            f.seek(0)
+            return sync_agent.apply_stream(self.local_root, f)
+
+    def __send(self, local: Dict[str, Any], delta: Delta) -> List[str]:
+        remote_stream = f"{self.remote_dir}/sync-{uuid.uuid4().hex}.stream"
+        with tempfile.TemporaryFile() as f:
+            write_delta(self.local_root, local, delta, f)
+            f.seek(0)
+            self.connection.put(f, remote_stream)
+        result = self.__agent("apply", self.remote_root, remote_stream)
+        return result["failed"]
+
+def format_bytes(size: float) -> str:
+    """Format size in bytes as a human readable string"""
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TB"
@@ -0,0 +1,249 @@
+# Working tree sync agent
+#
+# This module is imported by ez to compute manifests of the local working
+# tree, and is also copied to the compute and run there with python3 to
+# compute manifests of the remote tree and apply deltas. It must only depend
+# on the Python standard library.
+
+import hashlib
+import json
+import os
+import stat
+import struct
+import subprocess
+import sys
+
+# Files larger than this are hashed and transferred in blocks so that only
+# the blocks that changed are sent
+BLOCK_SIZE = 1024 * 1024
+
+# Hashes computed on the compute are kept between runs of the agent
+CACHE_DIR = "~/.ez/sync-cache"
+
+# Suffix of the temporary files that are written while applying a stream
+TMP_SUFFIX = ".ez-sync"
+
+def list_files(root, untracked=True):
+    """List the files in the git working tree at root, including untracked
+    files that are not ignored. Returns a dict of path -> True if tracked"""
+    def ls_files(*args):
+        result = subprocess.run(["git", "ls-files", "-z"] + list(args),
+            cwd=root, capture_output=True, check=True)
+        return [p for p in result.stdout.decode("utf-8").split("\0") if p]
+
+    files = { path: True for path in ls_files("--cached") }
+    if untracked:
+        for path in ls_files("--others", "--exclude-standard"):
+            files[path] = False
+    return files
+
+def list_dir_files(root, dirs):
+    """List all files under dirs (relative to root), whether or not they are
+    ignored by git. Returns a dict of path -> False (not tracked)"""
+    files = {}
+    for directory in dirs:
+        for parent, _, names in os.walk(os.path.join(root, directory)):
+            for name in names:
+                if not name.endswith(TMP_SUFFIX):
+                    path = os.path.relpath(os.path.join(parent, name), root)
+                    files[path.replace(os.sep, "/")] = False
+    return files
+
+def hash_file(path, size):
+    """Return the sha256 of the file and of each block for large files"""
+    file_hash = hashlib.sha256()
+    blocks = []
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(BLOCK_SIZE)
+            if not data:
+                break
+            file_hash.update(data)
+            if size > BLOCK_SIZE:
+                blocks.append(hashlib.sha256(data).hexdigest())
+    return file_hash.hexdigest(), blocks
+
+def manifest(root, files, cache=None):
+    """Compute the manifest of files (dict of path -> tracked) under root
+
+    Only regular files are included; deleted files and symlinks are skipped.
+    cache is an optional dict that keeps hashes keyed by path, size and
+    mtime so that unchanged files aren't hashed again. Entries for files
+    that are no longer in files are removed from cache.
+    """
+    entries = {}
+    used = {}
+    for path, tracked in files.items():
+        full_path = os.path.join(root, path)
+        try:
+            st = os.lstat(full_path)
+        except FileNotFoundError:
+            continue
+        if not stat.S_ISREG(st.st_mode):
+            continue
+        key = f"{path}\0{st.st_size}\0{st.st_mtime_ns}"
+        if cache is not None and key in cache:
+            file_hash, blocks = cache[key]
+        else:
+            file_hash, blocks = hash_file(full_path, st.st_size)
+        used[key] = (file_hash, blocks)
+        entries[path] = {
+            "size": st.st_size,
+            "executable": bool(st.st_mode & stat.S_IXUSR),
+            "sha256": file_hash,
+            "blocks": blocks,
+            "tracked": tracked,
+        }
+    if cache is not None:
+        cache.clear()
+        cache.update(used)
+    return entries
+
+def cache_path(root, dirs):
+    key = hashlib.sha1("\0".join([root] + dirs).encode("utf-8")).hexdigest()
+    return os.path.join(os.path.expanduser(CACHE_DIR), f"{key}.json")
+
+def load_cache(path):
+    try:
+        with open(path, "rt") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_cache(path, cache):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}{TMP_SUFFIX}", "wt") as f:
+        json.dump(cache, f)
+    os.replace(f"{path}{TMP_SUFFIX}", path)
+
+def write_stream(out, header, chunks):
+    """Write a stream: 8 byte header length, JSON header, then data chunks"""
+    header_bytes = json.dumps(header).encode("utf-8")
+    out.write(struct.pack(">Q", len(header_bytes)))
+    out.write(header_bytes)
+    for chunk in chunks:
+        out.write(chunk)
+
+def write_files(root, header, out):
+    """Write a stream with the data of the files in header, read from root.
+    Each entry in header["files"] has blocks set to None to send the whole
+    file or to the indices of the blocks to send"""
+    def chunks():
+        for entry in header["files"]:
+            with open(os.path.join(root, entry["path"]), "rb") as f:
+                if entry["blocks"] is None:
+                    remaining = entry["size"]
+                    while remaining > 0:
+                        data = f.read(min(remaining, BLOCK_SIZE))
+                        if not data:
+                            raise IOError(f"{entry['path']} changed while "
+                                "syncing")
+                        remaining -= len(data)
+                        yield data
+                else:
+                    for index in entry["blocks"]:
+                        offset = index * BLOCK_SIZE
+                        f.seek(offset)
+                        data = f.read(min(BLOCK_SIZE, entry["size"] - offset))
+                        if len(data) != min(BLOCK_SIZE, 
+                            entry["size"] - offset):
+                            raise IOError(f"{entry['path']} changed while "
+                                "syncing")
+                        yield data
+
+    write_stream(out, header, chunks())
+
+def read_header(stream):
+    (length,) = struct.unpack(">Q", stream.read(8))
+    return json.loads(stream.read(length).decode("utf-8"))
+
+def read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise IOError("unexpected end of stream")
+    return data
+
+def copy_exactly(stream, out, size):
+    while size > 0:
+        data = read_exactly(stream, min(size, BLOCK_SIZE))
+        out.write(data)
+        size -= len(data)
+
+def apply_stream(root, stream):
+    """Apply a delta stream to the tree at root
+
+    The header contains the files to delete and the files to write. Each
+    file either has all of its data in the stream, or only the blocks that
+    changed, which are written into a copy of the existing file. Files are
+    replaced atomically, and files whose hash doesn't match after applying
+    blocks are left untouched and returned so the sender can resend them.
+    """
+    header = read_header(stream)
+    for path in header["delete"]:
+        try:
+            os.remove(os.path.join(root, path))
+        except FileNotFoundError:
+            pass
+
+    failed = []
+    for entry in header["files"]:
+        full_path = os.path.join(root, entry["path"])
+        os.makedirs(os.path.dirname(full_path) or ".", exist_ok=True)
+        tmp_path = f"{full_path}{TMP_SUFFIX}"
+        if entry["blocks"] is None:
+            with open(tmp_path, "wb") as f:
+                copy_exactly(stream, f, entry["size"])
+        else:
+            with open(full_path, "rb") as src, open(tmp_path, "wb") as f:
+                while True:
+                    data = src.read(BLOCK_SIZE)
+                    if not data:
+                        break
+                    f.write(data)
+            with open(tmp_path, "r+b") as f:
+                for index in entry["blocks"]:
+                    offset = index * BLOCK_SIZE
+                    f.seek(offset)
+                    copy_exactly(stream, f,
+                        min(BLOCK_SIZE, entry["size"] - offset))
+                f.truncate(entry["size"])
+            if hash_file(tmp_path, 0)[0] != entry["sha256"]:
+                os.remove(tmp_path)
+                failed.append(entry["path"])
+                continue
+        mode = 0o755 if entry["executable"] else 0o644
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, full_path)
+    return failed
+
+def main(argv):
+    command, root = argv[1], argv[2]
+    if command == "manifest":
+        # With directories, list all files under them instead of the files
+        # in the git working tree
+        dirs = argv[3:]
+        files = list_dir_files(root, dirs) if dirs else list_files(root)
+        path = cache_path(root, dirs)
+        cache = load_cache(path)
+        entries = manifest(root, files, cache)
+        save_cache(path, cache)
+        print(json.dumps(entries))
+    elif command == "pack":
+        with open(argv[3], "rt") as f:
+            header = json.load(f)
+        os.remove(argv[3])
+        with open(argv[4], "wb") as out:
+            write_files(root, header, out)
+        print(json.dumps({}))
+    elif command == "apply":
+        with open(argv[3], "rb") as stream:
+            failed = apply_stream(root, stream)
+        os.remove(argv[3])
+        print(json.dumps({ "failed": failed }))
+    else:
+        print(f"unknown command {command}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,39 @@
+import json
+import os
+
+from artifacts import copy_if_changed, write_json_if_changed
+from env_commands import write_settings_json
+from ez_state import Ez
+
+def test_unchanged_json_is_not_rewritten(tmp_path):
+    path = str(tmp_path / "devcontainer.json")
+    assert write_json_if_changed(path, { "image": "ws:abc" })
+    os.utime(path, (0, 0))
+    assert not write_json_if_changed(path, { "image": "ws:abc" })
+    assert os.stat(path).st_mtime == 0
+    assert write_json_if_changed(path, { "image": "ws:def" })
+
+def test_copy_if_changed(tmp_path):
+    src = tmp_path / "requirements.txt"
+    src.write_text("numpy\n")
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    assert copy_if_changed(str(src), str(dest))
+    assert not copy_if_changed(str(src), str(dest))
+    assert (dest / "requirements.txt").read_text() == "numpy\n"
+
+def test_settings_json_keeps_other_settings(tmp_path):
+    ez = Ez(user_name="ez", region="westus2")
+    vscode_dir = tmp_path / ".vscode"
+    vscode_dir.mkdir()
+    settings = vscode_dir / "settings.json"
+    settings.write_text(json.dumps({ "editor.tabSize": 4 }))
+
+    assert write_settings_json(ez, "vm1", str(tmp_path))
+    assert json.loads(settings.read_text()) == {
+        "editor.tabSize": 4,
+        "docker.host": "ssh://ez@vm1.westus2.cloudapp.azure.com" }
+    assert not write_settings_json(ez, "vm1", str(tmp_path))
+
+    assert write_settings_json(ez, ".", str(tmp_path))
+    assert json.loads(settings.read_text()) == { "editor.tabSize": 4 }
@@ -0,0 +1,30 @@
+import credentials
+import os
+import stat
+
+from credentials import get_secret, load_credentials
+
+def test_secrets_are_cached_in_a_private_file(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    fetches = []
+    def fetch():
+        fetches.append(1)
+        return "secret"
+
+    assert get_secret("key", fetch, ttl=60) == "secret"
+    assert get_secret("key", fetch, ttl=60) == "secret"
+    assert len(fetches) == 1
+    path = tmp_path / ".ez" / "credentials.json"
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert load_credentials()["key"]["value"] == "secret"
+
+def test_expired_or_refreshed_secrets_are_fetched_again(tmp_path, 
+    monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    values = iter(["old", "new", "newer"])
+    fetch = lambda: next(values)
+
+    assert get_secret("key", fetch, ttl=60) == "old"
+    assert get_secret("key", fetch, ttl=60, refresh=True) == "new"
+    monkeypatch.setattr(credentials, "time", lambda: 10 ** 12)
+    assert get_secret("key", fetch, ttl=60) == "newer"
@@ -0,0 +1,72 @@
+from dockerfile import generate_dockerfile, pin_image
+
+BASE = "python:3.9@sha256:" + "0" * 64
+
+def stage(text, name):
+    """Return the lines of the named stage"""
+    lines = []
+    in_stage = False
+    for line in text.splitlines():
+        if line.startswith("FROM "):
+            in_stage = line.endswith(f" AS {name}")
+        elif in_stage:
+            lines.append(line)
+    return "\n".join(lines)
+
+def test_compilers_stay_in_build_stage():
+    text = generate_dockerfile(BASE, "ez", requirements=True,
+        environment=True)
+    assert f"FROM {BASE} AS base" in text
+    assert "upgrade" not in text
+    assert "build-essential" in stage(text, "build")
+    runtime = stage(text, "runtime")
+    assert "build-essential" not in runtime
+    assert "COPY --from=build --chown=1000:1000 /opt/venv /opt/venv" in runtime
+
+def test_layers_ordered_from_least_to_most_volatile():
+    text = generate_dockerfile(BASE, "ez", requirements=True,
+        environment=True)
+    assert "environment.yml" in stage(text, "conda")
+    assert "requirements.txt" in stage(text, "build")
+    runtime = stage(text, "runtime")
+    assert (runtime.index("apt-get") < runtime.index("useradd") <
+        runtime.index("/opt/ez-env") < runtime.index("/opt/venv"))
+
+def test_no_build_stage_without_packages():
+    text = generate_dockerfile(BASE, "ez")
+    assert "AS build" not in text
+    assert "--mount" not in text
+
+def test_cache_mounts():
+    text = generate_dockerfile(BASE, "ez", requirements=True,
+        cache_mounts=True)
+    assert text.startswith("# syntax=docker/dockerfile:1\n")
+    assert "RUN --mount=type=cache,target=/root/.cache/pip " in text
+
+def test_pinned_images_are_not_resolved_again():
+    assert pin_image(BASE) == BASE
+
+def test_base_image_packages_stay_visible():
+    text = generate_dockerfile(BASE, "ez", requirements=True,
+        environment=True)
+    build = stage(text, "build")
+    # The venv inherits the site-packages of the conda environment
+    assert ("RUN /opt/ez-env/bin/python -m venv --system-site-packages "
+        "--without-pip /opt/venv") in build
+    assert "/opt/venv/bin/python -m pip install" in build
+    # Only the conda environment's own prefix is copied, so the base
+    # image's /opt/conda is neither replaced nor copied again
+    assert "env create -p /opt/ez-env" in stage(text, "conda")
+    runtime = stage(text, "runtime")
+    assert "COPY --from=conda /opt/ez-env /opt/ez-env\n" in runtime
+    assert "/opt/conda" not in runtime
+
+    text = generate_dockerfile(BASE, "ez", requirements=True)
+    assert "RUN python3 -m venv --system-site-packages" in text
+
+def test_conda_environment_without_build_stage():
+    text = generate_dockerfile(BASE, "ez", environment=True)
+    assert "AS build" not in text
+    assert "build-essential" not in text
+    assert "COPY --from=conda /opt/ez-env /opt/ez-env" in stage(text,
+        "runtime")
@@ -0,0 +1,100 @@
+import env_commands
+import subprocess
+
+from env_commands import (STALE_CONTAINER, container_shell_script,
+    find_env_containers, git_cache_remote, prefetch_to_local_disk,
+    remote_repo_script)
+
+def git(*args, cwd=None):
+    result = subprocess.run(["git", "-c", "user.name=ez", "-c", 
+        "user.email=ez@example.com"] + list(args), cwd=cwd, 
+        capture_output=True, check=True)
+    return result.stdout.decode("utf-8").strip()
+
+def make_repo(path):
+    path.mkdir()
+    git("init", "-q", cwd=path)
+    (path / "README.md").write_text("hello\n")
+    git("add", ".", cwd=path)
+    git("commit", "-q", "-m", "first", cwd=path)
+
+def run_script(script):
+    return subprocess.run(["bash", "-c", script], capture_output=True)
+
+def test_remote_repo_script_clones_then_pulls(tmp_path):
+    origin = tmp_path / "origin"
+    make_repo(origin)
+    target = tmp_path / "code" / "env"
+    uri = f"file://{origin}"
+
+    result = run_script(remote_repo_script(uri, str(target), depth=1, 
+        partial=True))
+    assert result.returncode == 0
+    assert (target / "README.md").read_text() == "hello\n"
+
+    (origin / "README.md").write_text("hello again\n")
+    git("commit", "-q", "-am", "second", cwd=origin)
+    result = run_script(remote_repo_script(uri, str(target), depth=1))
+    assert result.returncode == 0
+    assert (target / "README.md").read_text() == "hello again\n"
+
+def test_git_cache_remote_is_shared_by_forks():
+    cache, remote = git_cache_remote("git@github.com:jflam/fastai.git")
+    fork_cache, fork_remote = git_cache_remote(
+        "https://github.com/someone/fastai")
+    assert cache == fork_cache == "fastai.git"
+    assert remote != fork_remote
+
+def test_remote_repo_script_uses_git_cache(tmp_path):
+    origin = tmp_path / "origin"
+    make_repo(origin)
+    cache_dir = tmp_path / "cache"
+    uri = f"file://{origin}"
+
+    for env in ["env1", "env2"]:
+        target = tmp_path / env
+        result = run_script(remote_repo_script(uri, str(target), 
+            cache_dir=str(cache_dir)))
+        assert result.returncode == 0
+        alternates = target / ".git" / "objects" / "info" / "alternates"
+        assert str(cache_dir / "origin.git") in alternates.read_text()
+        assert (target / "README.md").read_text() == "hello\n"
+
+def test_find_env_containers():
+    docker_ps = ("1a2b,vsc-ez-demo-3f2a,gallant_bell\n"
+        "3c4d,postgres:14,db\n")
+    assert find_env_containers(docker_ps, "ez-demo") == [
+        ("1a2b", "vsc-ez-demo-3f2a", "gallant_bell")]
+    assert find_env_containers(docker_ps, "other") == []
+
+def test_container_shell_script_reports_stale_container():
+    result = subprocess.run(["bash", "-c", 
+        "docker() { echo false; }; " + container_shell_script("1a2b")])
+    assert result.returncode == STALE_CONTAINER
+
+def test_find_env_containers_by_label():
+    docker_ps = ("1a2b,ezws:3f2a,gallant_bell,ez-demo\n"
+        "5e6f,ezws:9c1d,quirky_hopper,ez-demo-2\n")
+    assert find_env_containers(docker_ps, "ez-demo") == [
+        ("1a2b", "ezws:3f2a", "gallant_bell")]
+
+def test_failed_prefetch_doesnt_stop_the_env(monkeypatch):
+    def fail(error):
+        def prefetch_data(*args):
+            raise error
+        return prefetch_data
+    for error in [IOError("no disk"), SystemExit(1), RuntimeError("ssh")]:
+        monkeypatch.setattr(env_commands, "prefetch_data", fail(error))
+        assert prefetch_to_local_disk(None, None, "gpu1", ["*"]) is None
+
+def test_concurrent_clones_share_the_git_cache(tmp_path):
+    origin = tmp_path / "origin"
+    make_repo(origin)
+    scripts = [remote_repo_script(f"file://{origin}", str(tmp_path / 
+        f"env{i}"), cache_dir=str(tmp_path / "cache")) for i in range(4)]
+    clones = [subprocess.Popen(["bash", "-c", script], 
+        stderr=subprocess.PIPE) for script in scripts]
+    for clone in clones:
+        assert clone.wait() == 0, clone.stderr.read()
+    for i in range(4):
+        assert (tmp_path / f"env{i}" / "README.md").read_text() == "hello\n"
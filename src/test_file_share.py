@@ -0,0 +1,234 @@
+import base64
+import file_share
+import hashlib
+import os
+import pytest
+import threading
+import urllib.parse
+
+from file_share import (FileShareClient, FileShareError, plan_pull, plan_push,
+    pull_files, push_files, shared_key_signature)
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ACCOUNT = "devstoreaccount1"
+KEY = base64.b64encode(b"not a real key").decode("ascii")
+SHARE = "ezdata"
+
+class FakeFileService:
+    """Enough of the Azure Files REST API for FileShareClient"""
+    def __init__(self):
+        self.dirs = { "" }
+        self.files = {}
+        self.md5 = {}
+        self.etags = {}
+        self.ranges_written = 0
+        # Fail Put Range requests once this many ranges have been written
+        self.fail_after = None
+        # Statuses to reply with before handling the next requests
+        self.statuses = []
+
+def make_handler(service: FakeFileService):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, status, body=b"", headers={}):
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            if "Content-Length" not in headers:
+                self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(body)
+
+        def handle_request(self):
+            url = urllib.parse.urlsplit(self.path)
+            query = dict(urllib.parse.parse_qsl(url.query))
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if service.statuses:
+                return self.reply(service.statuses.pop(0))
+            headers = { name: value for name, value in self.headers.items()
+                if name.lower() != "authorization" }
+            signature = shared_key_signature(ACCOUNT, KEY, self.command,
+                url.path, query, headers)
+            if self.headers["Authorization"] != (
+                f"SharedKey {ACCOUNT}:{signature}"):
+                return self.reply(403)
+
+            prefix = f"/{ACCOUNT}/{SHARE}"
+            path = urllib.parse.unquote(url.path)[len(prefix):].strip("/")
+            handler = getattr(self, f"do_{self.command}_request")
+            return handler(path, query, self.headers, body)
+
+        do_GET = do_PUT = do_HEAD = handle_request
+
+        def do_PUT_request(self, path, query, headers, body):
+            if query.get("restype") == "directory":
+                if path in service.dirs:
+                    return self.reply(409)
+                service.dirs.add(path)
+                return self.reply(201)
+            if query.get("comp") == "range":
+                if (service.fail_after is not None and
+                    service.ranges_written >= service.fail_after):
+                    return self.reply(500)
+                md5 = base64.b64encode(hashlib.md5(body).digest()).decode()
+                if headers["Content-MD5"] != md5:
+                    return self.reply(400)
+                start, end = headers["x-ms-range"][6:].split("-")
+                service.files[path][int(start):int(end) + 1] = body
+                service.ranges_written += 1
+                return self.reply(201)
+            if query.get("comp") == "properties":
+                service.md5[path] = headers["x-ms-content-md5"]
+                return self.reply(200)
+            service.files[path] = bytearray(int(
+                headers["x-ms-content-length"]))
+            service.md5.pop(path, None)
+            service.etags[path] = service.etags.get(path, 0) + 1
+            return self.reply(201)
+
+        def do_HEAD_request(self, path, query, headers, body):
+            if path not in service.files:
+                return self.reply(404)
+            response = {
+                "Content-Length": str(len(service.files[path])),
+                "ETag": f"\"{service.etags[path]}\"",
+            }
+            if path in service.md5:
+                response["Content-MD5"] = service.md5[path]
+            return self.reply(200, headers=response)
+
+        def do_GET_request(self, path, query, headers, body):
+            if query.get("comp") == "list":
+                if path not in service.dirs:
+                    return self.reply(404)
+                entries = []
+                for d in sorted(service.dirs):
+                    if d and os.path.dirname(d) == path:
+                        name = os.path.basename(d)
+                        entries.append(f"<Directory><Name>{name}</Name>"
+                            "<Properties /></Directory>")
+                for f, data in sorted(service.files.items()):
+                    if os.path.dirname(f) == path:
+                        name = os.path.basename(f)
+                        entries.append(f"<File><Name>{name}</Name>"
+                            "<Properties><Content-Length>"
+                            f"{len(data)}</Content-Length></Properties>"
+                            "</File>")
+                return self.reply(200, ("<?xml version=\"1.0\"?>"
+                    "<EnumerationResults><Entries>" + "".join(entries) +
+                    "</Entries><NextMarker /></EnumerationResults>")
+                    .encode())
+            if path not in service.files:
+                return self.reply(404)
+            start, end = headers["x-ms-range"][6:].split("-")
+            data = bytes(service.files[path][int(start):int(end) + 1])
+            md5 = base64.b64encode(hashlib.md5(data).digest()).decode()
+            return self.reply(206, data, { "Content-MD5": md5,
+                "Content-Length": str(len(data)) })
+
+    return Handler
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    monkeypatch.setattr(file_share, "RANGE_SIZE", 1024)
+    monkeypatch.setattr(file_share, "RETRY_DELAY", 0)
+    service = FakeFileService()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(service))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    service.endpoint = f"http://127.0.0.1:{server.server_port}/{ACCOUNT}"
+    yield service
+    server.shutdown()
+
+def client(service, key=KEY):
+    return FileShareClient(ACCOUNT, key, SHARE, service.endpoint)
+
+def make_dataset(path):
+    (path / "images").mkdir(parents=True)
+    (path / "images" / "a.bin").write_bytes(os.urandom(5000))
+    (path / "images" / "b.bin").write_bytes(os.urandom(100))
+    (path / "labels.csv").write_text("a,1\nb,2\n")
+    (path / "empty").write_bytes(b"")
+
+def test_push_and_pull_round_trip(service, tmp_path):
+    share = client(service)
+    make_dataset(tmp_path / "dataset")
+    copies = plan_push(share, str(tmp_path / "dataset"), "datasets")
+    stats = push_files(share, copies, jobs=4)
+    assert stats.files == 4 and stats.bytes_copied == 5108
+    assert bytes(service.files["datasets/dataset/images/a.bin"]) == (
+        tmp_path / "dataset" / "images" / "a.bin").read_bytes()
+
+    copies = plan_pull(share, "datasets/dataset", str(tmp_path / "out"))
+    stats = pull_files(share, copies, jobs=4)
+    assert stats.files == 4 and stats.bytes_copied == 5108
+    for name in ["images/a.bin", "images/b.bin", "labels.csv", "empty"]:
+        assert (tmp_path / "out" / "dataset" / name).read_bytes() == (
+            tmp_path / "dataset" / name).read_bytes()
+
+def test_unchanged_files_are_skipped(service, tmp_path):
+    share = client(service)
+    make_dataset(tmp_path / "dataset")
+    push_files(share, plan_push(share, str(tmp_path / "dataset"), ""))
+    (tmp_path / "dataset" / "labels.csv").write_text("a,1\nb,3\n")
+    stats = push_files(share, plan_push(share, str(tmp_path / "dataset"), ""))
+    assert stats.skipped == 3 and stats.bytes_copied == 8
+
+    pull_files(share, plan_pull(share, "dataset", str(tmp_path / "out")))
+    stats = pull_files(share, plan_pull(share, "dataset",
+        str(tmp_path / "out")))
+    assert stats.skipped == 4 and stats.bytes_copied == 0
+
+def test_interrupted_push_resumes(service, tmp_path):
+    share = client(service)
+    data = os.urandom(10 * 1024)
+    (tmp_path / "big.bin").write_bytes(data)
+    service.fail_after = 4
+    with pytest.raises(FileShareError):
+        push_files(share, plan_push(share, str(tmp_path / "big.bin"), ""),
+            jobs=1)
+    assert "big.bin" not in service.md5
+
+    service.fail_after = None
+    stats = push_files(share, plan_push(share, str(tmp_path / "big.bin"), ""),
+        jobs=1)
+    assert stats.resumed == 1
+    assert stats.bytes_copied == 6 * 1024
+    assert bytes(service.files["big.bin"]) == data
+    assert "big.bin" in service.md5
+
+def test_requests_are_signed_with_the_account_key(service):
+    bad_key = base64.b64encode(b"wrong key").decode("ascii")
+    with pytest.raises(FileShareError) as e:
+        client(service, bad_key).properties("missing")
+    assert e.value.status == 403
+    assert client(service).properties("missing") is None
+
+def test_rotated_key_is_looked_up_again(service, tmp_path):
+    old_key = base64.b64encode(b"rotated key").decode("ascii")
+    share = FileShareClient(ACCOUNT, old_key, SHARE, service.endpoint,
+        refresh_key=lambda: KEY)
+    (tmp_path / "a.bin").write_bytes(b"a" * 100)
+    stats = push_files(share, plan_push(share, str(tmp_path / "a.bin"), ""))
+    assert stats.bytes_copied == 100
+    assert share.key == KEY
+
+def test_key_refresh_after_the_last_retry(service):
+    old_key = base64.b64encode(b"rotated key").decode("ascii")
+    share = FileShareClient(ACCOUNT, old_key, SHARE, service.endpoint,
+        refresh_key=lambda: KEY)
+    # The 403 of the rotated key comes after all retries of the 503s
+    service.statuses = [503] * (file_share.RETRIES - 1)
+    assert share.properties("missing") is None
+    assert share.key == KEY
+
+    service.statuses = [503] * file_share.RETRIES
+    with pytest.raises(FileShareError) as e:
+        share.properties("missing")
+    assert e.value.status == 503
@@ -0,0 +1,37 @@
+from ez_state import Ez
+from images import buildkit_script, context_hash, image_name
+
+def make_context(path):
+    path.mkdir()
+    (path / "Dockerfile").write_text("FROM python:3.9\n")
+    (path / "requirements.txt").write_text("numpy\n")
+    return path
+
+def test_context_hash_depends_only_on_build_inputs(tmp_path):
+    first = make_context(tmp_path / "first")
+    second = make_context(tmp_path / "second")
+    assert context_hash(first) == context_hash(second)
+
+    # devcontainer.json depends on the compute, not the image
+    (second / "devcontainer.json").write_text("{}")
+    assert context_hash(first) == context_hash(second)
+
+    (second / "requirements.txt").write_text("numpy\npandas\n")
+    assert context_hash(first) != context_hash(second)
+
+def test_image_name_is_shared_by_envs(tmp_path):
+    ez = Ez(workspace_name="ws")
+    name = image_name(ez, make_context(tmp_path / "env1"))
+    assert name == image_name(ez, make_context(tmp_path / "env2"))
+    assert name.startswith("ws:") and len(name) == len("ws:") + 16
+
+def test_buildkit_script_uses_registry_cache_when_pushing():
+    ez = Ez(workspace_name="ws", registry_name="reg")
+    script = buildkit_script(ez, "ws:abc", push=True)
+    assert "--tag reg.azurecr.io/ws:abc --push" in script
+    assert "--cache-from type=registry,ref=reg.azurecr.io/ws:buildcache" in script
+    assert "--cache-to type=registry,ref=reg.azurecr.io/ws:buildcache,mode=max" in script
+
+    script = buildkit_script(ez, "ws:abc", push=False)
+    assert "--tag ws:abc --load" in script
+    assert "--cache-to" not in script
@@ -0,0 +1,76 @@
+import os
+import stat
+import subprocess
+
+from jobs import (container_args, follow_script, job_script, new_job_id,
+    parse_status, status_script, submit_script, wait_script)
+from time import sleep, time
+
+DEVCONTAINER_JSON = {
+    "image": "ezws:3f2a",
+    "containerUser": "ezuser",
+    "workspaceFolder": "/workspace",
+    "workspaceMount": "source=/home/ezuser/code/demo,target=/workspace,"
+        "type=bind",
+    "mounts": ["source=/mnt/ez/scratch,target=/scratch,type=bind"],
+    "runArgs": ["--gpus=\"device=1\"", "--label=ez.env=demo/1"],
+}
+
+def test_container_args_from_devcontainer_json():
+    assert container_args(DEVCONTAINER_JSON) == ["--rm", "--init",
+        "--user", "ezuser", "--workdir", "/workspace",
+        "--mount", DEVCONTAINER_JSON["workspaceMount"],
+        "--mount", "source=/mnt/ez/scratch,target=/scratch,type=bind",
+        "--gpus=\"device=1\"", "--label=ez.env=demo/1", "ezws:3f2a"]
+
+def shell(env, script):
+    return subprocess.run(["bash", "-c", script], env=env,
+        capture_output=True, text=True)
+
+def wait_for(env, job_ids, timeout=20):
+    deadline = time() + timeout
+    while time() < deadline:
+        jobs = parse_status(shell(env, status_script()).stdout)
+        if len(jobs) == len(job_ids) and all(j.finished for j in jobs):
+            return jobs
+        sleep(0.1)
+    raise TimeoutError(jobs)
+
+def test_queued_jobs_run_in_slots(tmp_path):
+    # docker that prints the slot's arguments and runs the command
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    docker = bin_dir / "docker"
+    docker.write_text("#!/bin/bash\necho \"slot args: $4\"\n"
+        "eval \"${@: -1}\"\n")
+    docker.chmod(docker.stat().st_mode | stat.S_IEXEC)
+    env = { **os.environ, "HOME": str(tmp_path),
+        "PATH": f"{bin_dir}:{os.environ['PATH']}" }
+
+    job_ids = []
+    for i, command in enumerate(["sleep 0.5; echo first", "echo second",
+        "echo third; exit 3"]):
+        job_id = new_job_id("demo")
+        script = job_script(job_id, "demo", command,
+            [["--cpuset-cpus=1", "ezws:3f2a"],
+             ["--cpuset-cpus=2", "ezws:3f2a"]],
+            reserved=["demo/0", "demo/1"], poll_seconds=0.1)
+        assert shell(env, submit_script(job_id, script)).returncode == 0
+        # The runner is up when submit returns, so waiting on the job
+        # right away doesn't take it for lost
+        assert (tmp_path / ".ez" / "jobs" / job_id / "pid").exists()
+        job_ids.append(job_id)
+        sleep(0.01)
+
+    jobs = wait_for(env, job_ids)
+    assert [j.job_id for j in jobs] == job_ids
+    assert [j.exit_code for j in jobs] == [0, 0, 3]
+    assert [j.command for j in jobs] == ["sleep 0.5; echo first",
+        "echo second", "echo third; exit 3"]
+    # Two slots: the third job waits for the second to finish
+    assert jobs[0].slot == 0 and jobs[1].slot == 1 and jobs[2].slot == 1
+
+    assert shell(env, wait_script(job_ids[2])).stdout == "3\n"
+    result = shell(env, follow_script(job_ids[2]))
+    assert result.returncode == 3
+    assert result.stdout == "slot args: --cpuset-cpus=2\nthird\n"
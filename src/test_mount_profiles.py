@@ -0,0 +1,50 @@
+from mount_profiles import (PROFILES, automount_script, mount_command,
+    parse_bench)
+
+def test_cifs_mount_uses_profile_options():
+    cmd = mount_command("acct", "share", "/home/ez/data", "read-only-dataset",
+        key="secret", uid="ez")
+    assert cmd.startswith("sudo mount -t cifs "
+        "//acct.file.core.windows.net/share /home/ez/data -o ")
+    options = cmd.split(" -o ")[1].split(",")
+    assert "password=secret" in options
+    assert "cache=loose" in options
+    assert "ro" in options
+
+def test_nfs_mount_for_premium_shares():
+    cmd = mount_command("acct", "share", "/data", "throughput",
+        protocol="NFS")
+    assert cmd.startswith("sudo mount -t nfs "
+        "acct.file.core.windows.net:/acct/share /data -o ")
+    options = cmd.split(" -o ")[1].split(",")
+    assert "minorversion=1" in options
+    assert "nconnect=4" in options
+    assert not any(o.startswith("password=") for o in options)
+
+def test_cache_adds_fsc_option():
+    for protocol in ["SMB", "NFS"]:
+        cmd = mount_command("acct", "share", "/data", "throughput",
+            protocol=protocol)
+        assert "fsc" not in cmd.split(" -o ")[1].split(",")
+        cmd = mount_command("acct", "share", "/data", "throughput",
+            protocol=protocol, cache=True)
+        assert "fsc" in cmd.split(" -o ")[1].split(",")
+
+def test_every_profile_has_options_for_both_protocols():
+    for profile in PROFILES.values():
+        assert profile.cifs_options and profile.nfs_options
+
+def test_parse_bench():
+    assert parse_bench("warming up\n104857600.0 2500.5\n") == (104857600.0,
+        2500.5)
+
+def test_automount_keeps_the_key_in_a_credentials_file():
+    script = automount_script("acct", "share", "/home/ez/data", "throughput",
+        key="secret", uid="ez", cache=True)
+    options = [line for line in script.splitlines() 
+        if line.startswith("Options=")][0][len("Options="):].split(",")
+    assert "credentials=/etc/smbcredentials/acct.cred" in options
+    assert "fsc" in options and "_netdev" in options
+    assert not any(o.startswith("password=") for o in options)
+    assert "password=secret" in script.splitlines()
+    assert "What=//acct.file.core.windows.net/share" in script
@@ -0,0 +1,88 @@
+import pytest
+
+from pipeline import (Stage, check_stages, critical_path, run_stages,
+    scope_results, scope_stages)
+from time import sleep, time
+
+def test_dependencies_are_passed_results():
+    stages = [
+        Stage("a", "first", lambda r: 1),
+        Stage("b", "second", lambda r: r["a"] + 1, ["a"]),
+        Stage("c", "third", lambda r: r["a"] + r["b"], ["a", "b"]),
+    ]
+    results = run_stages(stages, "testing dependencies")
+    assert results == { "a": 1, "b": 2, "c": 3 }
+
+def test_independent_stages_run_concurrently():
+    stages = [
+        Stage("a", "sleep a", lambda r: sleep(0.5)),
+        Stage("b", "sleep b", lambda r: sleep(0.5)),
+        Stage("c", "sleep c", lambda r: sleep(0.5)),
+        Stage("d", "after all", lambda r: "done", ["a", "b", "c"]),
+    ]
+    started = time()
+    results = run_stages(stages, "testing concurrency")
+    assert results["d"] == "done"
+    assert time() - started < 1.2
+
+def test_stage_failure_stops_new_stages():
+    ran = []
+    def fail(r):
+        raise RuntimeError("stage failed")
+    stages = [
+        Stage("a", "failing stage", fail),
+        Stage("b", "dependent stage", lambda r: ran.append("b"), ["a"]),
+    ]
+    with pytest.raises(RuntimeError):
+        run_stages(stages, "testing failure")
+    assert ran == []
+
+def test_exit_in_stage_propagates():
+    stages = [Stage("a", "exiting stage", lambda r: exit(3))]
+    with pytest.raises(SystemExit):
+        run_stages(stages, "testing exit")
+
+def test_invalid_graphs():
+    with pytest.raises(ValueError):
+        check_stages([Stage("a", "", lambda r: 0, ["missing"])])
+    with pytest.raises(ValueError):
+        check_stages([Stage("a", "", lambda r: 0, ["b"]),
+            Stage("b", "", lambda r: 0, ["a"])])
+    with pytest.raises(ValueError):
+        check_stages([Stage("a", "", lambda r: 0), 
+            Stage("a", "", lambda r: 0)])
+
+def test_critical_path():
+    stages = [
+        Stage("a", "", lambda r: 0),
+        Stage("b", "", lambda r: 0, ["a"]),
+        Stage("c", "", lambda r: 0),
+    ]
+    timings = { "a": 1.0, "b": 2.0, "c": 2.5 }
+    assert critical_path(stages, timings) == 3.0
+
+def test_scoped_stages_share_stages_across_scopes():
+    calls = []
+    def stages(compute):
+        return [
+            Stage("clone", "Cloning", lambda r: calls.append("clone") or 1),
+            Stage("size", f"Querying {compute}", lambda r: sleep(0.5) or
+                len(compute)),
+            Stage("assign", "Assigning", lambda r: r["clone"] + r["size"],
+                ["clone", "size"]),
+        ]
+    graph = []
+    for compute in ["gpu1", "gpu22"]:
+        for stage in scope_stages(stages(compute), compute, { "clone" }):
+            if all(stage.name != s.name for s in graph):
+                graph.append(stage)
+    assert [s.description for s in graph] == ["Cloning", "Querying gpu1",
+        "Assigning on gpu1", "Querying gpu22", "Assigning on gpu22"]
+
+    started = time()
+    results = run_stages(graph, "testing scopes")
+    assert time() - started < 0.9
+    assert calls == ["clone"]
+    assert scope_results(results, "gpu1") == { "clone": 1, "size": 4,
+        "assign": 5 }
+    assert scope_results(results, "gpu22")["assign"] == 6
@@ -0,0 +1,64 @@
+import os
+import prefetch_agent
+
+from prefetch_agent import TMP_SUFFIX, prefetch
+
+def make_share(root):
+    (root / "train").mkdir(parents=True)
+    (root / "train" / "a.png").write_bytes(b"a" * 1000)
+    (root / "train" / "b.png").write_bytes(b"b" * 2000)
+    (root / "train" / "labels.csv").write_text("a,1\nb,2\n")
+    (root / "test").mkdir()
+    (root / "test" / "c.png").write_bytes(b"")
+
+def test_copies_matching_files(tmp_path):
+    share, dest = tmp_path / "share", tmp_path / "scratch"
+    make_share(share)
+    stats = prefetch(str(share), str(dest), ["**/*.png"], jobs=4)
+    assert stats["files"] == 3
+    assert stats["bytes"] == 3000
+    assert stats["failed"] == []
+    assert (dest / "train" / "b.png").read_bytes() == b"b" * 2000
+    assert (dest / "test" / "c.png").read_bytes() == b""
+    assert not (dest / "train" / "labels.csv").exists()
+    assert not any(name.endswith(TMP_SUFFIX) 
+        for _, _, names in os.walk(dest) for name in names)
+
+def test_directories_are_copied_recursively(tmp_path):
+    share, dest = tmp_path / "share", tmp_path / "scratch"
+    make_share(share)
+    stats = prefetch(str(share), str(dest), ["train", "../outside"])
+    assert stats["files"] == 3
+    assert (dest / "train" / "labels.csv").exists()
+
+def test_unchanged_files_are_skipped(tmp_path):
+    share, dest = tmp_path / "share", tmp_path / "scratch"
+    make_share(share)
+    prefetch(str(share), str(dest), ["train"])
+    (share / "train" / "a.png").write_bytes(b"A" * 1001)
+    stats = prefetch(str(share), str(dest), ["train"])
+    assert stats["skipped"] == 2
+    assert stats["bytes"] == 1001
+    assert (dest / "train" / "a.png").read_bytes() == b"A" * 1001
+
+def test_large_files_are_copied_in_parts(tmp_path, monkeypatch):
+    monkeypatch.setattr(prefetch_agent, "PART_SIZE", 1000)
+    monkeypatch.setattr(prefetch_agent, "READ_SIZE", 300)
+    share, dest = tmp_path / "share", tmp_path / "scratch"
+    share.mkdir()
+    data = os.urandom(4500)
+    (share / "big.bin").write_bytes(data)
+    stats = prefetch(str(share), str(dest), ["big.bin"], jobs=3)
+    assert stats["bytes"] == 4500
+    assert (dest / "big.bin").read_bytes() == data
+
+def test_failed_verification_is_reported(tmp_path, monkeypatch):
+    monkeypatch.setattr(prefetch_agent, "read_hash", 
+        lambda path, offset, length: "corrupt")
+    share, dest = tmp_path / "share", tmp_path / "scratch"
+    make_share(share)
+    stats = prefetch(str(share), str(dest), ["train/a.png"])
+    assert stats["failed"] == ["train/a.png"]
+    assert stats["bytes"] == 0
+    assert not (dest / "train" / "a.png").exists()
+    assert not (dest / "train" / f"a.png{TMP_SUFFIX}").exists()
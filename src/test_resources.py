@@ -0,0 +1,33 @@
+from resources import merge_run_args, size_resources
+from size_catalog import VmSize
+
+NC6S_V3 = VmSize(name="Standard_NC6s_v3", cores=6, memory_gb=112, gpus=1)
+
+def test_resources_sized_from_vm():
+    resources = size_resources(NC6S_V3)
+    assert resources.cpus == "5"
+    assert resources.memory == "100g"
+    assert resources.shm_size == "28g"
+    assert "--ulimit=memlock=-1" in resources.run_args()
+
+def test_unknown_size_keeps_docker_defaults():
+    resources = size_resources(VmSize(name="Unknown"))
+    assert resources.run_args() == [f"--ulimit={name}={value}" for name, value
+        in resources.ulimits.items()]
+
+def test_ez_json_overrides():
+    resources = size_resources(NC6S_V3, { "shm_size": "8g", "cpus": 2,
+        "ulimits": { "nofile": "1024:1024" } })
+    assert resources.shm_size == "8g"
+    assert resources.cpus == "2"
+    assert resources.memory == "100g"
+    assert resources.ulimits["nofile"] == "1024:1024"
+
+def test_run_args_take_precedence():
+    args = merge_run_args(["--gpus=all", "--shm-size=2g", "--ulimit=stack=1"],
+        size_resources(NC6S_V3).run_args())
+    assert args.count("--gpus=all") == 1
+    assert "--shm-size=28g" not in args
+    assert "--ulimit=stack=67108864" not in args
+    assert "--ulimit=memlock=-1" in args
+    assert "--cpus=5" in args
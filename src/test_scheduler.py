@@ -0,0 +1,73 @@
+import pytest
+
+from scheduler import (Assignment, SchedulingError, assign, env_request,
+    format_cpuset, load_assignments, reclaim, save_assignments)
+from size_catalog import VmSize
+
+# 4 GPUs, 24 cores and 448GB: 23 cores and 403GB for containers
+NC24S_V3 = VmSize(name="Standard_NC24s_v3", cores=24, memory_gb=448, gpus=4)
+
+def test_gpu_envs_get_a_share_of_cores_and_memory_per_gpu():
+    assignments = {}
+    for env in ["a", "b"]:
+        assignments[env] = assign(NC24S_V3, assignments, env, gpus=1)
+    assert assignments["a"].gpus == [0]
+    assert assignments["b"].gpus == [1]
+    assert assignments["a"].cpus == list(range(1, 6))
+    assert assignments["b"].cpus == list(range(6, 11))
+    assert assignments["a"].memory_gb == 403 * 5 // 23
+
+    big = assign(NC24S_V3, assignments, "c", gpus=2)
+    assert big.gpus == [2, 3] and len(big.cpus) == 11
+    with pytest.raises(SchedulingError):
+        assign(NC24S_V3, { **assignments, "c": big }, "d", gpus=1)
+
+def test_run_args_restrict_devices_and_cores():
+    assignment = Assignment(gpus=[0, 2], cpus=[1, 2, 3, 7], memory_gb=64)
+    assert assignment.run_args() == ["--gpus=\"device=0,2\"",
+        "--cpuset-cpus=1-3,7"]
+    assert format_cpuset([5]) == "5"
+
+def test_existing_assignment_is_kept():
+    assignments = { "a": assign(NC24S_V3, {}, "a", gpus=1) }
+    assignments["b"] = assign(NC24S_V3, assignments, "b", gpus=1)
+    assert assign(NC24S_V3, assignments, "b", gpus=1) is assignments["b"]
+    assert assign(NC24S_V3, assignments, "b", gpus=2).gpus == [1, 2]
+
+# 16 cores and 64GB: 15 cores and 57GB for containers
+D16S_V5 = VmSize(name="Standard_D16s_v5", cores=16, memory_gb=64, gpus=0)
+
+def test_cpu_env_gets_the_cores_of_a_gpu():
+    assignments = { "a": assign(NC24S_V3, {}, "a", gpus=1) }
+    cpu_env = assign(NC24S_V3, assignments, "b", gpus=0)
+    assert cpu_env.gpus == [] and cpu_env.cpus == list(range(6, 11))
+
+def test_gpu_env_starts_next_to_a_cpu_env():
+    assignments = { "cpu": assign(NC24S_V3, {}, "cpu", gpus=0) }
+    assignments["gpu"] = assign(NC24S_V3, assignments, "gpu", gpus=1)
+    assert assignments["gpu"].gpus == [0]
+    assert len(assignments["gpu"].cpus) == 5
+    assert not set(assignments["cpu"].cpus) & set(assignments["gpu"].cpus)
+
+def test_cpu_slots_split_the_free_cores():
+    assignments = {}
+    for slot in range(2):
+        assignments[f"x/{slot}"] = assign(D16S_V5, assignments, f"x/{slot}",
+            gpus=0, envs=2 - slot)
+    assert assignments["x/0"].cpus == list(range(1, 8))
+    assert assignments["x/1"].cpus == list(range(8, 16))
+    assert assignments["x/0"].memory_gb + assignments["x/1"].memory_gb <= 57
+
+def test_stale_assignments_are_reclaimed():
+    compute = {}
+    save_assignments(compute, { "a": Assignment([0], [1], 10), 
+        "b": Assignment([1], [2], 10), "c": Assignment([2], [3], 10) })
+    assignments = load_assignments(compute)
+    assert reclaim(assignments, running={ "a" }, keep={ "c" }) == ["b"]
+    assert sorted(assignments) == ["a", "c"]
+
+def test_env_request_from_ez_json():
+    assert env_request(NC24S_V3, { "requires_gpu": True }) == (1, None)
+    assert env_request(NC24S_V3, { "requires_gpu": False }) == (0, None)
+    assert env_request(NC24S_V3, { "requires_gpu": True, 
+        "resources": { "gpus": "all", "cpus": 7.5 } }) == (4, 8)
@@ -0,0 +1,74 @@
+import json
+
+from size_catalog import (CreateOptions, VmSize, parse_sku, 
+    validate_create_options)
+
+def load_skus():
+    with open("./test_data/skus.json", "rt") as f:
+        return { sku["name"]: sku for sku in json.load(f) }
+
+def test_parse_gpu_sku():
+    info = parse_sku(load_skus()["Standard_NC6s_v3"])
+    assert info.name == "Standard_NC6s_v3"
+    assert info.cores == 6
+    assert info.memory_gb == 112
+    assert info.gpus == 1
+    assert info.resource_disk_gb == 336
+    assert info.has_local_disk
+
+def test_parse_nvme_sku():
+    info = parse_sku(load_skus()["Standard_L8s_v2"])
+    assert info.nvme_disk_gb == 1788
+    assert info.gpus == 0
+    assert info.has_local_disk
+
+def test_parse_diskless_sku():
+    info = parse_sku(load_skus()["Standard_D4as_v5"])
+    assert info.resource_disk_gb == 0
+    assert not info.has_local_disk
+
+def test_unknown_size():
+    assert not VmSize(name="Standard_Unknown").has_local_disk
+
+def test_ephemeral_os_disk_on_cache_disk():
+    info = parse_sku(load_skus()["Standard_NC6s_v3"])
+    options = CreateOptions(os_disk_size_gb=256, ephemeral_os_disk=True)
+    assert validate_create_options(info, options) == []
+    assert options.ephemeral_os_disk_placement == "CacheDisk"
+
+def test_ephemeral_os_disk_on_resource_disk():
+    info = parse_sku(load_skus()["Standard_L8s_v2"])
+    options = CreateOptions(os_disk_size_gb=64, ephemeral_os_disk=True)
+    assert validate_create_options(info, options) == []
+    assert options.ephemeral_os_disk_placement == "ResourceDisk"
+
+def test_ephemeral_os_disk_too_large():
+    info = parse_sku(load_skus()["Standard_L8s_v2"])
+    options = CreateOptions(os_disk_size_gb=256, ephemeral_os_disk=True)
+    assert len(validate_create_options(info, options)) == 1
+
+def test_unsupported_options():
+    info = parse_sku(load_skus()["Standard_NC6s_v3"])
+    options = CreateOptions(accelerated_networking=True)
+    assert len(validate_create_options(info, options)) == 1
+    info = parse_sku(load_skus()["Standard_D4as_v5"])
+    options = CreateOptions(ephemeral_os_disk=True, 
+        accelerated_networking=True)
+    assert len(validate_create_options(info, options)) == 1
+
+def test_unknown_size_is_not_validated():
+    options = CreateOptions(ephemeral_os_disk=True)
+    assert validate_create_options(VmSize(name="Standard_X"), options) == []
+
+def test_hibernation():
+    skus = load_skus()
+    options = CreateOptions(hibernation=True)
+    info = parse_sku(skus["Standard_D4as_v5"])
+    assert info.hibernation
+    assert validate_create_options(info, options) == []
+    info = parse_sku(skus["Standard_NC6s_v3"])
+    assert len(validate_create_options(info, options)) == 1
+    info = parse_sku(skus["Standard_L8s_v2"])
+    options = CreateOptions(os_disk_size_gb=64, ephemeral_os_disk=True, 
+        hibernation=True)
+    assert len(validate_create_options(info, options)) == 2
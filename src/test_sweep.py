@@ -0,0 +1,82 @@
+import pytest
+
+from sweep import expand_grid, format_command, parse_params, run_sweep
+from sweep_commands import trial_command
+from time import sleep, time
+
+def test_grid_of_parameters():
+    params = parse_params(["lr=0.1,0.01", "batch=32,64,128"])
+    trials = expand_grid(params)
+    assert len(trials) == 6
+    assert trials[1].params == { "lr": "0.1", "batch": "64" }
+    assert trials[1].trial_id == "trial-0001"
+
+    samples = expand_grid(params, samples=4, seed=1)
+    assert len(samples) == 4
+    assert samples == expand_grid(params, samples=4, seed=1)
+    with pytest.raises(ValueError):
+        parse_params(["lr"])
+
+def test_command_template():
+    assert format_command("python train.py --lr {lr} --out ${HOME}/{run}",
+        { "lr": "0.1" }) == "python train.py --lr 0.1 --out ${HOME}/{run}"
+
+def test_trial_command_has_a_metrics_dir():
+    trial = expand_grid({ "lr": ["0.1"] })[0]
+    assert trial_command(["python", "train.py", "--lr", "{lr}", "--out",
+        "{trial_dir}"], "sweep-1", trial) == ("export EZ_TRIAL_DIR="
+        "/workspace/.ez-sweep/sweep-1/trial-0000; mkdir -p $EZ_TRIAL_DIR && "
+        "python train.py --lr 0.1 --out "
+        "/workspace/.ez-sweep/sweep-1/trial-0000")
+
+    # Arguments keep their quoting, also when a value has spaces
+    trial = expand_grid({ "msg": ["a b"] })[0]
+    assert trial_command(["python", "-c", "print('{msg}')"], "sweep-1",
+        trial).endswith("&& python -c 'print('\"'\"'a b'\"'\"')'")
+
+def test_trials_spread_over_computes_and_slots():
+    trials = expand_grid(parse_params(["seed=" + ",".join(map(str, 
+        range(12)))]))
+    def run(compute, trial):
+        sleep(0.05)
+        return 0, { "seed": trial.params["seed"] }
+
+    started = time()
+    done = run_sweep(trials, { "a": 2, "b": 2, "c": 2 }, run)
+    elapsed = time() - started
+    # 12 trials of 50ms on 6 slots take 2 rounds
+    assert elapsed < 0.05 * 12 / 2
+    assert [t.index for t in done] == list(range(12))
+    assert all(t.exit_code == 0 and len(t.attempts) == 1 for t in done)
+    assert done[3].metrics == { "seed": "3" }
+
+def test_idle_compute_steals_trials():
+    trials = expand_grid(parse_params(["seed=" + ",".join(map(str, 
+        range(10)))]))
+    def run(compute, trial):
+        sleep(0.2 if compute == "slow" else 0.01)
+        return 0, {}
+
+    done = run_sweep(trials, { "slow": 1, "fast": 1 }, run)
+    on_slow = [t for t in done if t.attempts == ["slow"]]
+    # The slow compute was dealt 5 trials, most of which the fast one took
+    assert 1 <= len(on_slow) <= 2
+
+def test_failed_trial_is_retried_on_another_compute():
+    trials = expand_grid(parse_params(["seed=0,1,2,3"]))
+    retried = []
+    def run(compute, trial):
+        return (1 if compute == "bad" else 0), {}
+
+    done = run_sweep(trials, { "bad": 1, "good": 1 }, run,
+        on_finish=lambda t, retry: retry and retried.append(t.index))
+    assert all(t.exit_code == 0 and t.attempts[-1] == "good" for t in done)
+    assert len(retried) > 0
+    assert all(t.attempts == ["bad", "good"] for t in done
+        if t.index in retried)
+
+    # Trials that fail everywhere are given up after max_attempts
+    trials = expand_grid(parse_params(["seed=0,1,2,3"]))
+    done = run_sweep(trials, { "a": 1, "b": 1, "c": 1 }, 
+        lambda compute, trial: (2, {}), max_attempts=2)
+    assert all(t.exit_code == 2 and len(t.attempts) == 2 for t in done)
@@ -0,0 +1,162 @@
+import io
+import json
+import os
+import shutil
+import subprocess
+import sync_agent
+
+from sync import compute_delta, delta_header, tree_state, write_delta
+
+BLOCK_SIZE = sync_agent.BLOCK_SIZE
+
+def git(*args, cwd=None):
+    subprocess.run(["git", "-c", "user.name=ez", "-c",
+        "user.email=ez@example.com"] + list(args), cwd=cwd,
+        capture_output=True, check=True)
+
+def make_repo(path):
+    path.mkdir()
+    git("init", "-q", cwd=path)
+    (path / "README.md").write_text("hello\n")
+    (path / "big.bin").write_bytes(bytes(range(256)) * (BLOCK_SIZE // 128))
+    (path / "src").mkdir()
+    (path / "src" / "main.py").write_text("print('hello')\n")
+    git("add", ".", cwd=path)
+    git("commit", "-q", "-m", "first", cwd=path)
+
+def manifest(path):
+    return sync_agent.manifest(str(path), sync_agent.list_files(str(path)))
+
+def sync(local, remote):
+    local_manifest = manifest(local)
+    delta = compute_delta(local_manifest, manifest(remote))
+    stream = io.BytesIO()
+    write_delta(str(local), local_manifest, delta, stream)
+    stream.seek(0)
+    assert sync_agent.apply_stream(str(remote), stream) == []
+    return delta
+
+def test_identical_trees_have_no_delta(tmp_path):
+    make_repo(tmp_path / "local")
+    shutil.copytree(tmp_path / "local", tmp_path / "remote")
+    delta = compute_delta(manifest(tmp_path / "local"),
+        manifest(tmp_path / "remote"))
+    assert delta.files == []
+    assert delta.delete == []
+    assert delta.bytes_to_send == 0
+
+def test_only_changed_blocks_are_sent(tmp_path):
+    local = tmp_path / "local"
+    make_repo(local)
+    remote = tmp_path / "remote"
+    shutil.copytree(local, remote)
+
+    data = bytearray((local / "big.bin").read_bytes())
+    data[BLOCK_SIZE + 10] ^= 0xff
+    data += b"tail"
+    (local / "big.bin").write_bytes(data)
+    (local / "README.md").write_text("changed\n")
+
+    delta = sync(local, remote)
+    assert dict(delta.files) == { "big.bin": [1, 2], "README.md": None }
+    assert delta.bytes_to_send == BLOCK_SIZE + 4 + len("changed\n")
+    assert (remote / "big.bin").read_bytes() == data
+    assert (remote / "README.md").read_text() == "changed\n"
+
+def test_untracked_and_deleted_files(tmp_path):
+    local = tmp_path / "local"
+    make_repo(local)
+    remote = tmp_path / "remote"
+    shutil.copytree(local, remote)
+
+    # Untracked files are sent, ignored files are not
+    (local / ".gitignore").write_text("*.log\n")
+    (local / "notes.txt").write_text("untracked\n")
+    (local / "run.log").write_text("ignored\n")
+    # Deleting a tracked file deletes it remotely, but files created in the
+    # remote environment are kept
+    os.remove(local / "src" / "main.py")
+    (remote / "outputs.csv").write_text("1,2,3\n")
+
+    delta = sync(local, remote)
+    assert delta.delete == ["src/main.py"]
+    assert (remote / "notes.txt").read_text() == "untracked\n"
+    assert not (remote / "run.log").exists()
+    assert not (remote / "src" / "main.py").exists()
+    assert (remote / "outputs.csv").exists()
+
+def test_executable_bit_is_synced(tmp_path):
+    local = tmp_path / "local"
+    make_repo(local)
+    remote = tmp_path / "remote"
+    shutil.copytree(local, remote)
+
+    os.chmod(local / "src" / "main.py", 0o755)
+    delta = sync(local, remote)
+    assert dict(delta.files) == { "src/main.py": None }
+    assert os.stat(remote / "src" / "main.py").st_mode & 0o100
+
+def test_failed_block_patch_is_reported(tmp_path):
+    local = tmp_path / "local"
+    make_repo(local)
+    remote = tmp_path / "remote"
+    shutil.copytree(local, remote)
+
+    data = bytearray((local / "big.bin").read_bytes())
+    data[0] ^= 0xff
+    (local / "big.bin").write_bytes(data)
+    local_manifest = manifest(local)
+    delta = compute_delta(local_manifest, manifest(remote))
+
+    # A block that isn't sent changes after the remote manifest was computed
+    changed = bytearray((remote / "big.bin").read_bytes())
+    changed[BLOCK_SIZE] ^= 0xff
+    (remote / "big.bin").write_bytes(changed)
+    stream = io.BytesIO()
+    write_delta(str(local), local_manifest, delta, stream)
+    stream.seek(0)
+    assert sync_agent.apply_stream(str(remote), stream) == ["big.bin"]
+    assert (remote / "big.bin").read_bytes() == changed
+
+def test_outputs_are_pulled_with_pack(tmp_path, monkeypatch):
+    monkeypatch.setattr(sync_agent, "CACHE_DIR", str(tmp_path / "cache"))
+    local = tmp_path / "local"
+    make_repo(local)
+    remote = tmp_path / "remote"
+    shutil.copytree(local, remote)
+    (remote / "checkpoints").mkdir()
+    (remote / "checkpoints" / "epoch1.pt").write_bytes(b"weights")
+    (local / "checkpoints").mkdir()
+    (local / "checkpoints" / "local.txt").write_text("kept\n")
+
+    files = sync_agent.list_dir_files(str(local), ["checkpoints"])
+    assert files == { "checkpoints/local.txt": False }
+    local_manifest = sync_agent.manifest(str(local), files)
+
+    # The remote agent lists and packs the outputs, the sender is local
+    root = str(remote)
+    remote_manifest = sync_agent.manifest(root,
+        sync_agent.list_dir_files(root, ["checkpoints"]))
+    delta = compute_delta(remote_manifest, local_manifest)
+    assert delta.delete == []
+    request = tmp_path / "request.json"
+    request.write_text(json.dumps(delta_header(remote_manifest, delta)))
+    stream = tmp_path / "out.stream"
+    assert sync_agent.main(["agent", "pack", root, str(request),
+        str(stream)]) == 0
+    with open(stream, "rb") as f:
+        assert sync_agent.apply_stream(str(local), f) == []
+    assert (local / "checkpoints" / "epoch1.pt").read_bytes() == b"weights"
+    assert (local / "checkpoints" / "local.txt").exists()
+
+def test_tree_state_detects_edits(tmp_path):
+    local = tmp_path / "local"
+    make_repo(local)
+    (local / "checkpoints").mkdir()
+    (local / "checkpoints" / "a.pt").write_text("a")
+    state = tree_state(str(local), ["checkpoints"])
+    assert "checkpoints/a.pt" not in state
+    assert tree_state(str(local), ["checkpoints"]) == state
+
+    (local / "src" / "main.py").write_text("print('changed')\n")
+    assert tree_state(str(local), ["checkpoints"]) != state
@@ -0,0 +1,254 @@
+import os
+import paramiko
+import socket
+import subprocess
+import threading
+import transfer
+
+from transfer import copy_files, plan_download, plan_upload, remote_path
+
+class LocalFile:
+    """File that also has the paramiko SFTPFile methods used by transfer"""
+    prefetched = []
+
+    def __init__(self, path, mode):
+        self.f = open(path, mode)
+        self.read, self.write, self.seek = (self.f.read, self.f.write,
+            self.f.seek)
+
+    def set_pipelined(self, pipelined):
+        pass
+
+    def prefetch(self, size):
+        # Like paramiko, prefetch from the current position up to size
+        LocalFile.prefetched.append((self.f.tell(), size))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.f.close()
+
+class LocalSftp:
+    """SFTP client for the local file system"""
+    def stat(self, path):
+        return paramiko.SFTPAttributes.from_stat(os.stat(path))
+
+    def listdir(self, path):
+        return os.listdir(path)
+
+    def listdir_attr(self, path):
+        return [paramiko.SFTPAttributes.from_stat(
+            os.stat(os.path.join(path, name)), name)
+            for name in sorted(os.listdir(path))]
+
+    def open(self, path, mode):
+        return LocalFile(path, mode)
+
+    def posix_rename(self, src, dest):
+        os.replace(src, dest)
+
+    def chmod(self, path, mode):
+        os.chmod(path, mode)
+
+    def close(self):
+        pass
+
+class LocalConnection:
+    """Connection whose remote commands and files are local"""
+    def __init__(self):
+        self.sftp_client = LocalSftp()
+        self.client = self
+        self.commands = []
+
+    def sftp(self):
+        return self.sftp_client
+
+    def open_sftp(self):
+        return LocalSftp()
+
+    def run(self, cmd, hide=None, warn=False):
+        self.commands.append(cmd)
+        return subprocess.run(["bash", "-c", cmd], capture_output=True,
+            text=True)
+
+def make_tree(path):
+    (path / "data" / "nested").mkdir(parents=True)
+    (path / "data" / "a.txt").write_text("a")
+    (path / "data" / "nested" / "b with space.txt").write_text("b")
+    (path / "run.sh").write_text("#!/bin/sh\n")
+    os.chmod(path / "run.sh", 0o755)
+
+def test_remote_paths_are_relative_to_the_env():
+    assert remote_path("/home/u/code/env", ".") == "/home/u/code/env"
+    assert remote_path("/home/u/code/env", "/data") == "/home/u/code/env/data"
+
+def test_upload_directory_and_skip_unchanged(tmp_path):
+    local = tmp_path / "local"
+    local.mkdir()
+    make_tree(local)
+    remote = tmp_path / "remote"
+    remote.mkdir()
+    connection = LocalConnection()
+
+    copies = plan_upload(connection.sftp(), [str(local / "data")],
+        str(remote))
+    assert sorted(c.dest for c in copies) == [
+        str(remote / "data" / "a.txt"),
+        str(remote / "data" / "nested" / "b with space.txt")]
+    stats = copy_files(connection, copies, upload=True)
+    assert stats.skipped == 0
+    assert (remote / "data" / "nested" / "b with space.txt").read_text() == "b"
+
+    (local / "data" / "a.txt").write_text("A")
+    stats = copy_files(connection, copies, upload=True)
+    assert stats.skipped == 1
+    assert stats.bytes_copied == 1
+    assert (remote / "data" / "a.txt").read_text() == "A"
+
+def test_download_glob_keeps_mode(tmp_path):
+    remote = tmp_path / "remote"
+    remote.mkdir()
+    make_tree(remote)
+    local = tmp_path / "local"
+    local.mkdir()
+    connection = LocalConnection()
+
+    copies = plan_download(connection.sftp(), [str(remote / "*.sh")],
+        str(local))
+    copy_files(connection, copies, upload=False)
+    assert os.stat(local / "run.sh").st_mode & 0o111
+
+def test_partial_copy_is_resumed(tmp_path, monkeypatch):
+    monkeypatch.setattr(transfer, "RESUME_MIN_SIZE", 1024)
+    local = tmp_path / "local"
+    local.mkdir()
+    data = os.urandom(4096)
+    (local / "big.bin").write_bytes(data)
+    remote = tmp_path / "remote"
+    remote.mkdir()
+    (remote / "big.bin.ez-part").write_bytes(data[:1000])
+    connection = LocalConnection()
+
+    copies = plan_upload(connection.sftp(), [str(local / "big.bin")],
+        str(remote / "big.bin"))
+    stats = copy_files(connection, copies, upload=True)
+    assert stats.resumed == 1
+    assert stats.bytes_copied == 4096 - 1000
+    assert (remote / "big.bin").read_bytes() == data
+    assert not (remote / "big.bin.ez-part").exists()
+
+def test_partial_download_is_resumed(tmp_path, monkeypatch):
+    monkeypatch.setattr(transfer, "RESUME_MIN_SIZE", 1024)
+    monkeypatch.setattr(LocalFile, "prefetched", [])
+    remote = tmp_path / "remote"
+    remote.mkdir()
+    data = os.urandom(4096)
+    (remote / "big.bin").write_bytes(data)
+    local = tmp_path / "local"
+    local.mkdir()
+    (local / "big.bin.ez-part").write_bytes(data[:1000])
+    connection = LocalConnection()
+
+    copies = plan_download(connection.sftp(), [str(remote / "big.bin")],
+        str(local / "big.bin"))
+    stats = copy_files(connection, copies, upload=False)
+    assert stats.resumed == 1
+    assert stats.bytes_copied == 4096 - 1000
+    assert (local / "big.bin").read_bytes() == data
+    # Only the rest of the file is requested
+    assert LocalFile.prefetched == [(1000, 4096)]
+
+class SftpHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(
+            self.readfile.fileno()))
+
+class SftpServer(paramiko.SFTPServerInterface):
+    """SFTP server for the local file system"""
+    def stat(self, path):
+        return paramiko.SFTPAttributes.from_stat(os.stat(path))
+
+    lstat = stat
+
+    def list_folder(self, path):
+        return [paramiko.SFTPAttributes.from_stat(
+            os.stat(os.path.join(path, name)), name)
+            for name in os.listdir(path)]
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        else:
+            mode = "rb"
+        handle = SftpHandle(flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def posix_rename(self, oldpath, newpath):
+        os.replace(oldpath, newpath)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        paramiko.SFTPServer.set_file_attr(path, attr)
+        return paramiko.SFTP_OK
+
+class SshServer(paramiko.ServerInterface):
+    def get_allowed_auths(self, username):
+        return "none"
+
+    def check_auth_none(self, username):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+class SftpConnection(LocalConnection):
+    """Connection whose files are copied over paramiko SFTP sessions"""
+    def __init__(self, transport):
+        super().__init__()
+        self.transport = transport
+        self.sftp_client = self.open_sftp()
+
+    def open_sftp(self):
+        return paramiko.SFTPClient.from_transport(self.transport)
+
+def sftp_transports():
+    server_socket, client_socket = socket.socketpair()
+    server = paramiko.Transport(server_socket)
+    server.add_server_key(paramiko.RSAKey.generate(2048))
+    server.set_subsystem_handler("sftp", paramiko.SFTPServer, SftpServer)
+    server.start_server(threading.Event(), SshServer())
+    client = paramiko.Transport(client_socket)
+    client.start_client()
+    client.auth_none("ez")
+    return server, client
+
+def test_concurrent_copies_over_sftp(tmp_path):
+    local = tmp_path / "local"
+    (local / "data").mkdir(parents=True)
+    files = { f"data/{i}.bin": os.urandom(300 * 1024) for i in range(16) }
+    for name, data in files.items():
+        (local / name).write_bytes(data)
+    remote = tmp_path / "remote"
+    remote.mkdir()
+    (tmp_path / "back").mkdir()
+    server, client = sftp_transports()
+    try:
+        connection = SftpConnection(client)
+        copies = plan_upload(connection.sftp(), [str(local / "data")],
+            str(remote))
+        copy_files(connection, copies, upload=True, checksum=False)
+        copies = plan_download(connection.sftp(), [str(remote / "data")],
+            str(tmp_path / "back"))
+        copy_files(connection, copies, upload=False, checksum=False)
+    finally:
+        client.close()
+        server.close()
+    for name, data in files.items():
+        assert (remote / name).read_bytes() == data
+        assert (tmp_path / "back" / name).read_bytes() == data
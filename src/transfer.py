@@ -0,0 +1,322 @@
+# Copy files to and from a compute over SFTP sessions of a single connection
+
+import exec
+import fnmatch
+import glob
+import hashlib
+import os
+import posixpath
+import shlex
+import stat
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from fabric import Connection
+from rich.progress import (BarColumn, DownloadColumn, Progress, TextColumn,
+    TimeRemainingColumn, TransferSpeedColumn)
+from typing import Any, Callable, Dict, List, Optional
+
+CHUNK_SIZE = 256 * 1024
+
+# Files at least this large are written to a .ez-part file that is renamed
+# when complete, so that an interrupted copy can be resumed
+RESUME_MIN_SIZE = 16 * 1024 * 1024
+PART_SUFFIX = ".ez-part"
+
+@dataclass
+class FileCopy:
+    src: str
+    dest: str
+    size: int
+    mode: int=0o644
+
+@dataclass
+class CopyStats:
+    files: int=0
+    skipped: int=0
+    resumed: int=0
+    bytes_copied: int=0
+    bytes_total: int=0
+
+def remote_path(remote_root: str, path: str) -> str:
+    """Paths in the environment are relative to remote_root"""
+    return posixpath.normpath(posixpath.join(remote_root, path.lstrip("/")))
+
+def run_remote(connection: Connection, cmd: str) -> str:
+    return connection.run(cmd, hide="both", warn=True).stdout
+
+def __is_remote_dir(sftp: Any, path: str) -> bool:
+    try:
+        return stat.S_ISDIR(sftp.stat(path).st_mode)
+    except IOError:
+        return False
+
+def __walk_remote(sftp: Any, path: str, dest: str) -> List[FileCopy]:
+    copies = []
+    for attr in sftp.listdir_attr(path):
+        src = posixpath.join(path, attr.filename)
+        target = os.path.join(dest, attr.filename)
+        if stat.S_ISDIR(attr.st_mode):
+            copies += __walk_remote(sftp, src, target)
+        elif stat.S_ISREG(attr.st_mode):
+            copies.append(FileCopy(src, target, attr.st_size,
+                attr.st_mode & 0o777))
+    return copies
+
+def __walk_local(path: str, dest: str) -> List[FileCopy]:
+    copies = []
+    for parent, _, names in os.walk(path):
+        for name in sorted(names):
+            src = os.path.join(parent, name)
+            rel = os.path.relpath(src, path).replace(os.sep, "/")
+            st = os.stat(src)
+            copies.append(FileCopy(src, posixpath.join(dest, rel),
+                st.st_size, st.st_mode & 0o777))
+    return copies
+
+def plan_upload(sftp: Any, sources: List[str], dest: str) -> List[FileCopy]:
+    """List the files to copy from the local sources (which may contain
+    wildcards) to the remote dest. dest is a directory if it exists as one,
+    ends with / or there are several sources.
+
+    Raises:
+        FileNotFoundError: if a source doesn't match any file
+    """
+    paths = []
+    for source in sources:
+        matches = sorted(glob.glob(source))
+        if len(matches) == 0:
+            raise FileNotFoundError(source)
+        paths += matches
+
+    into_dir = (len(paths) > 1 or dest.endswith("/") or
+        __is_remote_dir(sftp, dest))
+    copies = []
+    for path in paths:
+        name = os.path.basename(os.path.normpath(path))
+        target = posixpath.join(dest, name) if into_dir else dest
+        if os.path.isdir(path):
+            copies += __walk_local(path, target)
+        else:
+            st = os.stat(path)
+            copies.append(FileCopy(path, target, st.st_size,
+                st.st_mode & 0o777))
+    return copies
+
+def plan_download(sftp: Any, sources: List[str], dest: str) -> List[FileCopy]:
+    """List the files to copy from the remote sources (which may contain
+    wildcards in the last path component) to the local dest
+
+    Raises:
+        FileNotFoundError: if a source doesn't match any file
+    """
+    paths = []
+    for source in sources:
+        parent, pattern = posixpath.split(source)
+        if glob.has_magic(pattern):
+            names = sorted(fnmatch.filter(sftp.listdir(parent), pattern))
+            matches = [posixpath.join(parent, n) for n in names]
+        else:
+            sftp.stat(source)
+            matches = [source]
+        if len(matches) == 0:
+            raise FileNotFoundError(source)
+        paths += matches
+
+    into_dir = (len(paths) > 1 or dest.endswith(os.sep) or
+        os.path.isdir(dest))
+    copies = []
+    for path in paths:
+        name = posixpath.basename(posixpath.normpath(path))
+        target = os.path.join(dest, name) if into_dir else dest
+        attr = sftp.stat(path)
+        if stat.S_ISDIR(attr.st_mode):
+            copies += __walk_remote(sftp, path, target)
+        else:
+            copies.append(FileCopy(path, target, attr.st_size,
+                attr.st_mode & 0o777))
+    return copies
+
+def local_hash(path: str, size: Optional[int]=None) -> str:
+    """sha256 of the file at path, or of its first size bytes"""
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        remaining = size
+        while remaining is None or remaining > 0:
+            data = f.read(CHUNK_SIZE if remaining is None
+                else min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            file_hash.update(data)
+            if remaining is not None:
+                remaining -= len(data)
+    return file_hash.hexdigest()
+
+def remote_hashes(connection: Connection, paths: List[str]) -> Dict[str, str]:
+    """sha256 of each of the remote paths that exists, in as few commands as
+    possible"""
+    hashes = {}
+    for i in range(0, len(paths), 200):
+        batch = " ".join(shlex.quote(p) for p in paths[i:i + 200])
+        for line in run_remote(connection,
+            f"sha256sum -- {batch} 2>/dev/null").splitlines():
+            file_hash, _, path = line.partition("  ")
+            hashes[path] = file_hash
+    return hashes
+
+def remote_prefix_hash(connection: Connection, path: str, size: int) -> str:
+    cmd = f"head -c {size} {shlex.quote(path)} | sha256sum"
+    return run_remote(connection, cmd).split(" ")[0]
+
+def __unchanged(connection: Connection, sftp: Any, copies: List[FileCopy],
+    upload: bool) -> List[FileCopy]:
+    """Return the copies whose destination already has the same content"""
+    def dest_size(copy: FileCopy) -> int:
+        try:
+            if upload:
+                return sftp.stat(copy.dest).st_size
+            return os.stat(copy.dest).st_size
+        except (IOError, OSError):
+            return -1
+
+    same_size = [c for c in copies if dest_size(c) == c.size]
+    if len(same_size) == 0:
+        return []
+    remote = remote_hashes(connection,
+        [c.dest if upload else c.src for c in same_size])
+    unchanged = []
+    for copy in same_size:
+        local = copy.src if upload else copy.dest
+        if remote.get(copy.dest if upload else copy.src) == local_hash(local):
+            unchanged.append(copy)
+    return unchanged
+
+def __resume_offset(connection: Connection, sftp: Any, copy: FileCopy,
+    upload: bool) -> int:
+    """Size of the partial copy at the destination if its content matches
+    the start of the source, otherwise 0"""
+    part = f"{copy.dest}{PART_SUFFIX}"
+    try:
+        size = sftp.stat(part).st_size if upload else os.stat(part).st_size
+    except (IOError, OSError):
+        return 0
+    if size == 0 or size >= copy.size:
+        return 0
+    if upload:
+        local, remote = local_hash(copy.src, size), remote_prefix_hash(
+            connection, part, size)
+    else:
+        local, remote = local_hash(part, size), remote_prefix_hash(
+            connection, copy.src, size)
+    return size if local == remote else 0
+
+def __copy_file(connection: Connection, sftp: Any, copy: FileCopy,
+    upload: bool, on_progress: Callable[[int], None]) -> int:
+    """Copy a single file, returning the offset it was resumed from"""
+    resumable = copy.size >= RESUME_MIN_SIZE
+    offset = (__resume_offset(connection, sftp, copy, upload)
+        if resumable else 0)
+    target = f"{copy.dest}{PART_SUFFIX}" if resumable else copy.dest
+    mode = "ab" if offset > 0 else "wb"
+    if upload:
+        src, dest = open(copy.src, "rb"), sftp.open(target, mode)
+        dest.set_pipelined(True)
+    else:
+        src, dest = sftp.open(copy.src, "rb"), open(target, mode)
+    with src, dest:
+        src.seek(offset)
+        if not upload:
+            # paramiko prefetches from the current position up to the size,
+            # so the part that was already downloaded isn't read again
+            src.prefetch(copy.size)
+        on_progress(offset)
+        while True:
+            data = src.read(CHUNK_SIZE)
+            if not data:
+                break
+            dest.write(data)
+            on_progress(len(data))
+
+    if upload:
+        if resumable:
+            sftp.posix_rename(target, copy.dest)
+        if copy.mode & 0o111:
+            sftp.chmod(copy.dest, copy.mode)
+    else:
+        if resumable:
+            os.replace(target, copy.dest)
+        os.chmod(copy.dest, copy.mode)
+    return offset
+
+def copy_files(connection: Connection, copies: List[FileCopy], upload: bool,
+    jobs: int=8, checksum: bool=True, description: str="") -> CopyStats:
+    """Copy files to (upload) or from the compute over SFTP sessions of
+    connection, running up to jobs transfers at a time
+
+    Args:
+        connection (Connection): connection to the compute
+        copies (List[FileCopy]): files to copy
+        upload (bool): True to copy local files to the compute
+        jobs (int, optional): maximum number of concurrent transfers
+        checksum (bool, optional): skip files whose destination has the same
+            sha256
+        description (str, optional): description for the progress bar
+
+    Returns:
+        CopyStats: what was copied
+    """
+    sftp = connection.sftp()
+    stats = CopyStats(files=len(copies))
+    if checksum:
+        unchanged = __unchanged(connection, sftp, copies, upload)
+        stats.skipped = len(unchanged)
+        copies = [c for c in copies if c not in unchanged]
+    stats.bytes_total = sum(c.size for c in copies)
+
+    # Create all of the destination directories up front
+    dirs = sorted(set(posixpath.dirname(c.dest) if upload
+        else os.path.dirname(c.dest) for c in copies) - {""})
+    if upload and len(dirs) > 0:
+        run_remote(connection,
+            f"mkdir -p {' '.join(shlex.quote(d) for d in dirs)}")
+    elif not upload:
+        for d in dirs:
+            os.makedirs(d, exist_ok=True)
+
+    with Progress(
+        TextColumn("[progress.description]{task.description}"),
+        BarColumn(),
+        DownloadColumn(),
+        TransferSpeedColumn(),
+        TimeRemainingColumn(),
+        disable=not exec.show_progress,
+    ) as progress, ThreadPoolExecutor(max_workers=jobs) as executor:
+        task = progress.add_task(description, total=stats.bytes_total)
+
+        def on_progress(size: int):
+            progress.advance(task, size)
+
+        # A paramiko SFTPClient can't be used by several threads at once,
+        # so each worker opens its own SFTP channel on the connection
+        sessions, opened = threading.local(), []
+        def copy(c: FileCopy) -> int:
+            if not hasattr(sessions, "sftp"):
+                sessions.sftp = connection.client.open_sftp()
+                opened.append(sessions.sftp)
+            return __copy_file(connection, sessions.sftp, c, upload,
+                on_progress)
+
+        try:
+            futures = [executor.submit(copy, c) for c in copies]
+            for future in futures:
+                offset = future.result()
+                if offset > 0:
+                    stats.resumed += 1
+                stats.bytes_copied -= offset
+        finally:
+            executor.shutdown()
+            for worker_sftp in opened:
+                worker_sftp.close()
+    stats.bytes_copied += stats.bytes_total
+    return stats
@@ -376,4 +376,11 @@ def info(runtime: EzRuntime):
     print(f"[green]Name[/green]:           {ez.workspace_name}")
     print(f"[green]Subscription[/green]:   {subscription_info}")
     print(f"[green]Resource Group[/green]: {ez.resource_group}")
-    print(f"[green]Azure Region[/green]:   {ez.region}")
\ No newline at end of file
+    print(f"[green]Azure Region[/green]:   {ez.region}")
+    print(f"\nCompute defaults:\n")
+    print(f"[green]OS disk size[/green]:   {ez.os_disk_size_gb}GB")
+    print(f"[green]Ephemeral OS disk[/green]: {ez.ephemeral_os_disk}")
+    print(f"[green]Accelerated networking[/green]: "
+        f"{ez.accelerated_networking}")
+    print(f"[green]Proximity placement group[/green]: "
+        f"{ez.proximity_placement_group or 'none'}")
\ No newline at end of file